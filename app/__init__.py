@@ -1,13 +1,22 @@
 import os
 from flask import Flask
 from dotenv import load_dotenv
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Import extensions from the new file
-from app.extensions import db, migrate, login_manager, mail
+from app.extensions import db, login_manager, cache, limiter, invigilation, init_migrate
+from app.compression import init_compression
+from app.assets import init_assets
+from app.templating import init_templates
 
-load_dotenv()
+def create_app(config_class=None, cli=True):
+    """
+    Builds the application. Web workers pass cli=False to skip the CLI
+    commands and Flask-Migrate (and with it Alembic), which only `flask`
+    needs; Flask-Mail is set up on the first email either way.
+    """
+    load_dotenv()
 
-def create_app(config_class=None):
     app = Flask(__name__)
 
     # Load configuration
@@ -25,11 +34,71 @@ def create_app(config_class=None):
     app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD') # Your email password or app-specific password
     app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER') # The "From" address for emails
 
+    # Signs offline centre bundles: the central server's own key, or at a centre the key derived for it
+    app.config['CENTRE_BUNDLE_KEY'] = os.environ.get('CENTRE_BUNDLE_KEY')
+
+    # Submissions are accepted this long after an attempt's time runs out (slow networks, clock drift)
+    app.config['SUBMIT_GRACE_SECONDS'] = int(os.environ.get('SUBMIT_GRACE_SECONDS', 120))
+
+    # Uploaded resource files, kept out of the static folder (defaults to instance/uploads)
+    app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER')
+    # Largest file the chunked upload API accepts, in bytes
+    app.config['MAX_UPLOAD_SIZE'] = int(os.environ.get('MAX_UPLOAD_SIZE', 2 * 1024 * 1024 * 1024))
+    # Serving uploaded resource files: X-Sendfile (Apache/lighttpd) or an nginx
+    # internal location such as /protected-uploads/ mapped to the upload folder
+    app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', 'false').lower() in ['true', 'on', '1']
+    app.config['RESOURCE_ACCEL_REDIRECT'] = os.environ.get('RESOURCE_ACCEL_REDIRECT')
+
+    # Cache shared by all workers: 'sqlite' (a file in the instance folder), 'memory' or 'null'
+    app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'sqlite')
+    app.config['CACHE_PATH'] = os.environ.get('CACHE_PATH')
+    app.config['CACHE_MAX_ENTRIES'] = int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+    app.config['CACHE_MAX_BYTES'] = int(os.environ.get('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    app.config['CACHE_L1_SIZE'] = int(os.environ.get('CACHE_L1_SIZE', 256))
+    app.config['CACHE_L1_TTL'] = int(os.environ.get('CACHE_L1_TTL', 10))
+
+    # Number of reverse proxies (e.g. nginx) in front of the app whose X-Forwarded-For is trusted;
+    # without it every request seems to come from the proxy and shares its rate limits
+    app.config['PROXY_FIX_X_FOR'] = int(os.environ.get('PROXY_FIX_X_FOR', 0))
+
+    # Sign-in and verification rate limits, shared by all workers: 'sqlite', 'memory' or 'null'
+    app.config['RATELIMIT_BACKEND'] = os.environ.get('RATELIMIT_BACKEND', 'sqlite')
+    app.config['RATELIMIT_PATH'] = os.environ.get('RATELIMIT_PATH')
+
+    # Live invigilation counters, shared by all workers: 'sqlite' or 'memory'
+    app.config['INVIGILATION_BACKEND'] = os.environ.get('INVIGILATION_BACKEND', 'sqlite')
+    app.config['INVIGILATION_PATH'] = os.environ.get('INVIGILATION_PATH')
+    # Live dashboard streams each worker serves at once; each holds one of its GUNICORN_THREADS
+    app.config['INVIGILATION_MAX_STREAMS'] = int(os.environ.get('INVIGILATION_MAX_STREAMS', 2))
+
+    # Compiled template bytecode shared by all processes: 'filesystem' (a folder in the instance folder) or 'none'
+    app.config['TEMPLATE_CACHE'] = os.environ.get('TEMPLATE_CACHE', 'filesystem')
+    app.config['TEMPLATE_CACHE_PATH'] = os.environ.get('TEMPLATE_CACHE_PATH')
+
+    # Compress text responses; turn off when a proxy in front already does (static files are prebuilt)
+    app.config['COMPRESS_RESPONSES'] = os.environ.get('COMPRESS_RESPONSES', 'true').lower() in ['true', 'on', '1']
+    app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+    app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+    app.config['COMPRESS_BROTLI_QUALITY'] = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+
+    # Optional overrides (e.g. a separate database for the benchmark harness)
+    if config_class is not None:
+        app.config.from_object(config_class)
+
+    if app.config['PROXY_FIX_X_FOR']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
     # Initialize extensions with the app
     db.init_app(app)
-    migrate.init_app(app, db)
     login_manager.init_app(app)
-    mail.init_app(app)
+    cache.init_app(app)
+    limiter.init_app(app)
+    invigilation.init_app(app)
+    init_compression(app)
+    init_assets(app)
+    init_templates(app)
+    if cli:
+        init_migrate(app)
 
     # Register blueprints
     from app.auth import bp as auth_bp
@@ -43,7 +112,8 @@ def create_app(config_class=None):
         from app import models
 
     # Register CLI commands
-    from app import commands
-    commands.register_commands(app)
+    if cli:
+        from app import commands
+        commands.register_commands(app)
 
     return app
\ No newline at end of file
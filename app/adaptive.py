@@ -0,0 +1,244 @@
+"""
+Computerized adaptive practice on a two-parameter logistic (2PL) IRT model.
+
+Item parameters are calibrated offline (flask calibrate-items) from
+historical attempt answers. At delivery time each subject's item bank is
+held in an InformationTable: for every ability bucket the items are
+pre-sorted by Fisher information, so picking the next item is a walk down
+one row past the items the student has already seen.
+"""
+import time
+from datetime import datetime
+
+import numpy as np
+
+from app.extensions import db
+from app.models import Question, QuestionType, ExamAttempt, AttemptAnswer, ItemParameter, StudentAbility, exam_questions
+from app.grading import is_correct
+from app.answers import decode
+
+# Only questions that can be scored automatically can be chosen adaptively
+OBJECTIVE_TYPES = (QuestionType.MCQ_SINGLE, QuestionType.MCQ_MULTIPLE)
+
+# Ability buckets the information tables are indexed by
+THETA_BUCKETS = np.linspace(-4.0, 4.0, 33)
+# Quadrature points for the ability estimate
+QUADRATURE = np.linspace(-4.0, 4.0, 81)
+
+# Starting difficulty for items that have not been calibrated yet
+DIFFICULTY_PRIORS = {'Easy': -1.0, 'Medium': 0.0, 'Hard': 1.0}
+
+# How often a worker checks whether a subject's bank was recalibrated
+TABLE_TTL = 60
+# Stop a session early once the ability estimate is this precise
+TARGET_STANDARD_ERROR = 0.3
+
+
+def _probability(theta, a, b):
+    return 1.0 / (1.0 + np.exp(-a * (theta - b)))
+
+
+def fit_2pl(person_idx, item_idx, responses, n_persons, n_items, iterations=50):
+    """
+    Joint maximum likelihood fit of a 2PL model. Inputs are parallel arrays
+    with one entry per response; every step is a vectorised Newton update
+    aggregated with np.bincount. Returns (theta, a, b).
+    """
+    y = responses.astype(float)
+    counts = np.maximum(np.bincount(item_idx, minlength=n_items), 1)
+    p_correct = np.clip(np.bincount(item_idx, y, n_items) / counts, 0.02, 0.98)
+    b = -np.log(p_correct / (1.0 - p_correct))
+    a = np.ones(n_items)
+    theta = np.zeros(n_persons)
+    eps = 1e-6
+
+    for _ in range(iterations):
+        ai = a[item_idx]
+        p = _probability(theta[person_idx], ai, b[item_idx])
+        residual, weight = y - p, p * (1.0 - p)
+        step = np.bincount(person_idx, ai * residual, n_persons) / \
+            (np.bincount(person_idx, ai * ai * weight, n_persons) + eps)
+        theta = np.clip(theta + np.clip(step, -1.0, 1.0), -4.0, 4.0)
+        # Fix the scale: abilities are standardised, items move around them
+        theta = (theta - theta.mean()) / (theta.std() or 1.0)
+
+        p = _probability(theta[person_idx], ai, b[item_idx])
+        residual, weight = y - p, p * (1.0 - p)
+        distance = theta[person_idx] - b[item_idx]
+        b_step = np.bincount(item_idx, -ai * residual, n_items) / \
+            (np.bincount(item_idx, ai * ai * weight, n_items) + eps)
+        a_step = np.bincount(item_idx, distance * residual, n_items) / \
+            (np.bincount(item_idx, distance * distance * weight, n_items) + eps)
+        b = np.clip(b + np.clip(b_step, -1.0, 1.0), -4.0, 4.0)
+        a = np.clip(a + np.clip(a_step, -0.5, 0.5), 0.2, 3.0)
+
+    return theta, a, b
+
+
+def _collect_responses(subject, chunk_size=1000):
+    """Scores every answered objective question in the subject from submitted attempts."""
+    questions = {question.id: question for question in Question.query.filter(
+        Question.subject == subject, Question.question_type.in_(OBJECTIVE_TYPES))}
+    if not questions:
+        return [], [], []
+
+    users, items, correct = [], [], []
+    stmt = db.select(ExamAttempt.user_id, AttemptAnswer.question_id,
+                     AttemptAnswer.choice, AttemptAnswer.choices, AttemptAnswer.text)\
+        .join(ExamAttempt, ExamAttempt.id == AttemptAnswer.attempt_id)\
+        .join(exam_questions, (exam_questions.c.exam_id == ExamAttempt.exam_id)
+                              & (exam_questions.c.question_id == AttemptAnswer.question_id))\
+        .join(Question, Question.id == AttemptAnswer.question_id)\
+        .where(Question.subject == subject, Question.question_type.in_(OBJECTIVE_TYPES),
+               ExamAttempt.end_time.isnot(None))
+    for user_id, question_id, choice, choices, text in db.session.execute(
+            stmt.execution_options(yield_per=chunk_size)):
+        answer = decode(choice, choices, text)
+        # Omitted items are treated as missing rather than wrong
+        if answer in (None, '', []):
+            continue
+        users.append(user_id)
+        items.append(question_id)
+        correct.append(is_correct(questions[question_id], answer))
+    return users, items, correct
+
+
+def calibrate(subject, min_responses=20, iterations=50):
+    """
+    Calibrates the 2PL parameters of a subject's objective questions and the
+    abilities of the students who answered them. Items with fewer than
+    `min_responses` responses are left out. Returns (items, students).
+    """
+    users, items, correct = _collect_responses(subject)
+    if not items:
+        return 0, 0
+
+    items = np.asarray(items)
+    item_ids, item_idx = np.unique(items, return_inverse=True)
+    keep = np.bincount(item_idx)[item_idx] >= min_responses
+    if not keep.any():
+        return 0, 0
+    users = np.asarray(users)[keep]
+    correct = np.asarray(correct)[keep]
+    item_ids, item_idx = np.unique(items[keep], return_inverse=True)
+    user_ids, person_idx = np.unique(users, return_inverse=True)
+
+    theta, a, b = fit_2pl(person_idx, item_idx, correct, len(user_ids), len(item_ids), iterations)
+    item_counts = np.bincount(item_idx, minlength=len(item_ids))
+    person_counts = np.bincount(person_idx, minlength=len(user_ids))
+
+    now = datetime.utcnow()
+    for start in range(0, len(item_ids), 500):
+        chunk = [int(i) for i in item_ids[start:start + 500]]
+        ItemParameter.query.filter(ItemParameter.question_id.in_(chunk)).delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(ItemParameter, [
+        {'question_id': int(question_id), 'subject': subject, 'discrimination': float(a[i]),
+         'difficulty': float(b[i]), 'responses': int(item_counts[i]), 'calibrated_at': now}
+        for i, question_id in enumerate(item_ids)
+    ])
+    StudentAbility.query.filter_by(subject=subject).delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(StudentAbility, [
+        {'user_id': int(user_id), 'subject': subject, 'theta': float(theta[i]),
+         'standard_error': float(1.0 / np.sqrt(max(person_counts[i], 1))),
+         'responses': int(person_counts[i]), 'updated_at': now}
+        for i, user_id in enumerate(user_ids)
+    ])
+    db.session.commit()
+    return len(item_ids), len(user_ids)
+
+
+class InformationTable:
+    """A subject's item bank, pre-sorted by information in each ability bucket."""
+
+    def __init__(self, item_ids, a, b):
+        self.item_ids = np.asarray(item_ids, dtype=np.int64)
+        self.a = np.asarray(a, dtype=float)
+        self.b = np.asarray(b, dtype=float)
+        self.index = {int(item_id): i for i, item_id in enumerate(self.item_ids)}
+        p = _probability(THETA_BUCKETS[:, None], self.a[None, :], self.b[None, :])
+        information = self.a[None, :] ** 2 * p * (1.0 - p)
+        self.order = np.argsort(-information, axis=1).astype(np.int32)
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    def parameters(self, item_id):
+        i = self.index[item_id]
+        return float(self.a[i]), float(self.b[i])
+
+    def select(self, theta, exclude=()):
+        """Returns the most informative item at this ability that is not in `exclude`."""
+        bucket = int(np.abs(THETA_BUCKETS - theta).argmin())
+        for i in self.order[bucket]:
+            item_id = int(self.item_ids[i])
+            if item_id not in exclude:
+                return item_id
+        return None
+
+
+_tables = {}
+
+
+def get_table(subject):
+    """
+    Returns the subject's InformationTable, rebuilding it when questions are
+    added or the bank is recalibrated. Checks for changes at most every
+    TABLE_TTL seconds per worker.
+    """
+    cached = _tables.get(subject)
+    if cached and time.monotonic() - cached['checked'] < TABLE_TTL:
+        return cached['table']
+
+    stamp = db.session.query(
+        db.func.count(Question.id), db.func.max(ItemParameter.calibrated_at)
+    ).outerjoin(ItemParameter, ItemParameter.question_id == Question.id)\
+     .filter(Question.subject == subject, Question.question_type.in_(OBJECTIVE_TYPES)).one()
+    stamp = tuple(stamp)
+    if cached and cached['stamp'] == stamp:
+        cached['checked'] = time.monotonic()
+        return cached['table']
+
+    rows = db.session.query(
+        Question.id, Question.difficulty, ItemParameter.discrimination, ItemParameter.difficulty
+    ).outerjoin(ItemParameter, ItemParameter.question_id == Question.id)\
+     .filter(Question.subject == subject, Question.question_type.in_(OBJECTIVE_TYPES)).all()
+    table = InformationTable(
+        [row[0] for row in rows],
+        [row[2] if row[2] is not None else 1.0 for row in rows],
+        [row[3] if row[3] is not None else DIFFICULTY_PRIORS.get(row[1], 0.0) for row in rows],
+    )
+    _tables[subject] = {'table': table, 'stamp': stamp, 'checked': time.monotonic()}
+    return table
+
+
+def estimate_ability(responses, prior_mean=0.0):
+    """
+    Expected a posteriori ability estimate from [(a, b, correct), ...] with a
+    N(prior_mean, 1) prior. Returns (theta, standard error).
+    """
+    prior = np.exp(-0.5 * (QUADRATURE - prior_mean) ** 2)
+    if not responses:
+        return float(prior_mean), 1.0
+    a, b, y = (np.asarray(column, dtype=float) for column in zip(*responses))
+    p = np.clip(_probability(QUADRATURE[:, None], a[None, :], b[None, :]), 1e-9, 1 - 1e-9)
+    log_likelihood = (y * np.log(p) + (1.0 - y) * np.log(1.0 - p)).sum(axis=1)
+    posterior = prior * np.exp(log_likelihood - log_likelihood.max())
+    posterior /= posterior.sum()
+    theta = float((QUADRATURE * posterior).sum())
+    return theta, float(np.sqrt(((QUADRATURE - theta) ** 2 * posterior).sum()))
+
+
+def starting_ability(user_id, subject):
+    ability = db.session.get(StudentAbility, (user_id, subject))
+    return ability.theta if ability else 0.0
+
+
+def save_ability(user_id, subject, theta, standard_error, responses):
+    ability = db.session.get(StudentAbility, (user_id, subject))
+    if ability is None:
+        ability = StudentAbility(user_id=user_id, subject=subject, responses=0)
+        db.session.add(ability)
+    ability.theta = theta
+    ability.standard_error = standard_error
+    ability.responses = (ability.responses or 0) + responses
+    ability.updated_at = datetime.utcnow()
@@ -0,0 +1,99 @@
+"""
+Attempt answers, stored one row per (attempt, question) in attempt_answer.
+
+MCQ answers are option indices, so they are kept as integers: a single
+choice in `choice`, a multiple choice as a bitmask of indices in `choices`.
+That keeps the rows small and lets per-question statistics run in SQL.
+Anything else (short answers, essays) goes in `text`. Rows are indexed by
+(question_id, attempt_id) for per-question reads such as grading one
+question across a class.
+
+Scoring code works on the dict form, {str(question_id): answer}, which
+load_answers() rebuilds. A multiple choice comes back as a sorted list of
+index strings; a list that is not all option indices is kept as its items
+joined by newlines.
+"""
+from app.extensions import db
+from app.models import AttemptAnswer
+
+MAX_CHOICE = 32767  # SmallInteger
+MAX_MASK_BIT = 62  # BigInteger, sign bit left alone
+
+
+def _index(value):
+    """The option index `value` spells exactly, or None."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value if 0 <= value <= MAX_CHOICE else None
+    if isinstance(value, str) and value.isdigit() and str(int(value)) == value and int(value) <= MAX_CHOICE:
+        return int(value)
+    return None
+
+
+def encode(answer):
+    """(choice, choices, text) for an answer, or None for no answer."""
+    if answer is None:
+        return None
+    if isinstance(answer, (list, tuple)):
+        indices = [_index(value) for value in answer]
+        if all(index is not None and index <= MAX_MASK_BIT for index in indices):
+            mask = 0
+            for index in indices:
+                mask |= 1 << index
+            return None, mask, None
+        return None, None, '\n'.join(str(value) for value in answer)
+    index = _index(answer)
+    if index is not None:
+        return index, None, None
+    return None, None, str(answer)
+
+
+def decode(choice, choices, text):
+    if choice is not None:
+        return str(choice)
+    if choices is not None:
+        return [str(bit) for bit in range(MAX_MASK_BIT + 1) if choices >> bit & 1]
+    return text
+
+
+def answer_rows(attempt_id, answers):
+    """attempt_answer rows for an answers dict; unanswered questions have no row."""
+    rows = []
+    for question_id, answer in (answers or {}).items():
+        encoded = encode(answer)
+        if encoded is not None:
+            choice, choices, text = encoded
+            rows.append({'attempt_id': attempt_id, 'question_id': int(question_id),
+                         'choice': choice, 'choices': choices, 'text': text})
+    return rows
+
+
+def save_answers(attempt_id, answers):
+    """
+    Stores the given answers for an attempt, replacing earlier answers to the
+    same questions. A None answer clears the question. Needs a flushed
+    attempt id; the caller commits.
+    """
+    if not answers:
+        return
+    AttemptAnswer.query.filter(
+        AttemptAnswer.attempt_id == attempt_id,
+        AttemptAnswer.question_id.in_([int(question_id) for question_id in answers])
+    ).delete(synchronize_session=False)
+    rows = answer_rows(attempt_id, answers)
+    if rows:
+        db.session.execute(AttemptAnswer.__table__.insert(), rows)
+
+
+def load_answers(attempt_ids, chunk_size=500):
+    """{attempt_id: {str(question_id): answer}} for the given attempts, one query per chunk."""
+    attempt_ids = list(attempt_ids)
+    answers = {attempt_id: {} for attempt_id in attempt_ids}
+    for start in range(0, len(attempt_ids), chunk_size):
+        for attempt_id, question_id, choice, choices, text in db.session.query(
+            AttemptAnswer.attempt_id, AttemptAnswer.question_id,
+            AttemptAnswer.choice, AttemptAnswer.choices, AttemptAnswer.text
+        ).filter(AttemptAnswer.attempt_id.in_(attempt_ids[start:start + chunk_size])):
+            answers[attempt_id][str(question_id)] = decode(choice, choices, text)
+    return answers
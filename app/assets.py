@@ -0,0 +1,132 @@
+"""
+Fingerprinted static files.
+
+`flask assets build` copies every file under app/static (uploads aside) to
+app/static/build/ with a hash of its content in the name, so css/style.css
+becomes build/css/style.3e1f0c9a2b7d.css, writes gzip (and, with the
+`brotli` package, brotli) variants of the text files next to them, and
+records the names in build/manifest.json.
+
+While a manifest exists, url_for('static', filename=...) returns the hashed
+name, and hashed files are served with a year-long immutable Cache-Control:
+a changed file gets a new name, so browsers never need to revalidate.
+Clients that accept a precompressed variant get it instead of the file
+(behind nginx, gzip_static does the same). Without a build, static URLs and
+caching are as before. Rebuild, and restart the workers, after changing
+anything under app/static.
+"""
+import hashlib
+import json
+import mimetypes
+import os
+
+from flask import current_app, send_from_directory
+
+from app.compression import COMPRESSIBLE, SUFFIXES, available_encodings, accepted_encodings, compress
+
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+SKIP_DIRS = {'uploads', BUILD_DIR}
+HASH_LENGTH = 12
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# Build time is not request time, so compress as hard as the encoders go
+BUILD_LEVELS = {'gzip': 9, 'br': 11}
+
+
+def _source_files(static_folder):
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder:
+            dirs[:] = [name for name in dirs if name not in SKIP_DIRS]
+        for name in sorted(files):
+            if not name.startswith('.'):
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, static_folder).replace(os.sep, '/'), path
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + '.partial'
+    with open(partial, 'wb') as f:
+        f.write(data)
+    os.replace(partial, path)
+
+
+def build_assets(static_folder, clean=False):
+    """
+    Writes the hashed files, their compressed variants and the manifest.
+    Files from earlier builds are kept, so pages rendered before a deploy
+    still load, unless `clean`. Returns the manifest.
+    """
+    build_folder = os.path.join(static_folder, BUILD_DIR)
+    manifest, written = {}, set()
+    for name, path in _source_files(static_folder):
+        with open(path, 'rb') as f:
+            data = f.read()
+        stem, extension = os.path.splitext(name)
+        hashed = f'{BUILD_DIR}/{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{extension}'
+        target = os.path.join(static_folder, *hashed.split('/'))
+        outputs = [(target, data)]
+        if mimetypes.guess_type(name)[0] in COMPRESSIBLE:
+            for encoding in available_encodings():
+                compressed = compress(data, encoding, BUILD_LEVELS[encoding])
+                if len(compressed) < len(data):
+                    outputs.append((target + SUFFIXES[encoding], compressed))
+        for output, content in outputs:
+            written.add(output)
+            # Same name, same content: a file from an earlier build can stay as it is
+            if not os.path.exists(output):
+                _write(output, content)
+        manifest[name] = hashed
+
+    if clean:
+        for root, _, files in os.walk(build_folder):
+            for name in files:
+                path = os.path.join(root, name)
+                if path not in written and name != MANIFEST:
+                    os.remove(path)
+    _write(os.path.join(build_folder, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def load_manifest(static_folder):
+    """{source name: hashed name} from the last build, or {} if there is none."""
+    try:
+        with open(os.path.join(static_folder, BUILD_DIR, MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _send_static(filename):
+    if not filename.startswith(BUILD_DIR + '/'):
+        return current_app.send_static_file(filename)
+    static_folder = current_app.static_folder
+    mimetype = mimetypes.guess_type(filename)[0]
+    response = None
+    for encoding in accepted_encodings():
+        variant = filename + SUFFIXES[encoding]
+        if os.path.isfile(os.path.join(static_folder, *variant.split('/'))):
+            response = send_from_directory(static_folder, variant, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    if response is None:
+        response = current_app.send_static_file(filename)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = IMMUTABLE
+    return response
+
+
+def init_assets(app):
+    """Points static URLs at the last build's hashed files, if there is one."""
+    if not app.static_folder:
+        return
+    app.view_functions['static'] = _send_static
+    manifest = load_manifest(app.static_folder)
+    app.extensions['assets'] = manifest
+    if not manifest:
+        return
+
+    @app.url_defaults
+    def _fingerprint(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in manifest:
+            values['filename'] = manifest[values['filename']]
@@ -4,6 +4,7 @@ from app.extensions import db
 from app.auth import bp
 from app.models import User, School
 from app.email import send_email
+from app.ratelimit import rate_limited, record_failure, query_email
 import random
 from datetime import datetime, timedelta
 
@@ -61,6 +62,8 @@ def register():
 
 
 @bp.route('/verify-otp', methods=['GET', 'POST'])
+# A code lives 10 minutes, so a handful of guesses per code
+@rate_limited('verify-otp', per_address=(60, 600), per_email=(5, 600), email=query_email)
 def verify_otp():
     email = request.args.get('email')
     if not email:
@@ -87,6 +90,7 @@ def verify_otp():
 
 
 @bp.route('/resend-otp')
+@rate_limited('resend-otp', per_address=(10, 3600), per_email=(3, 600), methods=('GET',), email=query_email)
 def resend_otp():
     email = request.args.get('email')
     if not email:
@@ -110,6 +114,8 @@ def resend_otp():
 
 
 @bp.route('/login', methods=['GET', 'POST'])
+# A whole exam centre may sign in from one address; guessing one account's password is what's held back
+@rate_limited('login', per_address=(300, 60), per_email=(10, 900), email_failures_only=True)
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('main.dashboard'))
@@ -120,6 +126,7 @@ def login():
         user = User.query.filter_by(email=email).first()
 
         if user is None or not user.check_password(password):
+            record_failure()
             flash('Invalid email or password.', 'danger')
             # Re-render the form with an error instead of redirecting, to break the loop
             return render_template('auth/login.html', title='Login')
@@ -0,0 +1,421 @@
+"""
+Offline centre bundles.
+
+An exam bundle packages everything one centre needs to run its exams on a
+local instance: the centre's candidates and teachers, the exams with their
+pinned papers and questions (with answer keys withheld), and resource
+files. The local instance loads it into an empty database, runs the
+sitting, and exports a results bundle that the central server merges back
+in. Papers keep their central digest at the centre, so results come back
+pinned to the paper that was sat and are scored against its keys. Attempts
+carry a sync_key, so importing the same results twice changes nothing.
+
+Both kinds of bundle are zip archives with a manifest that lists the
+SHA-256 of every member and is signed with HMAC-SHA256 under the centre's
+key. The central server derives each centre's key from its own
+CENTRE_BUNDLE_KEY (`flask centre-bundle key`), and that centre's local
+instance is given it as its CENTRE_BUNDLE_KEY. A centre therefore never
+holds the central key, nor can it sign bundles for another centre.
+
+An exam bundle's manifest also carries a grant: the centre and the exams
+it was given, signed with the central key itself. The centre hands it
+back with its results, and only that centre's candidates sitting those
+exams are imported.
+"""
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import tempfile
+import uuid
+import zipfile
+import zlib
+from datetime import datetime
+
+from flask import current_app
+
+from app.extensions import db
+from app.models import (School, User, UserRole, Question, QuestionType, Exam, ExamAttempt, ArchivedAttempt, AttemptAnswer,
+                        Resource, ResourceType, Blob, ExamSnapshot, exam_questions)
+from app.grading import recompute_scores
+from app.snapshots import pin_exam, load_paper
+from app.answers import load_answers, answer_rows
+from app.retention import EXAM_ACTIVE
+from app.uploads import upload_folder, static_upload_folder, take_in_files
+
+FORMAT_VERSION = 2
+EXAM_BUNDLE = 'exam-bundle'
+RESULTS_BUNDLE = 'results-bundle'
+# Written into the local instance folder when a bundle is loaded
+LOCAL_STATE_FILE = 'centre_bundle.json'
+
+
+class BundleError(Exception):
+    pass
+
+
+def _bundle_key():
+    key = current_app.config.get('CENTRE_BUNDLE_KEY')
+    if not key:
+        raise BundleError('Set CENTRE_BUNDLE_KEY to sign and verify centre bundles.')
+    return key.encode('utf-8')
+
+
+def centre_key(school_id):
+    """The key one centre's local instance is given, derived on the central server."""
+    return hmac.new(_bundle_key(), f'centre:{school_id}'.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def _central_key(manifest):
+    return centre_key(manifest.get('school_id')).encode('utf-8')
+
+
+def _local_key(manifest):
+    return _bundle_key()
+
+
+def _grant(bundle_id, school_id, exam_ids):
+    """Signs what a bundle was issued for; only the central server can make or check it."""
+    payload = json.dumps([bundle_id, school_id, sorted(exam_ids)], separators=(',', ':')).encode('utf-8')
+    return hmac.new(_bundle_key(), payload, hashlib.sha256).hexdigest()
+
+
+def _sign(files, key):
+    payload = json.dumps(files, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hmac.new(key, payload, hashlib.sha256).hexdigest()
+
+
+def _dumps(data):
+    return json.dumps(data, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+
+def _parse(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def _sha256_stream(stream):
+    digest = hashlib.sha256()
+    for block in iter(lambda: stream.read(1024 * 1024), b''):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_bundle(path, kind, members, extra, key, files_on_disk=None):
+    """
+    Writes {name: bytes} members, plus {name: path} files streamed from disk,
+    and a manifest signed with `key` to a zip archive.
+    """
+    files_on_disk = files_on_disk or {}
+    files = {name: hashlib.sha256(data).hexdigest() for name, data in members.items()}
+    for name, file_path in files_on_disk.items():
+        with open(file_path, 'rb') as f:
+            files[name] = _sha256_stream(f)
+    manifest = dict(extra, kind=kind, format_version=FORMAT_VERSION,
+                    created_at=datetime.utcnow().isoformat(), files=files, signature=_sign(files, key))
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as archive:
+        archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+        for name, data in members.items():
+            archive.writestr(name, data)
+        for name, file_path in files_on_disk.items():
+            archive.write(file_path, name)
+    return manifest
+
+
+def _open_bundle(path, kind, key_for):
+    """
+    Opens a bundle and verifies its checksums and its signature under
+    key_for(manifest). Returns (archive, manifest).
+    """
+    archive = zipfile.ZipFile(path)
+    try:
+        manifest = json.loads(archive.read('manifest.json'))
+    except KeyError:
+        raise BundleError('Not a centre bundle: manifest.json is missing.')
+    if manifest.get('kind') != kind:
+        raise BundleError(f"Expected a {kind}, got a {manifest.get('kind')}.")
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise BundleError(f"Unsupported bundle format {manifest.get('format_version')}.")
+    if not hmac.compare_digest(manifest.get('signature', ''), _sign(manifest['files'], key_for(manifest))):
+        raise BundleError('Bundle signature does not match. Check CENTRE_BUNDLE_KEY.')
+    for name, checksum in manifest['files'].items():
+        with archive.open(name) as member:
+            actual = _sha256_stream(member)
+        if actual != checksum:
+            raise BundleError(f'Checksum mismatch for {name}; the bundle is corrupt.')
+    return archive, manifest
+
+
+def _upload_path(link):
+    """Local path of an uploaded resource file, or None for external links."""
+    if link and '/media/' in link:
+        return os.path.join(upload_folder(), os.path.basename(link))
+    if link and '/static/uploads/' in link:
+        # Uploaded before content-addressed storage and not yet taken into the store
+        return os.path.join(static_upload_folder(), os.path.basename(link))
+    return None
+
+
+def export_bundle(school_id, path, exam_ids=()):
+    """
+    Writes an exam bundle for one centre: the active exams created by its
+    teachers plus any active `exam_ids`, each with its pinned paper (exams not yet pinned are
+    pinned first). Answer keys and explanations are withheld.
+    """
+    school = db.session.get(School, school_id)
+    if school is None:
+        raise BundleError(f'Centre {school_id} does not exist.')
+
+    users = User.query.filter_by(school_id=school.id).all()
+    teacher_ids = [u.id for u in users if u.role == UserRole.TEACHER]
+    # Exams being deleted or archived are not sat
+    exams = Exam.query.filter(db.or_(Exam.created_by.in_(teacher_ids), Exam.id.in_(list(exam_ids))),
+                              Exam.status == EXAM_ACTIVE).order_by(Exam.id).all()
+    # Candidates sit the pinned paper; exams from before snapshots get theirs now
+    unpinned = [e for e in exams if e.snapshot_digest is None]
+    for exam in unpinned:
+        pin_exam(exam)
+    if unpinned:
+        db.session.commit()
+    papers = db.session.query(ExamSnapshot.digest, ExamSnapshot.question_digests)\
+        .filter(ExamSnapshot.digest.in_({e.snapshot_digest for e in exams})).all()
+    paper_questions = {digest: load_paper(digest) for digest, _ in papers}
+    links = db.session.query(exam_questions.c.exam_id, exam_questions.c.question_id)\
+        .filter(exam_questions.c.exam_id.in_([e.id for e in exams])).all()
+    question_ids = {q for _, q in links} | {q.id for paper in paper_questions.values() for q in paper}
+    questions = Question.query.filter(Question.id.in_(question_ids)).order_by(Question.id).all()
+    # Exams and questions may have been written by people outside the centre
+    author_ids = {e.created_by for e in exams} | {q.created_by for q in questions}
+    authors = User.query.filter(User.id.in_(author_ids - {u.id for u in users})).all()
+    resources = Resource.query.filter(Resource.uploaded_by.in_(teacher_ids)).all()
+    blobs = Blob.query.filter(Blob.sha256.in_({r.blob_sha256 for r in resources if r.blob_sha256})).all()
+
+    data = {
+        'school': {'id': school.id, 'name': school.name, 'location': school.location},
+        'users': [
+            {'id': u.id, 'full_name': u.full_name, 'email': u.email, 'password_hash': u.password_hash,
+             'role': u.role.name, 'school_id': u.school_id, 'is_verified': u.is_verified}
+            for u in users
+        ] + [
+            # Authors outside the centre are carried without credentials so they cannot log in
+            {'id': u.id, 'full_name': u.full_name, 'email': u.email, 'password_hash': None,
+             'role': u.role.name, 'school_id': None, 'is_verified': False}
+            for u in authors
+        ],
+        'questions': [
+            {'id': q.id, 'text': q.text, 'question_type': q.question_type.name, 'options': q.options,
+             'subject': q.subject, 'topic': q.topic, 'difficulty': q.difficulty,
+             'max_score': q.max_score, 'created_by': q.created_by, 'version': q.version}
+            for q in questions
+        ],
+        'papers': [
+            {'digest': digest, 'question_digests': question_digests,
+             'questions': [dict(q.to_dict(), answer=None, explanation=None) for q in paper_questions[digest]]}
+            for digest, question_digests in papers
+        ],
+        'exams': [
+            {'id': e.id, 'title': e.title, 'subject': e.subject, 'duration_minutes': e.duration_minutes,
+             'created_by': e.created_by, 'creation_date': _iso(e.creation_date), 'snapshot_digest': e.snapshot_digest}
+            for e in exams
+        ],
+        'exam_questions': [[exam_id, question_id] for exam_id, question_id in links],
+        'resources': [
+            {'id': r.id, 'title': r.title, 'description': r.description, 'subject': r.subject, 'topic': r.topic,
+             'resource_type': r.resource_type.name, 'link': r.link, 'blob_sha256': r.blob_sha256,
+             'file_name': r.file_name, 'uploaded_by': r.uploaded_by, 'creation_date': _iso(r.creation_date)}
+            for r in resources
+        ],
+        'blobs': [
+            # Reference counts are local to each instance
+            {'sha256': b.sha256, 'filename': b.filename, 'size': b.size, 'content_type': b.content_type,
+             'ref_count': sum(1 for r in resources if r.blob_sha256 == b.sha256)}
+            for b in blobs
+        ],
+    }
+    resource_files = {}
+    for resource in resources:
+        file_path = _upload_path(resource.link)
+        if file_path and os.path.exists(file_path):
+            resource_files[f'resources/{os.path.basename(file_path)}'] = file_path
+
+    bundle_id = uuid.uuid4().hex
+    exam_ids = [e.id for e in exams]
+    return _write_bundle(path, EXAM_BUNDLE, {'data.json': _dumps(data)}, {
+        'bundle_id': bundle_id,
+        'school_id': school.id,
+        'exam_ids': exam_ids,
+        'grant': _grant(bundle_id, school.id, exam_ids),
+        'school_name': school.name,
+        'counts': {key: len(value) for key, value in data.items() if isinstance(value, list)},
+    }, centre_key(school.id).encode('utf-8'), files_on_disk=resource_files)
+
+
+def load_bundle(path):
+    """Loads an exam bundle into the (empty) local database for offline delivery."""
+    archive, manifest = _open_bundle(path, EXAM_BUNDLE, _local_key)
+    if db.session.query(Exam.id).first() is not None:
+        raise BundleError('The local database already has exams; load bundles into a fresh database.')
+    data = json.loads(archive.read('data.json'))
+
+    db.session.execute(School.__table__.insert(), [data['school']])
+    db.session.execute(User.__table__.insert(), [
+        dict(u, role=UserRole[u['role']]) for u in data['users']
+    ])
+    db.session.execute(Question.__table__.insert(), [
+        # Answer keys stay on the central server; scoring happens after import
+        dict(q, question_type=QuestionType[q['question_type']],
+             answer=None, explanation=None)
+        for q in data['questions']
+    ])
+    if data['papers']:
+        # Under its central digest, though the keys are withheld from this copy
+        db.session.execute(ExamSnapshot.__table__.insert(), [
+            {'digest': p['digest'], 'question_digests': p['question_digests'],
+             'payload': zlib.compress(json.dumps(p['questions'], separators=(',', ':')).encode('utf-8'))}
+            for p in data['papers']
+        ])
+    db.session.execute(Exam.__table__.insert(), [
+        dict(e, creation_date=_parse(e['creation_date'])) for e in data['exams']
+    ])
+    if data['exam_questions']:
+        db.session.execute(exam_questions.insert(), [
+            {'exam_id': exam_id, 'question_id': question_id} for exam_id, question_id in data['exam_questions']
+        ])
+    if data.get('blobs'):
+        db.session.execute(Blob.__table__.insert(), data['blobs'])
+    if data['resources']:
+        db.session.execute(Resource.__table__.insert(), [
+            dict(r, resource_type=ResourceType[r['resource_type']], creation_date=_parse(r['creation_date']))
+            for r in data['resources']
+        ])
+    db.session.commit()
+
+    # Resource files go into the store, never the public static folder
+    os.makedirs(current_app.instance_path, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=current_app.instance_path) as unpacked:
+        for name in archive.namelist():
+            if name.startswith('resources/'):
+                with archive.open(name) as source, \
+                        open(os.path.join(unpacked, os.path.basename(name)), 'wb') as target:
+                    shutil.copyfileobj(source, target)
+        take_in_files(unpacked)
+    db.session.commit()
+
+    with open(os.path.join(current_app.instance_path, LOCAL_STATE_FILE), 'w') as f:
+        json.dump({key: manifest[key] for key in ('bundle_id', 'school_id', 'school_name', 'exam_ids', 'grant')}, f)
+    return manifest
+
+
+def export_results(path):
+    """Packages the local instance's submitted attempts for the central server."""
+    state_file = os.path.join(current_app.instance_path, LOCAL_STATE_FILE)
+    if not os.path.exists(state_file):
+        raise BundleError('This instance was not loaded from a centre bundle.')
+    with open(state_file) as f:
+        state = json.load(f)
+
+    rows = db.session.query(
+        ExamAttempt.id, ExamAttempt.sync_key, User.email, ExamAttempt.exam_id, ExamAttempt.snapshot_digest,
+        ExamAttempt.start_time, ExamAttempt.end_time
+    ).join(User, ExamAttempt.user_id == User.id)\
+     .filter(ExamAttempt.end_time.isnot(None)).order_by(ExamAttempt.id).all()
+    answers = load_answers(row[0] for row in rows)
+    attempts = [
+        {'sync_key': sync_key, 'email': email, 'exam_id': exam_id, 'snapshot_digest': snapshot_digest,
+         'start_time': _iso(start_time), 'end_time': _iso(end_time), 'answers': answers[attempt_id]}
+        for attempt_id, sync_key, email, exam_id, snapshot_digest, start_time, end_time in rows
+    ]
+    return _write_bundle(path, RESULTS_BUNDLE, {'attempts.json': _dumps(attempts)}, {
+        'bundle_id': state['bundle_id'],
+        'school_id': state['school_id'],
+        'exam_ids': state['exam_ids'],
+        'grant': state['grant'],
+        'school_name': state['school_name'],
+        'counts': {'attempts': len(attempts)},
+    }, _bundle_key())
+
+
+def import_results(path, chunk_size=1000):
+    """
+    Merges a results bundle into the central database. Attempts whose
+    sync_key is already present are skipped, so re-importing is harmless.
+    Only candidates of the bundle's centre, sitting exams its bundle was
+    issued with, are imported. Returns (imported, already present, skipped
+    for a candidate not of that centre, skipped for an exam not in its
+    bundle or closed since).
+    """
+    archive, manifest = _open_bundle(path, RESULTS_BUNDLE, _central_key)
+    school_id, granted = manifest['school_id'], manifest.get('exam_ids') or []
+    if not hmac.compare_digest(manifest.get('grant') or '', _grant(manifest['bundle_id'], school_id, granted)):
+        raise BundleError('These results do not come from an exam bundle issued by this server.')
+    attempts = json.loads(archive.read('attempts.json'))
+
+    user_ids = {}
+    for start in range(0, len(attempts), chunk_size):
+        emails = {a['email'] for a in attempts[start:start + chunk_size]}
+        user_ids.update(db.session.query(User.email, User.id).filter(
+            User.email.in_(emails), User.school_id == school_id))
+    # Exams being deleted or archived take no new attempts
+    exam_ids = {exam_id for (exam_id,) in db.session.query(Exam.id).filter(
+        Exam.id.in_({a['exam_id'] for a in attempts} & set(granted)), Exam.status == EXAM_ACTIVE)}
+    # Each attempt keeps the paper it sat; answers to questions not on it are dropped
+    exam_digests = dict(db.session.query(Exam.id, Exam.snapshot_digest).filter(Exam.id.in_(exam_ids)))
+    known_digests = {digest for (digest,) in db.session.query(ExamSnapshot.digest).filter(
+        ExamSnapshot.digest.in_({a.get('snapshot_digest') for a in attempts} - {None}))}
+    on_papers = {}
+
+    def paper_of(attempt):
+        digest = attempt.get('snapshot_digest')
+        if digest not in known_digests:
+            digest = exam_digests[attempt['exam_id']]
+        if digest not in on_papers:
+            on_papers[digest] = {str(q.id) for q in load_paper(digest) or []} if digest else set()
+        return digest, on_papers[digest]
+
+    imported = present = unknown = closed = 0
+    for start in range(0, len(attempts), chunk_size):
+        chunk = attempts[start:start + chunk_size]
+        keys = [a['sync_key'] for a in chunk]
+        existing = {key for model in (ExamAttempt, ArchivedAttempt)
+                    for (key,) in db.session.query(model.sync_key).filter(model.sync_key.in_(keys))}
+        rows, answers = [], {}
+        for attempt in chunk:
+            if attempt['sync_key'] in existing:
+                present += 1
+            elif attempt['email'] not in user_ids:
+                unknown += 1
+            elif attempt['exam_id'] not in exam_ids:
+                closed += 1
+            else:
+                digest, on_paper = paper_of(attempt)
+                rows.append({
+                    'sync_key': attempt['sync_key'],
+                    'user_id': user_ids[attempt['email']],
+                    'exam_id': attempt['exam_id'],
+                    'snapshot_digest': digest,
+                    'start_time': _parse(attempt['start_time']),
+                    'end_time': _parse(attempt['end_time']),
+                })
+                answers[attempt['sync_key']] = {
+                    question_id: answer for question_id, answer in (attempt['answers'] or {}).items()
+                    if question_id in on_paper
+                }
+        if rows:
+            db.session.execute(ExamAttempt.__table__.insert(), rows)
+            new_ids = []
+            answer_inserts = []
+            for attempt_id, sync_key in db.session.query(ExamAttempt.id, ExamAttempt.sync_key).filter(
+                    ExamAttempt.sync_key.in_([row['sync_key'] for row in rows])):
+                new_ids.append(attempt_id)
+                answer_inserts += answer_rows(attempt_id, answers[sync_key])
+            if answer_inserts:
+                db.session.execute(AttemptAnswer.__table__.insert(), answer_inserts)
+            # Answer keys were withheld at the centre, so score against the central keys now
+            recompute_scores(new_ids)
+        db.session.commit()
+        imported += len(rows)
+    return imported, present, unknown, closed
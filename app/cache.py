@@ -0,0 +1,353 @@
+"""
+A cache shared by every worker on the machine, with no external services.
+
+The default store is a SQLite file in the instance folder (CACHE_BACKEND
+'sqlite'): entries carry a TTL, are evicted least recently used once the
+store passes CACHE_MAX_ENTRIES or CACHE_MAX_BYTES, and a lock table lets
+one worker compute a missing value while the others wait for it. A small
+per-process LRU (CACHE_L1_SIZE entries, CACHE_L1_TTL seconds) sits in front
+so hot keys are served without touching the file. 'memory' keeps a single
+per-process tier for development; 'null' turns caching off.
+
+Counters live alongside the entries and are never evicted; they are used
+as data version numbers. Hit and miss counts are kept per process and
+flushed to the store, so `flask cache stats` sees every worker.
+"""
+import atexit
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+
+MISSING = object()
+
+DEFAULT_TTL = 300
+LOCK_TIMEOUT = 30
+STATS_FLUSH_INTERVAL = 10
+
+
+class MemoryBackend:
+    """A per-process LRU store."""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            if entry[1] < time.time():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def counters(self, keys):
+        with self._lock:
+            return [self._counters.get(key, 0) for key in keys]
+
+    def incr(self, amounts):
+        with self._lock:
+            for key, amount in amounts.items():
+                self._counters[key] = self._counters.get(key, 0) + amount
+
+    def acquire(self, key, timeout):
+        with self._lock:
+            if self._locks.get(key, 0) > time.time():
+                return False
+            self._locks[key] = time.time() + timeout
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._locks.pop(key, None)
+
+    def info(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': None}
+
+
+class NullBackend(MemoryBackend):
+    """Stores nothing; every lookup is a miss."""
+
+    def get(self, key):
+        return MISSING
+
+    def set(self, key, value, ttl):
+        pass
+
+
+class SQLiteBackend:
+    """A SQLite file shared by all worker processes on the machine."""
+
+    # Last-access times are only rewritten when older than this, so that
+    # reads rarely need the write lock
+    ACCESS_RESOLUTION = 10
+    # Size limits are enforced every this many writes per process
+    CULL_EVERY = 20
+
+    def __init__(self, path, max_entries=10000, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._writes = 0
+
+    def _connection(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS entry (key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                         'size INTEGER NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_entry_accessed ON entry (accessed)')
+            conn.execute('CREATE TABLE IF NOT EXISTS counter (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS lock (key TEXT PRIMARY KEY, expires REAL NOT NULL)')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        conn = self._connection()
+        now = time.time()
+        row = conn.execute('SELECT value, expires, accessed FROM entry WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < now:
+            return MISSING
+        if row[2] < now - self.ACCESS_RESOLUTION:
+            conn.execute('UPDATE entry SET accessed = ? WHERE key = ?', (now, key))
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def set(self, key, value, ttl):
+        blob = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        now = time.time()
+        conn = self._connection()
+        conn.execute('INSERT OR REPLACE INTO entry (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)',
+                     (key, blob, len(blob), now + ttl, now))
+        self._writes += 1
+        if self._writes % self.CULL_EVERY == 0:
+            self.cull()
+
+    def cull(self):
+        """Drops expired entries, then least recently used ones until within the limits."""
+        conn = self._connection()
+        conn.execute('DELETE FROM entry WHERE expires < ?', (time.time(),))
+        count, size = conn.execute('SELECT count(*), coalesce(sum(size), 0) FROM entry').fetchone()
+        excess_entries = count - self.max_entries
+        excess_bytes = size - self.max_bytes
+        if excess_entries <= 0 and excess_bytes <= 0:
+            return
+        doomed = []
+        for key, entry_size in conn.execute('SELECT key, size FROM entry ORDER BY accessed'):
+            if excess_entries <= 0 and excess_bytes <= 0:
+                break
+            doomed.append((key,))
+            excess_entries -= 1
+            excess_bytes -= entry_size
+        conn.executemany('DELETE FROM entry WHERE key = ?', doomed)
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM entry WHERE key = ?', (key,))
+
+    def clear(self):
+        self._connection().execute('DELETE FROM entry')
+
+    def counters(self, keys):
+        if not keys:
+            return []
+        rows = dict(self._connection().execute(
+            f"SELECT key, value FROM counter WHERE key IN ({','.join('?' * len(keys))})", keys))
+        return [rows.get(key, 0) for key in keys]
+
+    def incr(self, amounts):
+        self._connection().executemany(
+            'INSERT INTO counter (key, value) VALUES (?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = value + excluded.value', list(amounts.items()))
+
+    def acquire(self, key, timeout):
+        now = time.time()
+        cursor = self._connection().execute(
+            'INSERT INTO lock (key, expires) VALUES (?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET expires = excluded.expires WHERE lock.expires < ?',
+            (key, now + timeout, now))
+        return cursor.rowcount == 1
+
+    def release(self, key):
+        self._connection().execute('DELETE FROM lock WHERE key = ?', (key,))
+
+    def info(self):
+        count, size = self._connection().execute(
+            'SELECT count(*), coalesce(sum(size), 0) FROM entry WHERE expires >= ?', (time.time(),)).fetchone()
+        return {'entries': count, 'bytes': size}
+
+
+class Cache:
+    """
+    Two-tier cache. Values must be picklable. Use get_or_set() for anything
+    expensive to build: only one caller on the machine computes a missing
+    key while the others wait for its result.
+    """
+
+    STAT_NAMES = ('l1_hits', 'hits', 'misses', 'computes', 'waits')
+
+    def __init__(self):
+        self.backend = NullBackend()
+        self.l1 = None
+        self.l1_ttl = 0
+        self.default_ttl = DEFAULT_TTL
+        self._key_locks = [threading.Lock() for _ in range(64)]
+        self._stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._stats_flushed = time.monotonic()
+        self._stats_pid = os.getpid()
+        atexit.register(self._flush_stats)
+
+    def init_app(self, app):
+        kind = app.config.get('CACHE_BACKEND', 'sqlite')
+        max_entries = int(app.config.get('CACHE_MAX_ENTRIES', 10000))
+        self.l1 = None
+        if kind == 'sqlite':
+            self.backend = SQLiteBackend(
+                app.config.get('CACHE_PATH') or os.path.join(app.instance_path, 'cache.sqlite3'),
+                max_entries=max_entries,
+                max_bytes=int(app.config.get('CACHE_MAX_BYTES', 64 * 1024 * 1024)))
+            l1_size = int(app.config.get('CACHE_L1_SIZE', 256))
+            self.l1 = MemoryBackend(max_entries=l1_size) if l1_size else None
+            self.l1_ttl = int(app.config.get('CACHE_L1_TTL', 10))
+        elif kind == 'memory':
+            self.backend = MemoryBackend(max_entries=max_entries)
+        elif kind == 'null':
+            self.backend = NullBackend()
+        else:
+            raise ValueError(f'Unknown CACHE_BACKEND {kind!r}')
+        self.default_ttl = int(app.config.get('CACHE_DEFAULT_TTL', DEFAULT_TTL))
+        app.extensions['cache'] = self
+
+    def _record(self, name):
+        with self._stats_lock:
+            if self._stats_pid != os.getpid():
+                # Forked worker: the parent reports its own counts
+                self._stats, self._stats_pid = Counter(), os.getpid()
+            self._stats[name] += 1
+            if time.monotonic() - self._stats_flushed < STATS_FLUSH_INTERVAL:
+                return
+        self._flush_stats()
+
+    def _flush_stats(self):
+        with self._stats_lock:
+            if self._stats_pid != os.getpid():
+                self._stats, self._stats_pid = Counter(), os.getpid()
+            pending, self._stats = self._stats, Counter()
+            self._stats_flushed = time.monotonic()
+        if pending:
+            self.backend.incr({f'stats:{name}': count for name, count in pending.items()})
+
+    def get(self, key, default=None):
+        if self.l1 is not None:
+            value = self.l1.get(key)
+            if value is not MISSING:
+                self._record('l1_hits')
+                return value
+        value = self.backend.get(key)
+        if value is MISSING:
+            self._record('misses')
+            return default
+        self._record('hits')
+        if self.l1 is not None:
+            self.l1.set(key, value, self.l1_ttl)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        self.backend.set(key, value, ttl)
+        if self.l1 is not None:
+            self.l1.set(key, value, min(ttl, self.l1_ttl))
+
+    def delete(self, key):
+        """Removes a key. Other processes may serve it from their L1 for up to CACHE_L1_TTL seconds."""
+        self.backend.delete(key)
+        if self.l1 is not None:
+            self.l1.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+        if self.l1 is not None:
+            self.l1.clear()
+
+    def get_or_set(self, key, compute, ttl=None):
+        """Returns the cached value for key, calling compute() to fill it on a miss."""
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            return value
+        # One thread per process, and one process per machine, computes the value
+        with self._key_locks[hash(key) % len(self._key_locks)]:
+            value = self.get(key, MISSING)
+            if value is not MISSING:
+                return value
+            lock_key = 'lock:' + key
+            acquired = self.backend.acquire(lock_key, LOCK_TIMEOUT)
+            if not acquired:
+                value = self._wait_for(key)
+                if value is not MISSING:
+                    return value
+            # Gave up waiting: compute anyway, but the lock is still the other process's
+            try:
+                self._record('computes')
+                value = compute()
+                self.set(key, value, ttl)
+            finally:
+                if acquired:
+                    self.backend.release(lock_key)
+        return value
+
+    def _wait_for(self, key):
+        self._record('waits')
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        delay = 0.01
+        while time.monotonic() < deadline:
+            time.sleep(delay)
+            value = self.backend.get(key)
+            if value is not MISSING:
+                return value
+            delay = min(delay * 2, 0.2)
+        return MISSING
+
+    def counters(self, keys):
+        """Current values of the given counters; unknown counters are 0."""
+        return self.backend.counters(list(keys))
+
+    def incr(self, *keys):
+        self.backend.incr(Counter(keys))
+
+    def stats(self):
+        """Hit and miss totals across every process, plus the store's size."""
+        self._flush_stats()
+        totals = dict(zip(self.STAT_NAMES, self.backend.counters([f'stats:{name}' for name in self.STAT_NAMES])))
+        lookups = totals['l1_hits'] + totals['hits'] + totals['misses']
+        totals['hit_rate'] = round((totals['l1_hits'] + totals['hits']) / lookups, 3) if lookups else None
+        totals.update(self.backend.info())
+        return totals
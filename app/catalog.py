@@ -0,0 +1,52 @@
+"""
+The question bank catalog: subjects and topics with their question counts.
+
+Built with one GROUP BY and kept in the shared cache under the catalog's
+data version. Inserting, deleting or re-filing a question bumps the version
+when the transaction commits, so every worker sees the change on its next
+lookup.
+"""
+from app.extensions import db, cache
+from app.fragments import touch, versions
+from app.models import Question
+
+CATALOG_TTL = 300
+CATALOG_SCOPE = 'catalog'
+
+
+def _build():
+    subjects = {}
+    for subject, topic, count in db.session.query(
+        Question.subject, Question.topic, db.func.count(Question.id)
+    ).group_by(Question.subject, Question.topic).order_by(Question.subject, Question.topic):
+        entry = subjects.setdefault(subject, {'subject': subject, 'count': 0, 'topics': []})
+        entry['count'] += count
+        if topic:
+            entry['topics'].append({'topic': topic, 'count': count})
+    return list(subjects.values())
+
+
+def subject_catalog():
+    """[{'subject', 'count', 'topics': [{'topic', 'count'}, ...]}, ...] sorted by subject."""
+    return cache.get_or_set(f'catalog:{versions([CATALOG_SCOPE])}', _build, CATALOG_TTL)
+
+
+def subjects():
+    return [entry['subject'] for entry in subject_catalog()]
+
+
+def invalidate_catalog():
+    touch(CATALOG_SCOPE)
+
+
+@db.event.listens_for(Question, 'after_insert')
+@db.event.listens_for(Question, 'after_delete')
+def _question_added_or_removed(mapper, connection, target):
+    invalidate_catalog()
+
+
+@db.event.listens_for(Question, 'after_update')
+def _question_refiled(mapper, connection, target):
+    state = db.inspect(target)
+    if state.attrs.subject.history.has_changes() or state.attrs.topic.history.has_changes():
+        invalidate_catalog()
@@ -1,5 +1,5 @@
 import click
-from flask.cli import with_appcontext
+from flask.cli import with_appcontext, AppGroup
 from app.extensions import db
 from app.models import User, UserRole, School
 
@@ -39,4 +39,312 @@ def register_commands(app):
             print(f"Failed to create admin user. Error: {e}")
             print("NOTE: This may be due to the sandbox environment's database limitations.")
 
-    app.cli.add_command(create_admin)
\ No newline at end of file
+    app.cli.add_command(create_admin)
+
+    @app.cli.command("detect-similar-answers")
+    @click.option("--exam-id", type=int, help="Only scan answers submitted for this exam.")
+    @click.option("--question-id", "question_ids", type=int, multiple=True, help="Only scan these questions.")
+    @click.option("--threshold", type=float, default=None, help="Minimum estimated similarity to flag (0-1).")
+    @click.option("--workers", type=int, default=None, help="Worker processes (defaults to the CPU count).")
+    def detect_similar_answers_command(exam_id, question_ids, threshold, workers):
+        """Flags near-duplicate essay and short answer responses."""
+        from app.similarity import detect_similar_answers, DEFAULT_THRESHOLD
+        questions, hashed, flagged = detect_similar_answers(
+            question_ids=question_ids, exam_id=exam_id,
+            threshold=threshold if threshold is not None else DEFAULT_THRESHOLD, workers=workers)
+        print(f"Scanned {questions} questions, hashed {hashed} new answers, flagged {flagged} pairs.")
+
+    @app.cli.command("export-results")
+    @click.option("--exam-id", type=int, help="Export attempts for this exam.")
+    @click.option("--school-id", type=int, help="Export attempts by candidates of this centre.")
+    @click.option("--output", "-o", type=click.Path(dir_okay=False), help="Output file (defaults to stdout).")
+    @click.option("--gzip", "compress", is_flag=True, help="Gzip-compress the CSV.")
+    def export_results_command(exam_id, school_id, output, compress):
+        """Streams exam results as CSV, per exam and/or per centre."""
+        from app.export import export_csv, gzip_stream
+        if exam_id is None and school_id is None:
+            raise click.UsageError("Give --exam-id, --school-id or both.")
+        chunks = export_csv(exam_id=exam_id, school_id=school_id)
+        if compress:
+            stream = click.open_file(output or '-', 'wb')
+            chunks = gzip_stream(chunks)
+        else:
+            stream = click.open_file(output or '-', 'w', encoding='utf-8')
+        with stream:
+            for chunk in chunks:
+                stream.write(chunk)
+
+    @app.cli.command("calibrate-items")
+    @click.option("--subject", "subjects", multiple=True, help="Subjects to calibrate (defaults to all).")
+    @click.option("--min-responses", type=int, default=20, help="Skip questions with fewer responses.")
+    @click.option("--iterations", type=int, default=50)
+    def calibrate_items_command(subjects, min_responses, iterations):
+        """Fits IRT parameters for adaptive practice from past attempts."""
+        from app.adaptive import calibrate
+        from app.models import Question
+        if not subjects:
+            subjects = [s[0] for s in db.session.query(Question.subject).distinct().all()]
+        for subject in subjects:
+            items, students = calibrate(subject, min_responses=min_responses, iterations=iterations)
+            print(f"{subject}: calibrated {items} questions and {students} student abilities.")
+
+    @app.cli.command("regrade-exams")
+    @click.option("--exam-id", "exam_ids", type=int, multiple=True, help="Only check these exams.")
+    def regrade_exams_command(exam_ids):
+        """Re-pins exams whose questions changed and rescores the affected attempts."""
+        from app.grading import regrade_exam, stale_exams
+        from app.models import Exam
+        for exam_id in stale_exams(exam_ids):
+            moved, rescored = regrade_exam(db.session.get(Exam, exam_id))
+            db.session.commit()
+            print(f"Exam {exam_id}: moved {moved} attempts to the new paper, rescored {rescored}.")
+
+    @app.cli.command("pin-exams")
+    def pin_exams_command():
+        """Pins a question paper for every exam created before snapshots existed; run once at deploy."""
+        from app.snapshots import pin_unpinned_exams
+        print(f"Pinned {pin_unpinned_exams()} exams.")
+
+    @app.cli.command("move-uploads")
+    def move_uploads_command():
+        """Moves uploaded files out of the public static folder into the upload folder; run once at deploy."""
+        import os
+        from app.uploads import take_in_files, static_upload_folder
+        if not os.path.isdir(static_upload_folder()):
+            print("No uploads in the static folder.")
+            return
+        # New links are built with url_for
+        with app.test_request_context():
+            moved, taken_in = take_in_files(static_upload_folder())
+            db.session.commit()
+        print(f"Moved {moved} stored files and took in {taken_in} older resource files.")
+
+    @app.cli.command("prune-uploads")
+    @click.option("--hours", type=int, default=24,
+                  help="Remove unfinished uploads, and files no resource uses, older than this.")
+    def prune_uploads_command(hours):
+        """Removes abandoned chunked uploads and uploaded files no resource uses."""
+        from datetime import timedelta
+        from app.uploads import prune_uploads
+        uploads, files = prune_uploads(timedelta(hours=hours))
+        db.session.commit()
+        print(f"Removed {uploads} unfinished uploads and {files} unused files.")
+
+    @app.cli.command("archive-exams")
+    @click.option("--older-than-days", "days", type=int, default=365,
+                  help="Archive exams created, and last sat, before this many days ago.")
+    def archive_exams_command(days):
+        """Queues a job moving old exams' attempts into the archive table."""
+        from datetime import datetime, timedelta
+        from app.jobs import enqueue
+        before = datetime.utcnow() - timedelta(days=days)
+        job = enqueue('archive-exams', {'before': before.isoformat()})
+        db.session.commit()
+        print(f"Queued archive job {job.id} for exams last sat before {before:%Y-%m-%d}; run `flask jobs work`.")
+
+    @app.cli.command("recommend-resources")
+    def recommend_resources_command():
+        """Queues the job that ranks resources for every student from their weak topics; run it nightly."""
+        from app.recommendations import start_recommendations
+        job = start_recommendations()
+        if job is None:
+            print("A recommendation job is already queued or running.")
+            return
+        db.session.commit()
+        print(f"Queued recommendation job {job.id}; run `flask jobs work`.")
+
+    jobs = AppGroup("jobs", help="Background jobs.")
+
+    @jobs.command("work")
+    @click.option("--processes", type=int, default=1, help="Worker processes to start.")
+    @click.option("--once", is_flag=True, help="Exit when the queue is empty.")
+    def work_command(processes, once):
+        """Processes queued background jobs."""
+        from app.jobs import work
+        if processes <= 1:
+            print(f"Processed {work(once=once)} jobs.")
+            return
+        import multiprocessing
+        workers = [multiprocessing.Process(target=_work_in_process, args=(once,)) for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    @jobs.command("list")
+    @click.option("--status", help="Only show jobs with this status.")
+    @click.option("--limit", type=int, default=20)
+    def list_jobs_command(status, limit):
+        """Shows recent jobs and their progress."""
+        from app.models import Job
+        query = Job.query.order_by(Job.id.desc())
+        if status:
+            query = query.filter_by(status=status)
+        for job in query.limit(limit):
+            total = job.total if job.total is not None else '?'
+            print(f"{job.id:>6}  {job.kind:<20} {job.status:<8} {job.progress}/{total}")
+
+    @jobs.command("retry")
+    @click.argument("job_id", type=int)
+    def retry_job_command(job_id):
+        """Requeues a failed job; it resumes from its last completed chunk."""
+        from app.jobs import retry
+        if not retry(job_id):
+            raise click.ClickException(f"Job {job_id} is not a failed job.")
+        db.session.commit()
+        print(f"Job {job_id} requeued.")
+
+    app.cli.add_command(jobs)
+
+    cache_group = AppGroup("cache", help="The shared cache.")
+
+    @cache_group.command("stats")
+    def cache_stats_command():
+        """Shows hit and miss counts across all workers and the store's size."""
+        from app.extensions import cache
+        for name, value in cache.stats().items():
+            print(f"{name:<10} {value if value is not None else '-'}")
+
+    @cache_group.command("clear")
+    def cache_clear_command():
+        """Drops every cached entry; data versions and statistics are kept."""
+        from app.extensions import cache
+        cache.clear()
+        print("Cache cleared.")
+
+    app.cli.add_command(cache_group)
+
+    assets = AppGroup("assets", help="Fingerprinted, precompressed static files.")
+
+    @assets.command("build")
+    @click.option("--clean", is_flag=True, help="Remove files left from earlier builds.")
+    def build_assets_command(clean):
+        """Writes hashed copies of the static files and their compressed variants."""
+        from flask import current_app
+        from app.assets import build_assets
+        manifest = build_assets(current_app.static_folder, clean=clean)
+        print(f"Built {len(manifest)} static files; restart the web workers to serve them.")
+
+    app.cli.add_command(assets)
+
+    templates = AppGroup("templates", help="Compiled Jinja templates.")
+
+    @templates.command("compile")
+    @click.option("--clean", is_flag=True, help="Drop the cached bytecode first, so every template is compiled again.")
+    def compile_templates_command(clean):
+        """Compiles every template into the shared bytecode cache."""
+        from flask import current_app
+        from jinja2 import TemplateSyntaxError
+        from app.templating import compile_templates
+        if current_app.jinja_env.bytecode_cache is None:
+            raise click.ClickException("TEMPLATE_CACHE is 'none'; there is no cache to compile into.")
+        try:
+            timings = compile_templates(current_app, clean=clean)
+        except TemplateSyntaxError as e:
+            raise click.ClickException(f"{e.name or e.filename}, line {e.lineno}: {e.message}")
+        print(f"Compiled {len(timings)} templates in {sum(timings.values()) * 1000:.0f} ms.")
+
+    app.cli.add_command(templates)
+
+    analytics = AppGroup("analytics", help="Score totals and distributions behind teacher analytics.")
+
+    @analytics.command("rebuild")
+    def rebuild_analytics_command():
+        """Recomputes the per-subject score totals and score histograms from attempt scores."""
+        from app.grading import rebuild_subject_aggregates, rebuild_score_histograms
+        rebuild_subject_aggregates()
+        rebuild_score_histograms()
+        db.session.commit()
+        print("Rebuilt subject totals and score histograms.")
+
+    app.cli.add_command(analytics)
+
+    leaderboards = AppGroup("leaderboards", help="Centre and national leaderboards.")
+
+    @leaderboards.command("rebuild")
+    def rebuild_leaderboards_command():
+        """Recomputes every exam and subject leaderboard from attempt scores."""
+        from app.leaderboards import rebuild_leaderboards
+        from app.models import LeaderboardEntry
+        nodes = rebuild_leaderboards()
+        db.session.commit()
+        print(f"Rebuilt leaderboards: {LeaderboardEntry.query.count()} entries, {nodes} rank tree nodes.")
+
+    app.cli.add_command(leaderboards)
+
+    centre_bundle = AppGroup("centre-bundle", help="Offline exam centre bundles.")
+
+    @centre_bundle.command("key")
+    @click.option("--school-id", type=int, required=True, help="Centre to print the key for.")
+    def centre_key_command(school_id):
+        """Prints the CENTRE_BUNDLE_KEY to set on one centre's local instance."""
+        from app.bundle import centre_key, BundleError
+        try:
+            print(centre_key(school_id))
+        except BundleError as e:
+            raise click.ClickException(str(e))
+
+    @centre_bundle.command("export")
+    @click.option("--school-id", type=int, required=True, help="Centre to package.")
+    @click.option("--exam-id", "exam_ids", type=int, multiple=True,
+                  help="Extra exams to include besides those set by the centre's teachers.")
+    @click.option("--output", "-o", type=click.Path(dir_okay=False), required=True)
+    def export_bundle_command(school_id, exam_ids, output):
+        """Packages a centre's exams, candidates and resources."""
+        from app.bundle import export_bundle, BundleError
+        try:
+            manifest = export_bundle(school_id, output, exam_ids=exam_ids)
+        except BundleError as e:
+            raise click.ClickException(str(e))
+        counts = ", ".join(f"{count} {name}" for name, count in manifest["counts"].items())
+        print(f"Wrote bundle {manifest['bundle_id']} for {manifest['school_name']} to {output} ({counts}).")
+
+    @centre_bundle.command("load")
+    @click.argument("bundle", type=click.Path(exists=True, dir_okay=False))
+    def load_bundle_command(bundle):
+        """Sets up a fresh local instance from an exam bundle."""
+        from app.bundle import load_bundle, BundleError
+        try:
+            # Links to resource files are built with url_for
+            with app.test_request_context():
+                manifest = load_bundle(bundle)
+        except BundleError as e:
+            raise click.ClickException(str(e))
+        print(f"Loaded bundle {manifest['bundle_id']} for {manifest['school_name']}.")
+
+    @centre_bundle.command("export-results")
+    @click.option("--output", "-o", type=click.Path(dir_okay=False), required=True)
+    def export_results_command(output):
+        """Packages this local instance's submitted attempts for the central server."""
+        from app.bundle import export_results, BundleError
+        try:
+            manifest = export_results(output)
+        except BundleError as e:
+            raise click.ClickException(str(e))
+        print(f"Wrote {manifest['counts']['attempts']} attempts to {output}.")
+
+    @centre_bundle.command("import-results")
+    @click.argument("bundle", type=click.Path(exists=True, dir_okay=False))
+    def import_results_command(bundle):
+        """Merges a centre's results bundle into this database."""
+        from app.bundle import import_results, BundleError
+        try:
+            imported, present, unknown, closed = import_results(bundle)
+        except BundleError as e:
+            raise click.ClickException(str(e))
+        print(f"Imported {imported} attempts ({present} already present).")
+        if unknown:
+            print(f"Skipped {unknown} attempts by candidates who are not registered at this centre.")
+        if closed:
+            print(f"Skipped {closed} attempts at exams that were not in the centre's bundle "
+                  f"or have been closed or removed since.")
+
+    app.cli.add_command(centre_bundle)
+
+
+def _work_in_process(once):
+    # Each worker process needs its own app and database connections
+    from app import create_app
+    from app.jobs import work
+    with create_app().app_context():
+        work(once=once)
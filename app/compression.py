@@ -0,0 +1,74 @@
+"""
+Compressed responses.
+
+Exam centres often share one thin link, and the large pages (the exam
+interface, the question bank, past questions) are repetitive markup that
+shrinks to a fraction of its size. After each request a text response of at
+least COMPRESS_MIN_SIZE bytes is compressed with the best encoding the client
+accepts: brotli if the optional `brotli` package is installed, else gzip.
+
+Streamed responses (CSV exports compress themselves with ?gzip=1) and files
+sent from disk are left alone; static files are compressed ahead of time by
+`flask assets build` (see app.assets). Set COMPRESS_RESPONSES=false when a
+proxy in front already compresses.
+"""
+import gzip
+
+from flask import request, current_app
+
+try:
+    import brotli
+except ImportError:  # Optional; gzip is used without it
+    brotli = None
+
+COMPRESSIBLE = {
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript', 'application/javascript',
+    'application/json', 'application/xml', 'image/svg+xml',
+}
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+def available_encodings():
+    """Encodings this server can produce, most compact first."""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def accepted_encodings(accept_encodings=None):
+    """The available encodings the current client accepts, most compact first."""
+    accept_encodings = request.accept_encodings if accept_encodings is None else accept_encodings
+    return [encoding for encoding in available_encodings() if accept_encodings[encoding] > 0]
+
+
+def compress(data, encoding, level):
+    """Compresses bytes; `level` is the gzip level (1-9) or brotli quality (0-11)."""
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    # A fixed mtime keeps the output, and so the ETag of prebuilt files, stable
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _compress_response(response):
+    config = current_app.config
+    if (not config.get('COMPRESS_RESPONSES', True) or response.status_code != 200
+            or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE):
+        return response
+    response.vary.add('Accept-Encoding')
+    encodings = accepted_encodings()
+    if not encodings or response.content_length is None \
+            or response.content_length < config.get('COMPRESS_MIN_SIZE', 500):
+        return response
+
+    encoding = encodings[0]
+    level = config.get('COMPRESS_BROTLI_QUALITY', 5) if encoding == 'br' else config.get('COMPRESS_LEVEL', 6)
+    response.set_data(compress(response.get_data(), encoding, level))
+    response.headers['Content-Encoding'] = encoding
+    # The ETag describes the uncompressed body
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
+
+
+def init_compression(app):
+    app.after_request(_compress_response)
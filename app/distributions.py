@@ -0,0 +1,99 @@
+"""
+Score distributions for analytics.
+
+Scores are counted in 1-point bins (0-100, with 100 in a bin of its own)
+per exam and candidate centre, in score_histogram rows that are updated in
+place as attempts are scored. A histogram is a sketch that merges by adding
+bins, so the distribution of a subject, a centre or a teacher's whole set
+of exams is one GROUP BY over those rows; medians and percentiles come from
+the merged bins, accurate to within a point, without reading any attempts.
+
+grading.update_score_histograms() keeps the rows in step with
+ExamAttempt.score; increments are applied in the database, so concurrent
+workers add up correctly. `flask analytics rebuild` recomputes them.
+"""
+from app.extensions import db
+from app.models import Exam, ScoreHistogram
+
+BINS = 101
+NO_SCHOOL = 0  # Candidates who are not registered with a centre
+
+
+def score_bin(score):
+    return min(max(int(score), 0), BINS - 1)
+
+
+class ScoreSketch:
+    """Counts of scores per 1-point bin. Sketches add bin by bin."""
+
+    def __init__(self, counts=None):
+        self.counts = list(counts) if counts is not None else [0] * BINS
+
+    def add(self, score, amount=1):
+        self.counts[score_bin(score)] += amount
+
+    def __add__(self, other):
+        return ScoreSketch(a + b for a, b in zip(self.counts, other.counts))
+
+    def __iadd__(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        return self
+
+    @property
+    def total(self):
+        return sum(self.counts)
+
+    def mean(self):
+        """Mean score taking each bin at its midpoint, or None if empty."""
+        total = self.total
+        if not total:
+            return None
+        return sum(min(index + 0.5, BINS - 1) * count for index, count in enumerate(self.counts)) / total
+
+    def quantile(self, q):
+        """
+        The score below which a fraction q of the scores fall, interpolated
+        linearly within its bin, or None if the sketch is empty.
+        """
+        total = self.total
+        if not total:
+            return None
+        target = min(max(q, 0.0), 1.0) * total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= target:
+                width = 0 if index == BINS - 1 else 1
+                return round(index + width * (target - seen) / count, 1)
+            seen += count
+        return float(BINS - 1)
+
+    def summary(self):
+        """{'count', 'p10', 'median', 'p90'} for display."""
+        return {'count': self.total, 'p10': self.quantile(0.1), 'median': self.quantile(0.5),
+                'p90': self.quantile(0.9)}
+
+    def bands(self, width=10):
+        """[(label, count), ...] over `width`-point bands, 100 falling in the top band."""
+        bands = []
+        for start in range(0, BINS - 1, width):
+            end = min(start + width, BINS - 1)
+            count = sum(self.counts[start:end]) + (self.counts[BINS - 1] if end == BINS - 1 else 0)
+            bands.append((f'{start}-{end}', count))
+        return bands
+
+
+def merged_sketches(group_by, *criteria):
+    """
+    {key: ScoreSketch} for the histograms matching `criteria`, merged per
+    value of the `group_by` columns (ScoreHistogram or Exam columns). The key
+    is a tuple of those values; with no group_by everything merges under ().
+    """
+    sketches = {}
+    for *key, index, count in db.session.query(
+        *group_by, ScoreHistogram.bin, db.func.sum(ScoreHistogram.count)
+    ).join(Exam, Exam.id == ScoreHistogram.exam_id)\
+     .filter(*criteria)\
+     .group_by(*group_by, ScoreHistogram.bin):
+        sketches.setdefault(tuple(key), ScoreSketch()).counts[index] += int(count or 0)
+    return sketches
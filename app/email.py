@@ -1,11 +1,13 @@
-from flask_mail import Message
-from app.extensions import mail
 from flask import current_app
+from app.extensions import get_mail
 
 def send_email(to, subject, template):
     """
     A simple email sending utility.
     """
+    from flask_mail import Message
+    # Message falls back to the Mail extension's default sender, so set it up first
+    mail = get_mail()
     msg = Message(
         subject,
         recipients=[to],
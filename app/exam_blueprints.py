@@ -0,0 +1,195 @@
+"""
+Exam blueprints: building exams from a topic and difficulty spec.
+
+A blueprint lists how many questions to draw from each part of a
+subject's bank, e.g.
+
+    40 questions: 10 algebra easy, 20 geometry medium, 10 statistics
+
+Each line is a count, a topic (or "any") and optionally a difficulty;
+lines are separated by commas, semicolons or new lines, and the optional
+"<n> questions:" header is checked against their sum. Pools are read off
+the (subject, topic, difficulty) index. Questions the target cohort sat
+in recent exams go to the back of each pool, so they are only used when
+there are not enough fresh ones.
+
+Several parallel forms can be built at once: forms take consecutive,
+non-overlapping slices of each shuffled pool for as long as the pool
+lasts, and all their exam_questions links are written in one insert.
+"""
+import random
+import re
+from datetime import datetime, timedelta
+
+from app.extensions import db
+from app.models import Exam, ExamAttempt, Question, User, UserRole, exam_questions
+from app.snapshots import pin_exam
+
+MAX_FORMS = 50
+RECENT_DAYS = 90
+
+_HEADER = re.compile(r'^\s*(\d+)\s*(?:questions?)?\s*$', re.IGNORECASE)
+_LINE = re.compile(r'^(\d+)\s*(?:x\s+|of\s+)?(.*)$', re.IGNORECASE)
+
+
+class BlueprintError(ValueError):
+    """A blueprint that cannot be parsed or filled; the message is shown to the teacher."""
+
+
+class BlueprintLine:
+    def __init__(self, count, topic, difficulty):
+        self.count = count
+        self.topic = topic  # None for any topic
+        self.difficulty = difficulty  # None for any difficulty
+
+    def describe(self):
+        parts = [str(self.count), self.topic or 'any topic']
+        if self.difficulty:
+            parts.append(self.difficulty.lower())
+        return ' '.join(parts)
+
+
+def _bank_labels(subject):
+    """{lower-case label: label} for the subject's topics and difficulties, off the index."""
+    topics, difficulties = {}, {}
+    for topic, difficulty in db.session.query(Question.topic, Question.difficulty)\
+            .filter(Question.subject == subject).distinct():
+        if topic:
+            topics[topic.lower()] = topic
+        difficulties[difficulty.lower()] = difficulty
+    return topics, difficulties
+
+
+def parse_blueprint(spec, subject):
+    """Parses a blueprint for `subject` into BlueprintLines, matching topics and difficulties case-insensitively."""
+    total = None
+    body = spec or ''
+    if ':' in body:
+        head, rest = body.split(':', 1)
+        match = _HEADER.match(head)
+        if match:
+            total, body = int(match.group(1)), rest
+
+    topics, difficulties = _bank_labels(subject)
+    if not topics and not difficulties:
+        raise BlueprintError(f'There are no {subject} questions in the bank.')
+
+    lines = []
+    for item in re.split(r'[,;\n]', body):
+        item = item.strip().rstrip('.')
+        if not item:
+            continue
+        match = _LINE.match(item)
+        if not match or int(match.group(1)) <= 0:
+            raise BlueprintError(f'"{item}" should start with a number of questions, e.g. "10 algebra easy".')
+        words = match.group(2).split()
+        difficulty = None
+        if words and words[-1].lower() in difficulties:
+            difficulty = difficulties[words.pop().lower()]
+        name = ' '.join(words).strip()
+        if name.lower() in ('', 'any', 'any topic', 'questions'):
+            topic = None
+        elif name.lower() in topics:
+            topic = topics[name.lower()]
+        else:
+            raise BlueprintError(f'{subject} has no topic "{name}". Topics: {", ".join(sorted(topics.values()))}.')
+        lines.append(BlueprintLine(int(match.group(1)), topic, difficulty))
+
+    if not lines:
+        raise BlueprintError('The blueprint is empty.')
+    if total is not None and total != sum(line.count for line in lines):
+        raise BlueprintError(f'The lines add up to {sum(line.count for line in lines)} questions, not {total}.')
+    return lines
+
+
+def recently_seen(school_id=None, days=RECENT_DAYS):
+    """
+    Ids of questions on exams that students sat in the last `days` days,
+    only counting students of one centre when `school_id` is given.
+    """
+    attempted = db.session.query(ExamAttempt.exam_id)\
+        .join(User, User.id == ExamAttempt.user_id)\
+        .filter(ExamAttempt.start_time >= datetime.utcnow() - timedelta(days=days),
+                User.role == UserRole.STUDENT)
+    if school_id is not None:
+        attempted = attempted.filter(User.school_id == school_id)
+    return {question_id for (question_id,) in db.session.query(exam_questions.c.question_id)
+            .filter(exam_questions.c.exam_id.in_(attempted.distinct().scalar_subquery())).distinct()}
+
+
+def _pool(subject, line, seen, rng):
+    """Question ids for a line, shuffled, with recently seen ones last."""
+    query = db.session.query(Question.id).filter(Question.subject == subject)
+    if line.topic is not None:
+        query = query.filter(Question.topic == line.topic)
+    if line.difficulty is not None:
+        query = query.filter(Question.difficulty == line.difficulty)
+    ids = [question_id for (question_id,) in query]
+    fresh = [question_id for question_id in ids if question_id not in seen]
+    stale = [question_id for question_id in ids if question_id in seen]
+    rng.shuffle(fresh)
+    rng.shuffle(stale)
+    return fresh + stale
+
+
+def draw_forms(subject, lines, forms=1, seen=(), rng=None):
+    """
+    Picks question ids for `forms` parallel forms. Returns (forms, reused),
+    where forms is a list of id lists and reused counts picks of recently
+    seen questions. Forms share questions only once a pool runs out.
+    """
+    rng = rng or random.Random()
+    seen = set(seen)
+    picked = [[] for _ in range(forms)]
+    taken = [set() for _ in range(forms)]
+    reused = 0
+    for line in lines:
+        pool = _pool(subject, line, seen, rng)
+        if len(pool) < line.count:
+            raise BlueprintError(f'Only {len(pool)} questions match "{line.describe()}".')
+        position = 0
+        for form in range(forms):
+            wanted = line.count
+            for _ in range(len(pool)):
+                if not wanted:
+                    break
+                question_id = pool[position % len(pool)]
+                position += 1
+                # Lines can overlap ("10 algebra" and "5 any hard"), but a form never repeats a question
+                if question_id in taken[form]:
+                    continue
+                taken[form].add(question_id)
+                picked[form].append(question_id)
+                reused += question_id in seen
+                wanted -= 1
+            if wanted:
+                raise BlueprintError(f'Not enough distinct questions left for "{line.describe()}".')
+    return picked, reused
+
+
+def _form_label(index, forms):
+    if forms == 1:
+        return ''
+    return f' (Form {chr(ord("A") + index) if forms <= 26 else index + 1})'
+
+
+def build_exams(title, subject, duration_minutes, created_by, form_question_ids):
+    """
+    Creates one exam per form and pins its paper, linking every form's
+    questions in a single exam_questions insert. The caller commits.
+    """
+    questions = {q.id: q for q in Question.query.filter(
+        Question.id.in_({question_id for ids in form_question_ids for question_id in ids}))}
+    exams = []
+    for index, ids in enumerate(form_question_ids):
+        exam = Exam(title=title + _form_label(index, len(form_question_ids)), subject=subject,
+                    duration_minutes=duration_minutes, created_by=created_by)
+        db.session.add(exam)
+        pin_exam(exam, [questions[question_id] for question_id in ids])
+        exams.append(exam)
+    db.session.flush()
+    db.session.execute(exam_questions.insert(), [
+        {'exam_id': exam.id, 'question_id': question_id}
+        for exam, ids in zip(exams, form_question_ids) for question_id in ids
+    ])
+    return exams
@@ -0,0 +1,151 @@
+"""
+Streaming results export.
+
+Attempts are read through a server-side cursor in chunks; answers and
+grades are fetched one chunk at a time and every chunk is turned into CSV
+text and yielded before the next is read, so memory use does not grow with
+the number of candidates. Per-question scores come from the paper each
+attempt was pinned to, like its total.
+"""
+import csv
+import io
+import zlib
+
+from app.extensions import db
+from app.models import Exam, ExamAttempt, Grade, Question, School, User, exam_questions
+from app.grading import MANUAL_TYPES, is_correct
+from app.answers import load_answers
+from app.snapshots import load_paper, exam_paper
+
+CHUNK_SIZE = 1000
+# Spreadsheets run cells starting with these as formulas (names and titles are user-entered)
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _exam_questions(exam_id):
+    return Question.query.join(exam_questions, exam_questions.c.question_id == Question.id)\
+        .filter(exam_questions.c.exam_id == exam_id).order_by(Question.id).all()
+
+
+class _Papers:
+    """The questions each attempt sat, as in scoring: its pinned paper, else its exam's."""
+
+    def __init__(self):
+        self._exam_digests = {}
+        self._questions = {}
+
+    def questions(self, digest, exam_id):
+        if digest is None:
+            if exam_id not in self._exam_digests:
+                self._exam_digests[exam_id] = exam_paper(exam_id)[0]
+            digest = self._exam_digests[exam_id]
+        key = digest or exam_id
+        if key not in self._questions:
+            # Exams that were never pinned have only their live questions
+            paper = load_paper(digest) if digest else _exam_questions(exam_id)
+            self._questions[key] = sorted(paper or [], key=lambda question: question.id)
+        return self._questions[key]
+
+
+def _question_score(question, answers, grades):
+    if question.question_type in MANUAL_TYPES:
+        return grades.get(question.id)
+    return question.max_score if is_correct(question, answers.get(str(question.id))) else 0
+
+
+def export_rows(exam_id=None, school_id=None, chunk_size=CHUNK_SIZE):
+    """
+    Yields the header and then one list per submitted attempt, filtered by
+    exam and/or centre. With an exam, each question gets its own column;
+    otherwise per-question scores are packed into one "question_scores"
+    column as "<question id>:<score>" pairs, since exams differ in shape.
+    """
+    papers = _Papers()
+    per_exam_questions = None
+    if exam_id is not None:
+        # One column per question on any paper the exam's candidates sat
+        digests = {digest for (digest,) in db.session.query(ExamAttempt.snapshot_digest).filter(
+            ExamAttempt.exam_id == exam_id, ExamAttempt.end_time.isnot(None)).distinct()}
+        per_exam_questions = sorted({question.id for digest in digests or {None}
+                                     for question in papers.questions(digest, exam_id)})
+    header = ['attempt_id', 'candidate', 'email', 'centre', 'exam', 'subject', 'started', 'submitted']
+    if per_exam_questions is not None:
+        header += [f'q{question_id}' for question_id in per_exam_questions]
+    else:
+        header.append('question_scores')
+    header.append('total')
+    yield header
+
+    stmt = db.select(
+        ExamAttempt.id, ExamAttempt.exam_id, ExamAttempt.start_time, ExamAttempt.end_time,
+        ExamAttempt.score, ExamAttempt.snapshot_digest,
+        User.full_name, User.email, School.name, Exam.title, Exam.subject
+    ).join(User, ExamAttempt.user_id == User.id)\
+     .outerjoin(School, User.school_id == School.id)\
+     .join(Exam, ExamAttempt.exam_id == Exam.id)\
+     .where(ExamAttempt.end_time.isnot(None))\
+     .order_by(ExamAttempt.id)
+    if exam_id is not None:
+        stmt = stmt.where(ExamAttempt.exam_id == exam_id)
+    if school_id is not None:
+        stmt = stmt.where(User.school_id == school_id)
+
+    result = db.session.execute(stmt.execution_options(yield_per=chunk_size))
+    for chunk in result.partitions():
+        answers_by_attempt = load_answers([row.id for row in chunk])
+        grades = {}
+        for attempt_id, question_id, score in db.session.query(
+            Grade.attempt_id, Grade.question_id, Grade.score
+        ).filter(Grade.attempt_id.in_([row.id for row in chunk])):
+            grades.setdefault(attempt_id, {})[question_id] = score
+
+        for row in chunk:
+            answers = answers_by_attempt[row.id]
+            attempt_grades = grades.get(row.id, {})
+            line = [row.id, row.full_name, row.email, row.name or '', row.title, row.subject,
+                    row.start_time.isoformat(sep=' ', timespec='seconds'),
+                    row.end_time.isoformat(sep=' ', timespec='seconds')]
+            paper = papers.questions(row.snapshot_digest, row.exam_id)
+            if per_exam_questions is not None:
+                # Questions not on the paper this candidate sat are left blank
+                scores = {q.id: _question_score(q, answers, attempt_grades) for q in paper}
+                line += [scores.get(question_id) for question_id in per_exam_questions]
+            else:
+                line.append(';'.join(
+                    f'{q.id}:{score}' for q in paper
+                    for score in [_question_score(q, answers, attempt_grades)] if score is not None
+                ))
+            line.append(row.score)
+            yield line
+
+
+def _csv_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def export_csv(exam_id=None, school_id=None, chunk_size=CHUNK_SIZE):
+    """Yields the export as CSV text, one chunk of attempts at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for count, row in enumerate(export_rows(exam_id, school_id, chunk_size), start=1):
+        writer.writerow([_csv_cell(value) for value in row])
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gzip_stream(chunks):
+    """Gzip-compresses a stream of text chunks incrementally."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
@@ -1,10 +1,41 @@
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
-from flask_mail import Mail
+
+from app.cache import Cache
+from app.ratelimit import RateLimiter
+from app.invigilation import Invigilation
 
 db = SQLAlchemy()
-migrate = Migrate()
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
-mail = Mail()
\ No newline at end of file
+cache = Cache()
+limiter = RateLimiter()
+invigilation = Invigilation()
+
+
+def init_migrate(app):
+    """Flask-Migrate pulls in Alembic, which only the CLI needs."""
+    from flask_migrate import Migrate
+    Migrate(app, db)
+
+
+def dialect_insert():
+    """The database dialect's insert() supporting ON CONFLICT, or None if it has none."""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        insert = None
+    return insert
+
+
+def get_mail():
+    """Flask-Mail for the current app, set up the first time an email is sent."""
+    app = current_app._get_current_object()
+    if 'mail' not in app.extensions:
+        from flask_mail import Mail
+        Mail(app)
+    return app.extensions['mail']
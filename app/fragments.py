@@ -0,0 +1,82 @@
+"""
+Data versions and cached page fragments.
+
+Cached values that depend on changing data are keyed by the version number
+of each scope they read (a student's attempts, a teacher's exams, the exam
+list, the question catalog). Code that changes that data calls touch();
+the versions are bumped once the transaction commits, so the next lookup
+misses and rebuilds, and the stale entry simply ages out of the cache.
+
+Fragments are rendered HTML sections stored this way; a hit costs no SQL.
+"""
+import sqlite3
+
+from flask import current_app
+from markupsafe import Markup
+
+from app.extensions import db, cache
+from app.models import Exam
+
+FRAGMENT_TTL = 300
+
+# Bumped whenever exams are created, renamed or removed; every student
+# dashboard lists exams that are open to everyone
+EXAMS_SCOPE = 'exams'
+
+
+def user_scope(user_id):
+    return f'user:{user_id}'
+
+
+def teacher_scope(teacher_id):
+    return f'teacher:{teacher_id}'
+
+
+def versions(scopes):
+    """A key suffix for the current versions of `scopes`."""
+    return ':'.join(map(str, cache.counters(f'version:{scope}' for scope in scopes)))
+
+
+def touch(*scopes):
+    """Marks data behind these scopes as changed, effective when the session commits."""
+    db.session.info.setdefault('touched_scopes', set()).update(scopes)
+
+
+def touch_attempts(pairs):
+    """
+    Marks the students and exam owners behind some attempts as changed.
+    `pairs` is an iterable of (user_id, exam_id).
+    """
+    pairs = set(pairs)
+    if not pairs:
+        return
+    teacher_ids = db.session.query(Exam.created_by).filter(
+        Exam.id.in_({exam_id for _, exam_id in pairs})).distinct()
+    touch(*{user_scope(user_id) for user_id, _ in pairs},
+          *{teacher_scope(teacher_id) for (teacher_id,) in teacher_ids})
+
+
+def render_fragment(name, scopes, render, ttl=FRAGMENT_TTL):
+    """
+    Returns the fragment `name` for the current versions of `scopes`,
+    calling `render()` to build it on a miss.
+    """
+    html = cache.get_or_set(f'fragment:{name}:{versions(scopes)}', lambda: str(render()), ttl)
+    return Markup(html)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def _bump_touched_scopes(session):
+    scopes = session.info.pop('touched_scopes', None)
+    if not scopes:
+        return
+    # The data is already committed; a cache that can't be written must not fail the request
+    try:
+        cache.incr(*(f'version:{scope}' for scope in sorted(scopes)))
+    except sqlite3.Error:
+        current_app.logger.warning('Could not bump cache versions for %s', ', '.join(sorted(scopes)), exc_info=True)
+
+
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def _forget_touched_scopes(session, previous_transaction):
+    session.info.pop('touched_scopes', None)
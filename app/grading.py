@@ -0,0 +1,561 @@
+import numpy as np
+
+from app.extensions import db, dialect_insert
+from app.models import (QuestionType, Question, Exam, ExamAttempt, ArchivedAttempt, Grade, SubjectAggregate, ScoreHistogram,
+                        LeaderboardEntry, RankNode, User, exam_questions)
+from app.snapshots import pin_exam, load_paper, current_digests, scoring_changes
+from app.jobs import job_handler
+from app.fragments import touch_attempts
+from app.answers import load_answers
+from app.leaderboards import board_entries, add_to_trees
+from app.distributions import score_bin, NO_SCHOOL
+
+# Question types a teacher has to mark by hand in the grading interface
+MANUAL_TYPES = (QuestionType.ESSAY, QuestionType.SHORT_ANSWER)
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [str(v).strip() for v in value]
+    return [str(value).strip()]
+
+
+def is_correct(question, answer):
+    """
+    Compares a student's answer against the question's answer key.
+    MCQ answers are option indices (as strings), as sent by exam.js.
+    """
+    key = _as_list(question.answer)
+    given = _as_list(answer)
+    if not given:
+        return False
+    if question.question_type == QuestionType.MCQ_SINGLE:
+        return given[0] in key
+    if question.question_type == QuestionType.MCQ_MULTIPLE:
+        return set(given) == set(key)
+    return given[0].lower() in [k.lower() for k in key]
+
+
+def compute_score(questions, answers, grades=None):
+    """
+    Returns the attempt score as a percentage, or None while any manually
+    graded question is still waiting for a Grade.
+
+    `answers` is the attempt's answers dict ({str(question_id): answer}) and
+    `grades` maps question ids to the score a teacher awarded.
+    """
+    answers = answers or {}
+    grades = grades or {}
+    earned = 0.0
+    total = 0
+    for question in questions:
+        total += question.max_score
+        # Keys are withheld on offline centre instances; scoring happens centrally
+        if question.answer is None:
+            return None
+        if question.question_type in MANUAL_TYPES:
+            if question.id not in grades:
+                return None
+            earned += grades[question.id]
+        elif is_correct(question, answers.get(str(question.id))):
+            earned += question.max_score
+    if total == 0:
+        return 0.0
+    return round(earned * 100.0 / total, 2)
+
+
+def correct_mask(question, answers):
+    """Vectorised is_correct: a boolean array for a list of answers to one question."""
+    key = _as_list(question.answer)
+    given = [_as_list(answer) for answer in answers]
+    answered = np.fromiter((bool(g) for g in given), dtype=bool, count=len(given))
+    if question.question_type == QuestionType.MCQ_SINGLE:
+        values, accepted = [g[0] if g else '' for g in given], key
+    elif question.question_type == QuestionType.MCQ_MULTIPLE:
+        values = ['\x1f'.join(sorted(set(g))) for g in given]
+        accepted = ['\x1f'.join(sorted(set(key)))]
+    else:
+        values = [g[0].lower() if g else '' for g in given]
+        accepted = [k.lower() for k in key]
+    return answered & np.isin(np.asarray(values, dtype=str), np.asarray(accepted, dtype=str))
+
+
+def score_attempts(questions, answers_list, grades_list):
+    """
+    Vectorised compute_score for many attempts that sat the same questions:
+    one array comparison per question instead of one per answer. Returns a
+    list of scores in the same order, with None where compute_score would.
+    """
+    count = len(answers_list)
+    answers_list = [answers or {} for answers in answers_list]
+    grades_list = [grades or {} for grades in grades_list]
+    if any(question.answer is None for question in questions):
+        return [None] * count
+
+    total = 0
+    earned = np.zeros(count)
+    pending = np.zeros(count, dtype=bool)
+    for question in questions:
+        total += question.max_score
+        if question.question_type in MANUAL_TYPES:
+            awarded = np.array([grades.get(question.id, np.nan) for grades in grades_list], dtype=float)
+            pending |= np.isnan(awarded)
+            earned += np.nan_to_num(awarded)
+        else:
+            mask = correct_mask(question, [answers.get(str(question.id)) for answers in answers_list])
+            earned += mask * question.max_score
+    return [None if waiting else (round(float(points) * 100.0 / total, 2) if total else 0.0)
+            for points, waiting in zip(earned, pending)]
+
+
+def _chunks(values, size=500):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _upsert_grades(rows):
+    """Inserts or updates Grade rows in one statement per chunk, keyed on (attempt_id, question_id)."""
+    insert = dialect_insert()
+    if insert is not None:
+        for chunk in _chunks(rows):
+            stmt = insert(Grade.__table__).values(chunk)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['attempt_id', 'question_id'],
+                set_={
+                    'score': stmt.excluded.score,
+                    'comments': stmt.excluded.comments,
+                    'teacher_id': stmt.excluded.teacher_id,
+                }
+            )
+            db.session.execute(stmt)
+        return
+
+    # Other databases: split into updates and inserts with one lookup per chunk
+    for chunk in _chunks(rows):
+        attempt_ids = {row['attempt_id'] for row in chunk}
+        existing = {
+            (attempt_id, question_id): grade_id
+            for grade_id, attempt_id, question_id in db.session.query(
+                Grade.id, Grade.attempt_id, Grade.question_id
+            ).filter(Grade.attempt_id.in_(attempt_ids))
+        }
+        updates, inserts = [], []
+        for row in chunk:
+            grade_id = existing.get((row['attempt_id'], row['question_id']))
+            if grade_id is None:
+                inserts.append(row)
+            else:
+                updates.append(dict(row, id=grade_id))
+        db.session.bulk_update_mappings(Grade, updates)
+        db.session.bulk_insert_mappings(Grade, inserts)
+
+
+def update_subject_aggregates(changes):
+    """
+    Applies score changes to the per-subject totals. `changes` is a list of
+    (exam_id, old score, new score); None means the attempt is unscored.
+    """
+    deltas = {}
+    for exam_id, old, new in changes:
+        if old == new:
+            continue
+        delta = deltas.setdefault(exam_id, [0, 0.0])
+        if old is not None:
+            delta[0] -= 1
+            delta[1] -= old
+        if new is not None:
+            delta[0] += 1
+            delta[1] += new
+    if not deltas:
+        return
+
+    totals = {}
+    for chunk in _chunks(deltas):
+        for exam_id, teacher_id, subject in db.session.query(Exam.id, Exam.created_by, Exam.subject)\
+                .filter(Exam.id.in_(chunk)):
+            total = totals.setdefault((teacher_id, subject), [0, 0.0])
+            total[0] += deltas[exam_id][0]
+            total[1] += deltas[exam_id][1]
+    rows = [{'teacher_id': teacher_id, 'subject': subject, 'scored_attempts': count, 'score_sum': score_sum}
+            for (teacher_id, subject), (count, score_sum) in totals.items()]
+
+    insert = dialect_insert()
+    if insert is not None:
+        table = SubjectAggregate.__table__
+        for chunk in _chunks(rows):
+            stmt = insert(table).values(chunk)
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=['teacher_id', 'subject'],
+                set_={
+                    'scored_attempts': table.c.scored_attempts + stmt.excluded.scored_attempts,
+                    'score_sum': table.c.score_sum + stmt.excluded.score_sum,
+                }
+            ))
+        return
+
+    for row in rows:
+        aggregate = db.session.get(SubjectAggregate, (row['teacher_id'], row['subject']))
+        if aggregate is None:
+            db.session.add(SubjectAggregate(**row))
+        else:
+            aggregate.scored_attempts += row['scored_attempts']
+            aggregate.score_sum += row['score_sum']
+
+
+def rebuild_subject_aggregates():
+    """Recomputes the per-subject totals from scratch, archived attempts included; the caller commits."""
+    SubjectAggregate.query.delete(synchronize_session=False)
+    totals = {}
+    for model in (ExamAttempt, ArchivedAttempt):
+        for teacher_id, subject, count, score_sum in db.session.query(
+            Exam.created_by, Exam.subject, db.func.count(model.score), db.func.sum(model.score)
+        ).join(model, model.exam_id == Exam.id)\
+         .filter(model.score.isnot(None))\
+         .group_by(Exam.created_by, Exam.subject):
+            total = totals.setdefault((teacher_id, subject), [0, 0.0])
+            total[0] += count
+            total[1] += score_sum
+    db.session.bulk_insert_mappings(SubjectAggregate, [
+        {'teacher_id': teacher_id, 'subject': subject, 'scored_attempts': count, 'score_sum': score_sum}
+        for (teacher_id, subject), (count, score_sum) in totals.items()
+    ])
+
+
+def update_score_histograms(changes):
+    """
+    Applies score changes to the per-exam, per-centre score histograms.
+    `changes` is a list of (exam_id, school_id, old score, new score); None
+    means the attempt is unscored.
+    """
+    deltas = {}
+    for exam_id, school_id, old, new in changes:
+        if old == new:
+            continue
+        school_id = school_id or NO_SCHOOL
+        if old is not None:
+            key = (exam_id, school_id, score_bin(old))
+            deltas[key] = deltas.get(key, 0) - 1
+        if new is not None:
+            key = (exam_id, school_id, score_bin(new))
+            deltas[key] = deltas.get(key, 0) + 1
+    rows = [{'exam_id': exam_id, 'school_id': school_id, 'bin': index, 'count': count}
+            for (exam_id, school_id, index), count in deltas.items() if count]
+    if not rows:
+        return
+
+    insert = dialect_insert()
+    if insert is not None:
+        table = ScoreHistogram.__table__
+        for chunk in _chunks(rows):
+            stmt = insert(table).values(chunk)
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=['exam_id', 'school_id', 'bin'],
+                set_={'count': table.c.count + stmt.excluded.count}
+            ))
+        return
+
+    for row in rows:
+        histogram = db.session.get(ScoreHistogram, (row['exam_id'], row['school_id'], row['bin']))
+        if histogram is None:
+            db.session.add(ScoreHistogram(**row))
+        else:
+            histogram.count += row['count']
+
+
+def rebuild_score_histograms():
+    """Recomputes the score histograms from scratch, archived attempts included; the caller commits."""
+    ScoreHistogram.query.delete(synchronize_session=False)
+    counts = {}
+    # Grouping by exact score first keeps the rows read to distinct scores
+    for model in (ExamAttempt, ArchivedAttempt):
+        for exam_id, school_id, score, count in db.session.query(
+            model.exam_id, User.school_id, model.score, db.func.count(model.id)
+        ).join(User, User.id == model.user_id)\
+         .filter(model.score.isnot(None))\
+         .group_by(model.exam_id, User.school_id, model.score):
+            key = (exam_id, school_id or NO_SCHOOL, score_bin(score))
+            counts[key] = counts.get(key, 0) + count
+    db.session.bulk_insert_mappings(ScoreHistogram, [
+        {'exam_id': exam_id, 'school_id': school_id, 'bin': index, 'count': count}
+        for (exam_id, school_id, index), count in counts.items()
+    ])
+
+
+def update_leaderboards(attempt_ids, removed=False):
+    """
+    Brings the leaderboards in step with the given attempts' current scores,
+    or takes the attempts off them when `removed` (before they are deleted).
+    Only attempts whose entries changed touch the score trees.
+    """
+    for chunk in _chunks(set(attempt_ids)):
+        old, new = {}, {}
+        for board, attempt_id, user_id, school_id, score in db.session.query(
+            LeaderboardEntry.board, LeaderboardEntry.attempt_id, LeaderboardEntry.user_id,
+            LeaderboardEntry.school_id, LeaderboardEntry.score
+        ).filter(LeaderboardEntry.attempt_id.in_(chunk)):
+            old.setdefault(attempt_id, []).append({'board': board, 'attempt_id': attempt_id, 'user_id': user_id,
+                                                   'school_id': school_id, 'score': score})
+        if not removed:
+            for entry in board_entries(chunk):
+                new.setdefault(entry['attempt_id'], []).append(entry)
+
+        changed = [attempt_id for attempt_id in set(old) | set(new)
+                   if sorted(old.get(attempt_id, []), key=lambda e: e['board'])
+                   != sorted(new.get(attempt_id, []), key=lambda e: e['board'])]
+        if not changed:
+            continue
+        counts = {}
+        for attempt_id in changed:
+            for entry in old.get(attempt_id, []):
+                add_to_trees(counts, entry, -1)
+            for entry in new.get(attempt_id, []):
+                add_to_trees(counts, entry, 1)
+        LeaderboardEntry.query.filter(LeaderboardEntry.attempt_id.in_(changed)).delete(synchronize_session=False)
+        rows = [entry for attempt_id in changed for entry in new.get(attempt_id, [])]
+        if rows:
+            db.session.execute(LeaderboardEntry.__table__.insert(), rows)
+        _add_rank_counts([{'board': board, 'school_id': school_id, 'node': node, 'count': count}
+                          for (board, school_id, node), count in counts.items() if count])
+
+
+def _add_rank_counts(rows):
+    insert = dialect_insert()
+    if insert is not None:
+        table = RankNode.__table__
+        for chunk in _chunks(rows):
+            stmt = insert(table).values(chunk)
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=['board', 'school_id', 'node'],
+                set_={'count': table.c.count + stmt.excluded.count}
+            ))
+        return
+
+    for row in rows:
+        node = db.session.get(RankNode, (row['board'], row['school_id'], row['node']))
+        if node is None:
+            db.session.add(RankNode(**row))
+        else:
+            node.count += row['count']
+
+
+def recompute_scores(attempt_ids):
+    """
+    Recalculates ExamAttempt.score for the given attempts from their answers
+    and grades, using a fixed number of queries per chunk of attempts, and
+    keeps the per-subject totals, score histograms and leaderboards in step.
+    """
+    for chunk in _chunks(set(attempt_ids)):
+        attempts = db.session.query(
+            ExamAttempt.id, ExamAttempt.user_id, ExamAttempt.exam_id, ExamAttempt.snapshot_digest,
+            ExamAttempt.score, User.school_id
+        ).join(User, User.id == ExamAttempt.user_id).filter(ExamAttempt.id.in_(chunk)).all()
+        answers_by_attempt = load_answers(chunk)
+
+        # Attempts are scored against the paper they sat; older attempts
+        # without a pinned paper fall back to the exam's live questions.
+        papers = {digest: load_paper(digest) for digest in {a.snapshot_digest for a in attempts} if digest}
+        exam_ids = {attempt.exam_id for attempt in attempts if attempt.snapshot_digest is None}
+        questions_by_exam = {}
+        for exam_id, question in db.session.query(exam_questions.c.exam_id, Question)\
+                .join(Question, Question.id == exam_questions.c.question_id)\
+                .filter(exam_questions.c.exam_id.in_(exam_ids)):
+            questions_by_exam.setdefault(exam_id, []).append(question)
+
+        grades_by_attempt = {}
+        for attempt_id, question_id, score in db.session.query(
+            Grade.attempt_id, Grade.question_id, Grade.score
+        ).filter(Grade.attempt_id.in_(chunk)):
+            grades_by_attempt.setdefault(attempt_id, {})[question_id] = score
+
+        # Score each group of attempts that sat the same questions in one pass
+        groups = {}
+        for attempt in attempts:
+            groups.setdefault(attempt.snapshot_digest or attempt.exam_id, []).append(attempt)
+        updates, changes, histogram_changes = [], [], []
+        for key, group in groups.items():
+            questions = papers[key] if isinstance(key, str) else questions_by_exam.get(key, [])
+            scores = score_attempts(questions, [answers_by_attempt[a.id] for a in group],
+                                    [grades_by_attempt.get(a.id) for a in group])
+            for attempt, score in zip(group, scores):
+                updates.append({'id': attempt.id, 'score': score})
+                changes.append((attempt.exam_id, attempt.score, score))
+                histogram_changes.append((attempt.exam_id, attempt.school_id, attempt.score, score))
+        db.session.bulk_update_mappings(ExamAttempt, updates)
+        update_subject_aggregates(changes)
+        update_score_histograms(histogram_changes)
+        update_leaderboards(chunk)
+        touch_attempts((attempt.user_id, attempt.exam_id) for attempt in attempts)
+
+
+def regrade_exam(exam):
+    """
+    Re-pins the exam to its questions' current versions and brings submitted
+    attempts over to the new paper. Only attempts pinned to a different paper
+    are touched, and only those whose paper differs in an answer key, mark
+    or question type are rescored. The caller commits. Returns (attempts
+    moved, attempts rescored).
+    """
+    new_digest = pin_exam(exam)
+    db.session.flush()
+    new_paper = load_paper(new_digest)
+
+    moved = rescored = 0
+    stale = db.session.query(ExamAttempt.snapshot_digest).filter(
+        ExamAttempt.exam_id == exam.id, ExamAttempt.end_time.isnot(None),
+        db.or_(ExamAttempt.snapshot_digest.is_(None), ExamAttempt.snapshot_digest != new_digest)
+    ).distinct().all()
+    for (old_digest,) in stale:
+        # Unpinned attempts were scored against whatever the live questions were
+        changed = scoring_changes(load_paper(old_digest), new_paper) if old_digest else True
+        query = db.session.query(ExamAttempt.id).filter(
+            ExamAttempt.exam_id == exam.id, ExamAttempt.end_time.isnot(None),
+            ExamAttempt.snapshot_digest.is_(None) if old_digest is None
+            else ExamAttempt.snapshot_digest == old_digest)
+        attempt_ids = [attempt_id for (attempt_id,) in query]
+        for chunk in _chunks(attempt_ids):
+            ExamAttempt.query.filter(ExamAttempt.id.in_(chunk))\
+                .update({'snapshot_digest': new_digest}, synchronize_session=False)
+            if changed:
+                recompute_scores(chunk)
+        moved += len(attempt_ids)
+        if changed:
+            rescored += len(attempt_ids)
+    return moved, rescored
+
+
+REGRADE_CHUNK_SIZE = 500
+
+
+@job_handler('regrade-question')
+def regrade_question_job(job):
+    """
+    Background regrade after a question's key, marks or type changed. The
+    first call pins every exam using the question to its current version;
+    each later call moves one chunk of submitted attempts onto the new paper
+    and rescores those whose paper differs in scoring. Attempts already on
+    the new paper are skipped, so a resumed job carries on where it stopped.
+    """
+    cursor = dict(job.cursor or {})
+    if 'exams' not in cursor:
+        exams = Exam.query.join(exam_questions, exam_questions.c.exam_id == Exam.id)\
+            .filter(exam_questions.c.question_id == job.params['question_id']).order_by(Exam.id).all()
+        cursor = {'exams': [[exam.id, pin_exam(exam)] for exam in exams], 'index': 0}
+        db.session.flush()
+        job.total = sum(
+            db.session.query(db.func.count(ExamAttempt.id)).filter(
+                ExamAttempt.exam_id == exam_id, ExamAttempt.end_time.isnot(None),
+                db.or_(ExamAttempt.snapshot_digest.is_(None), ExamAttempt.snapshot_digest != digest)
+            ).scalar() for exam_id, digest in cursor['exams'])
+        job.cursor = cursor
+        return not cursor['exams']
+
+    exam_id, digest = cursor['exams'][cursor['index']]
+    rows = db.session.query(ExamAttempt.id, ExamAttempt.snapshot_digest).filter(
+        ExamAttempt.exam_id == exam_id, ExamAttempt.end_time.isnot(None),
+        db.or_(ExamAttempt.snapshot_digest.is_(None), ExamAttempt.snapshot_digest != digest)
+    ).order_by(ExamAttempt.id).limit(REGRADE_CHUNK_SIZE).all()
+    if not rows:
+        cursor['index'] += 1
+        job.cursor = cursor
+        return cursor['index'] >= len(cursor['exams'])
+
+    new_paper = load_paper(digest)
+    changed = {}
+    for _, old_digest in rows:
+        if old_digest not in changed:
+            changed[old_digest] = old_digest is None or bool(scoring_changes(load_paper(old_digest), new_paper))
+    attempt_ids = [attempt_id for attempt_id, _ in rows]
+    ExamAttempt.query.filter(ExamAttempt.id.in_(attempt_ids))\
+        .update({'snapshot_digest': digest}, synchronize_session=False)
+    recompute_scores(attempt_id for attempt_id, old_digest in rows if changed[old_digest])
+    job.progress = (job.progress or 0) + len(rows)
+    job.cursor = cursor
+    return False
+
+
+def stale_exams(exam_ids=None):
+    """Exams whose pinned paper no longer matches their questions' current versions."""
+    query = db.session.query(Exam.id, Exam.snapshot_digest)
+    if exam_ids:
+        query = query.filter(Exam.id.in_(exam_ids))
+    pinned = dict(query.all())
+    stale = []
+    for chunk in _chunks(pinned):
+        current = current_digests(chunk)
+        stale += [exam_id for exam_id in chunk if pinned[exam_id] != current.get(exam_id, pinned[exam_id])]
+    return stale
+
+
+def save_grades(teacher_id, entries):
+    """
+    Saves a batch of grades and refreshes the affected attempt scores in the
+    current transaction. Entries are dicts with attempt_id, question_id,
+    score and (optionally) comments; the caller validates and commits.
+
+    Works the same for a whole attempt or for one question across many
+    attempts. Returns the number of grades written.
+    """
+    rows = {}
+    for entry in entries:
+        key = (int(entry['attempt_id']), int(entry['question_id']))
+        rows[key] = {
+            'attempt_id': key[0],
+            'question_id': key[1],
+            'teacher_id': teacher_id,
+            'score': float(entry['score']),
+            'comments': entry.get('comments') or None,
+        }
+    if not rows:
+        return 0
+    _upsert_grades(list(rows.values()))
+    recompute_scores(attempt_id for attempt_id, _ in rows)
+    return len(rows)
+
+
+def find_grading_error(teacher_id, entries):
+    """
+    Checks a batch of grade entries before saving. Returns a message for the
+    first problem found, or None if every entry belongs to one of the
+    teacher's exams, targets a manually graded question on the paper that
+    attempt sat and is in range.
+    """
+    try:
+        keys = [(int(e['attempt_id']), int(e['question_id']), float(e['score'])) for e in entries]
+    except (KeyError, TypeError, ValueError):
+        return 'Each grade needs an attempt, a question and a numeric score.'
+
+    attempt_papers = {}
+    for chunk in _chunks({attempt_id for attempt_id, _, _ in keys}):
+        for attempt_id, exam_id, digest in db.session.query(
+            ExamAttempt.id, ExamAttempt.exam_id, ExamAttempt.snapshot_digest
+        ).join(Exam, Exam.id == ExamAttempt.exam_id)\
+         .filter(ExamAttempt.id.in_(chunk), Exam.created_by == teacher_id):
+            attempt_papers[attempt_id] = digest or exam_id
+
+    # As in scoring: the paper each attempt sat, else its exam's live questions
+    gradable = {}
+    for digest in {key for key in attempt_papers.values() if isinstance(key, str)}:
+        for question in load_paper(digest):
+            if question.question_type in MANUAL_TYPES:
+                gradable[(digest, question.id)] = question.max_score
+    gradable.update({
+        (exam_id, question_id): max_score
+        for exam_id, question_id, max_score in db.session.query(
+            exam_questions.c.exam_id, Question.id, Question.max_score
+        ).join(Question, Question.id == exam_questions.c.question_id)
+         .filter(exam_questions.c.exam_id.in_({key for key in attempt_papers.values() if isinstance(key, int)}),
+                 Question.question_type.in_(MANUAL_TYPES))
+    })
+
+    for attempt_id, question_id, score in keys:
+        if attempt_id not in attempt_papers:
+            return f'Submission {attempt_id} was not found in your exams.'
+        max_score = gradable.get((attempt_papers[attempt_id], question_id))
+        if max_score is None:
+            return f'Question {question_id} is not graded manually in this exam.'
+        if not 0 <= score <= max_score:
+            return f'Scores for question {question_id} must be between 0 and {max_score}.'
+    return None
@@ -0,0 +1,284 @@
+"""
+Live counters for invigilators.
+
+Autosaves and submissions report each candidate's activity to a presence
+store: per exam and candidate, when they started, when they were last seen,
+how many autosaves arrived and whether they submitted. The default store is
+a SQLite file in the instance folder shared by every worker on the machine
+(INVIGILATION_BACKEND 'sqlite'); 'memory' keeps it per process. Nothing here
+reads or writes the main database, except seeding an exam's candidates the
+first time anyone watches it, so candidates who started before a restart
+are counted.
+
+Each worker runs one hub thread that, every PUBLISH_INTERVAL seconds,
+aggregates the store once per watched exam and centre and hands changed
+counters to every viewer's queue. Server-Sent Events streams then forward
+them, so a hundred invigilators watching the same sitting cost one small
+query every few seconds rather than a hundred.
+
+A stream holds a worker thread for as long as it is open, so each worker
+serves at most INVIGILATION_MAX_STREAMS of them and turns further viewers
+away with a 503 that tells them when to try again, keeping its other
+threads free for candidates.
+"""
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+PUBLISH_INTERVAL = 2.0
+ACTIVE_WINDOW = 60  # Seconds since the last autosave for a candidate to count as answering
+KEEPALIVE = 15  # Seconds between comments that keep proxies from closing an idle stream
+STREAM_SECONDS = 600  # Streams end after this long; browsers reconnect on their own
+BUSY_RETRY = 10  # Seconds a viewer turned away by a full worker waits before trying again
+RETENTION = 2 * 24 * 3600  # Candidates not seen for this long are forgotten
+ALL_CENTRES = None
+
+EVENT_START, EVENT_HEARTBEAT, EVENT_SUBMIT = 'start', 'heartbeat', 'submit'
+
+
+class MemoryStore:
+    """Presence kept in this process."""
+
+    def __init__(self):
+        self._rows = {}  # (exam_id, user_id) -> [school_id, started, last_seen, heartbeats, submitted]
+        self._seeded = set()
+        self._lock = threading.Lock()
+
+    def record(self, exam_id, school_id, user_id, event, now):
+        with self._lock:
+            row = self._rows.get((exam_id, user_id))
+            if row is None or event == EVENT_START:
+                row = self._rows[(exam_id, user_id)] = [school_id, now, now, 0, None]
+            row[2] = now
+            row[3] += 1
+            if event == EVENT_SUBMIT:
+                row[4] = now
+
+    def seed(self, exam_id, rows):
+        with self._lock:
+            for user_id, school_id, started, submitted in rows:
+                self._rows.setdefault((exam_id, user_id), [school_id, started, submitted or started, 0, submitted])
+            self._seeded.add(exam_id)
+
+    def is_seeded(self, exam_id):
+        return exam_id in self._seeded
+
+    def counts(self, exam_id, school_id, now):
+        with self._lock:
+            rows = [row for (row_exam_id, _), row in self._rows.items() if row_exam_id == exam_id
+                    and (school_id is ALL_CENTRES or row[0] == school_id)]
+        return {
+            'started': len(rows),
+            'active': sum(1 for row in rows if row[4] is None and row[2] >= now - ACTIVE_WINDOW),
+            'submitted': sum(1 for row in rows if row[4] is not None),
+            'heartbeats': sum(row[3] for row in rows),
+        }
+
+
+class SQLiteStore:
+    """Presence in a SQLite file shared by all worker processes on the machine."""
+
+    # Forgotten candidates are swept every this many writes per process
+    SWEEP_EVERY = 500
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+
+    def _connection(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS presence (exam_id INTEGER NOT NULL, user_id INTEGER NOT NULL, '
+                         'school_id INTEGER, started REAL NOT NULL, last_seen REAL NOT NULL, '
+                         'heartbeats INTEGER NOT NULL, submitted REAL, PRIMARY KEY (exam_id, user_id))')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_presence_last_seen ON presence (last_seen)')
+            conn.execute('CREATE TABLE IF NOT EXISTS seeded (exam_id INTEGER PRIMARY KEY)')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def record(self, exam_id, school_id, user_id, event, now):
+        conn = self._connection()
+        if event == EVENT_START:
+            conn.execute('INSERT OR REPLACE INTO presence (exam_id, user_id, school_id, started, last_seen, '
+                         'heartbeats, submitted) VALUES (?, ?, ?, ?, ?, 1, NULL)',
+                         (exam_id, user_id, school_id, now, now))
+        else:
+            submitted = now if event == EVENT_SUBMIT else None
+            conn.execute('INSERT INTO presence (exam_id, user_id, school_id, started, last_seen, heartbeats, '
+                         'submitted) VALUES (?, ?, ?, ?, ?, 1, ?) ON CONFLICT (exam_id, user_id) DO UPDATE SET '
+                         'last_seen = excluded.last_seen, heartbeats = heartbeats + 1, '
+                         'submitted = coalesce(excluded.submitted, submitted)',
+                         (exam_id, user_id, school_id, now, now, submitted))
+        self._writes += 1
+        if self._writes % self.SWEEP_EVERY == 0:
+            conn.execute('DELETE FROM presence WHERE last_seen < ?', (now - RETENTION,))
+
+    def seed(self, exam_id, rows):
+        conn = self._connection()
+        conn.executemany('INSERT OR IGNORE INTO presence (exam_id, user_id, school_id, started, last_seen, '
+                         'heartbeats, submitted) VALUES (?, ?, ?, ?, ?, 0, ?)',
+                         [(exam_id, user_id, school_id, started, submitted or started, submitted)
+                          for user_id, school_id, started, submitted in rows])
+        conn.execute('INSERT OR IGNORE INTO seeded (exam_id) VALUES (?)', (exam_id,))
+
+    def is_seeded(self, exam_id):
+        return self._connection().execute('SELECT 1 FROM seeded WHERE exam_id = ?', (exam_id,)).fetchone() is not None
+
+    def counts(self, exam_id, school_id, now):
+        sql = ('SELECT count(*), coalesce(sum(submitted IS NULL AND last_seen >= ?), 0), count(submitted), '
+               'coalesce(sum(heartbeats), 0) FROM presence WHERE exam_id = ?')
+        params = [now - ACTIVE_WINDOW, exam_id]
+        if school_id is not ALL_CENTRES:
+            sql += ' AND school_id = ?'
+            params.append(school_id)
+        started, active, submitted, heartbeats = self._connection().execute(sql, params).fetchone()
+        return {'started': started, 'active': active, 'submitted': submitted, 'heartbeats': heartbeats}
+
+
+class Hub:
+    """
+    Fans counters out to the viewers in this process: one thread, one
+    aggregate per watched (exam, centre) per interval, whatever the number
+    of viewers.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._channels = {}  # (exam_id, school_id) -> {viewer queue: None}
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def subscribe(self, channel):
+        # Each viewer holds only the latest counters; older ones are superseded
+        viewer = queue.Queue(maxsize=1)
+        with self._lock:
+            self._channels.setdefault(channel, {})[viewer] = None
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='invigilation-hub', daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+            latest = self._latest.get(channel)
+        _offer(viewer, latest or self.store.counts(*channel, time.time()))
+        return viewer
+
+    def unsubscribe(self, channel, viewer):
+        with self._lock:
+            viewers = self._channels.get(channel)
+            if viewers is not None:
+                viewers.pop(viewer, None)
+                if not viewers:
+                    del self._channels[channel]
+                    self._latest.pop(channel, None)
+
+    def publish(self):
+        """Aggregates every watched channel once and offers changes to its viewers."""
+        with self._lock:
+            channels = list(self._channels)
+        now = time.time()
+        for channel in channels:
+            counts = self.store.counts(*channel, now)
+            with self._lock:
+                if channel not in self._channels or self._latest.get(channel) == counts:
+                    continue
+                self._latest[channel] = counts
+                viewers = list(self._channels[channel])
+            for viewer in viewers:
+                _offer(viewer, counts)
+
+    def _run(self):
+        while True:
+            time.sleep(PUBLISH_INTERVAL)
+            with self._lock:
+                if not self._channels:
+                    self._thread = None
+                    return
+            try:
+                self.publish()
+            except sqlite3.Error:
+                # A busy or briefly locked store; the next round catches up
+                pass
+
+
+def _offer(viewer, counts):
+    try:
+        viewer.get_nowait()
+    except queue.Empty:
+        pass
+    try:
+        viewer.put_nowait(counts)
+    except queue.Full:
+        pass
+
+
+class Invigilation:
+    def __init__(self):
+        self.store = MemoryStore()
+        self.hub = Hub(self.store)
+        self.max_streams = 2
+        self._streams = 0
+        self._streams_lock = threading.Lock()
+
+    def init_app(self, app):
+        kind = app.config.get('INVIGILATION_BACKEND', 'sqlite')
+        if kind == 'sqlite':
+            self.store = SQLiteStore(
+                app.config.get('INVIGILATION_PATH') or os.path.join(app.instance_path, 'invigilation.sqlite3'))
+        elif kind == 'memory':
+            self.store = MemoryStore()
+        else:
+            raise ValueError(f'Unknown INVIGILATION_BACKEND {kind!r}')
+        self.hub = Hub(self.store)
+        self.max_streams = app.config.get('INVIGILATION_MAX_STREAMS', 2)
+        app.extensions['invigilation'] = self
+
+    def record(self, exam_id, school_id, user_id, event):
+        """Reports a candidate's autosave or submission. The caller has committed it."""
+        self.store.record(exam_id, school_id, user_id, event, time.time())
+
+    def seed(self, exam_id, rows):
+        """Adds candidates from the database: rows of (user_id, school_id, started, submitted) datetimes."""
+        self.store.seed(exam_id, [(user_id, school_id, started.timestamp(), submitted and submitted.timestamp())
+                                  for user_id, school_id, started, submitted in rows])
+
+    def is_seeded(self, exam_id):
+        return self.store.is_seeded(exam_id)
+
+    def claim_stream(self):
+        """Takes one of this worker's stream slots; False if they are all in use."""
+        with self._streams_lock:
+            if self._streams >= self.max_streams:
+                return False
+            self._streams += 1
+            return True
+
+    def release_stream(self):
+        with self._streams_lock:
+            self._streams -= 1
+
+    def stream(self, exam_id, school_id=ALL_CENTRES):
+        """Server-Sent Events carrying the counters for an exam, in one centre or all of them."""
+        channel = (exam_id, school_id)
+        viewer = self.hub.subscribe(channel)
+        try:
+            yield f'retry: {int(PUBLISH_INTERVAL * 1000)}\n\n'
+            deadline = time.monotonic() + STREAM_SECONDS
+            while time.monotonic() < deadline:
+                try:
+                    counts = viewer.get(timeout=KEEPALIVE)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f'event: counts\ndata: {json.dumps(dict(counts, active_window=ACTIVE_WINDOW))}\n\n'
+        finally:
+            self.hub.unsubscribe(channel, viewer)
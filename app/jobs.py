@@ -0,0 +1,142 @@
+"""
+Database-backed background jobs.
+
+A job is a row in the `job` table. Handlers process one bounded chunk per
+call and record where to resume in `job.cursor`; the chunk's writes and the
+new cursor are committed together, so a worker that dies mid-job loses at
+most the chunk in flight. Jobs whose worker stops sending heartbeats are
+picked up again by the next worker that polls.
+
+Run workers with `flask jobs work`.
+"""
+import os
+import socket
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from app.extensions import db
+from app.models import Job
+
+# A running job without a heartbeat for this long is assumed to be orphaned
+STALE_AFTER = timedelta(minutes=5)
+POLL_INTERVAL = 2.0
+
+HANDLERS = {}
+
+
+def job_handler(kind):
+    """
+    Registers a handler for a job kind. The handler is called with the Job
+    repeatedly; each call processes one chunk, updates job.cursor and
+    job.progress, and returns True once the job is finished.
+    """
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def enqueue(kind, params=None, created_by=None):
+    """Adds a job to the queue in the current transaction; the caller commits."""
+    job = Job(kind=kind, params=params or {}, status='queued', progress=0, created_by=created_by)
+    db.session.add(job)
+    return job
+
+
+def _claimable(now):
+    return db.or_(Job.status == 'queued',
+                  db.and_(Job.status == 'running', Job.heartbeat_at < now - STALE_AFTER))
+
+
+def claim_job(worker):
+    """
+    Atomically takes the oldest queued (or orphaned) job for this worker.
+    Returns the Job, or None if there is nothing to do.
+    """
+    while True:
+        now = datetime.utcnow()
+        job_id = db.session.query(Job.id).filter(_claimable(now)).order_by(Job.id).limit(1).scalar()
+        if job_id is None:
+            return None
+        # Compare-and-set: only one worker's update matches the row
+        claimed = Job.query.filter(Job.id == job_id, _claimable(now)).update(
+            {'status': 'running', 'worker': worker, 'heartbeat_at': now,
+             'started_at': db.func.coalesce(Job.started_at, now)},
+            synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+
+
+def _still_owned(job_id, worker, now):
+    """
+    Renews the heartbeat if `worker` still holds the job. A job reclaimed as
+    orphaned belongs to its new worker; the old one must not commit to it.
+    """
+    return Job.query.filter(Job.id == job_id, Job.worker == worker).update(
+        {'heartbeat_at': now}, synchronize_session=False)
+
+
+def run_job(job):
+    """
+    Runs a claimed job to completion, committing after every chunk. Stops
+    without committing if another worker has reclaimed the job meanwhile.
+    """
+    handler = HANDLERS.get(job.kind)
+    job_id, worker = job.id, job.worker
+    try:
+        if handler is None:
+            raise LookupError(f'No handler registered for job kind {job.kind!r}.')
+        finished = False
+        while not finished:
+            finished = handler(job)
+            now = datetime.utcnow()
+            if finished:
+                job.status = 'done'
+                job.finished_at = now
+            # Compare-and-set in the chunk's transaction
+            if not _still_owned(job_id, worker, now):
+                db.session.rollback()
+                return db.session.get(Job, job_id)
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        Job.query.filter(Job.id == job_id, Job.worker == worker).update(
+            {'status': 'failed', 'error': traceback.format_exc(), 'finished_at': datetime.utcnow()},
+            synchronize_session=False)
+        db.session.commit()
+    return db.session.get(Job, job_id)
+
+
+def work(worker=None, once=False, poll_interval=POLL_INTERVAL):
+    """Claims and runs jobs until interrupted, or until the queue is empty with once=True."""
+    worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+    processed = 0
+    while True:
+        job = claim_job(worker)
+        if job is None:
+            if once:
+                return processed
+            db.session.remove()
+            time.sleep(poll_interval)
+            continue
+        run_job(job)
+        processed += 1
+
+
+def retry(job_id):
+    """Puts a failed job back in the queue; it resumes from its last committed chunk."""
+    return Job.query.filter(Job.id == job_id, Job.status == 'failed').update(
+        {'status': 'queued', 'error': None, 'finished_at': None}, synchronize_session=False)
+
+
+def job_status(job):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'total': job.total,
+        'error': job.error.strip().splitlines()[-1] if job.error else None,
+    }
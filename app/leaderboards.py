@@ -0,0 +1,157 @@
+"""
+Centre and national leaderboards.
+
+Every mock exam has a board, and so does every subject. A board is kept as:
+
+- a LeaderboardEntry per scored attempt, indexed by score within the board
+  and within each centre, so the top N is a short index range read;
+- a Fenwick tree of score counts over 0.01-wide buckets (RankNode rows),
+  one per centre plus one for the whole country under school_id 0, so the
+  number of scores above or below any score is a sum over O(log n) nodes.
+
+grading.update_leaderboards() applies score changes to both, and
+`flask leaderboards rebuild` recomputes them from ExamAttempt.score.
+Practice sessions students set themselves are not ranked.
+"""
+from app.extensions import db
+from app.models import Exam, ExamAttempt, User, UserRole, School, LeaderboardEntry, RankNode
+
+SCALE = 100  # Buckets per percentage point, matching scores rounded to 2 places
+SIZE = 100 * SCALE + 1  # Scores 0.00 to 100.00
+NATIONAL = 0
+REBUILD_CHUNK_SIZE = 1000
+
+
+def exam_board(exam_id):
+    return f'exam:{exam_id}'
+
+
+def subject_board(subject):
+    return f'subject:{subject}'
+
+
+def bucket(score):
+    """The tree index (1-based) of a percentage score."""
+    return min(max(int(round(score * SCALE)), 0), SIZE - 1) + 1
+
+
+def _update_path(index):
+    while index <= SIZE:
+        yield index
+        index += index & -index
+
+
+def _prefix_path(index):
+    while index > 0:
+        yield index
+        index -= index & -index
+
+
+def add_to_trees(counts, entry, amount):
+    """
+    Adds `amount` for an entry's score to its board's national and centre
+    trees, accumulating into counts {(board, school_id, node): delta}.
+    """
+    schools = (NATIONAL, entry['school_id']) if entry['school_id'] else (NATIONAL,)
+    for school_id in schools:
+        for node in _update_path(bucket(entry['score'])):
+            key = (entry['board'], school_id, node)
+            counts[key] = counts.get(key, 0) + amount
+
+
+def board_entries(attempt_ids=None):
+    """
+    LeaderboardEntry rows for the given attempts (or every attempt): one on
+    the exam's board and one on its subject's, for each scored attempt on an
+    exam set by a teacher.
+    """
+    author, candidate = db.aliased(User), db.aliased(User)
+    query = db.session.query(
+        ExamAttempt.id, ExamAttempt.user_id, candidate.school_id, ExamAttempt.score, Exam.id, Exam.subject
+    ).join(Exam, Exam.id == ExamAttempt.exam_id)\
+     .join(author, author.id == Exam.created_by)\
+     .join(candidate, candidate.id == ExamAttempt.user_id)\
+     .filter(ExamAttempt.score.isnot(None), author.role != UserRole.STUDENT)
+    if attempt_ids is not None:
+        query = query.filter(ExamAttempt.id.in_(attempt_ids))
+    else:
+        query = query.order_by(ExamAttempt.id).yield_per(REBUILD_CHUNK_SIZE)
+    for attempt_id, user_id, school_id, score, exam_id, subject in query:
+        for board in (exam_board(exam_id), subject_board(subject)):
+            yield {'board': board, 'attempt_id': attempt_id, 'user_id': user_id,
+                   'school_id': school_id, 'score': score}
+
+
+def rebuild_leaderboards():
+    """Recomputes every board from the attempts' scores; the caller commits."""
+    RankNode.query.delete(synchronize_session=False)
+    LeaderboardEntry.query.delete(synchronize_session=False)
+    counts, rows = {}, []
+    for entry in board_entries():
+        add_to_trees(counts, entry, 1)
+        rows.append(entry)
+        if len(rows) >= REBUILD_CHUNK_SIZE:
+            db.session.execute(LeaderboardEntry.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(LeaderboardEntry.__table__.insert(), rows)
+    nodes = [{'board': board, 'school_id': school_id, 'node': node, 'count': count}
+             for (board, school_id, node), count in counts.items()]
+    for start in range(0, len(nodes), REBUILD_CHUNK_SIZE):
+        db.session.execute(RankNode.__table__.insert(), nodes[start:start + REBUILD_CHUNK_SIZE])
+    return len(nodes)
+
+
+def standing(board, score, school_id=NATIONAL):
+    """
+    Where a score stands on a board, nationally or within one centre:
+    {'rank', 'total', 'percentile'}, or None while the board is empty. Equal
+    scores share a rank; the percentile is the share of scores below it,
+    counting half of those equal to it.
+    """
+    index = bucket(score)
+    paths = {
+        'total': list(_prefix_path(SIZE)),
+        'upto': list(_prefix_path(index)),
+        'below': list(_prefix_path(index - 1)),
+    }
+    nodes = dict(db.session.query(RankNode.node, RankNode.count).filter(
+        RankNode.board == board, RankNode.school_id == school_id,
+        RankNode.node.in_(set().union(*paths.values()))
+    ))
+    total, upto, below = (sum(nodes.get(node, 0) for node in paths[name]) for name in ('total', 'upto', 'below'))
+    if not total:
+        return None
+    return {
+        'rank': total - upto + 1,
+        'total': total,
+        'percentile': round(100.0 * (below + (upto - below) / 2) / total, 1),
+    }
+
+
+def best_entry(board, user_id):
+    """A student's highest score on a board, or None."""
+    return db.session.query(db.func.max(LeaderboardEntry.score)).filter(
+        LeaderboardEntry.user_id == user_id, LeaderboardEntry.board == board).scalar()
+
+
+def top(board, school_id=None, limit=10):
+    """
+    The highest scoring attempts on a board, nationally or in one centre:
+    [{'rank', 'attempt_id', 'user_id', 'name', 'school', 'score'}, ...].
+    """
+    query = db.session.query(
+        LeaderboardEntry.attempt_id, LeaderboardEntry.user_id, LeaderboardEntry.score, User.full_name, School.name
+    ).join(User, User.id == LeaderboardEntry.user_id)\
+     .outerjoin(School, School.id == LeaderboardEntry.school_id)\
+     .filter(LeaderboardEntry.board == board)
+    if school_id is not None:
+        query = query.filter(LeaderboardEntry.school_id == school_id)
+    rows = []
+    for position, (attempt_id, user_id, score, name, school) in enumerate(
+            query.order_by(LeaderboardEntry.score.desc(), LeaderboardEntry.attempt_id).limit(limit), 1):
+        # The list starts at the top, so ties only need comparing with the row above
+        rank = rows[-1]['rank'] if rows and rows[-1]['score'] == score else position
+        rows.append({'rank': rank, 'attempt_id': attempt_id, 'user_id': user_id,
+                     'name': name, 'school': school, 'score': score})
+    return rows
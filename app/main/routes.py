@@ -1,13 +1,33 @@
-from flask import render_template, request, abort, flash, redirect, url_for, current_app
+from flask import render_template, request, abort, flash, redirect, url_for, current_app, jsonify, Response, stream_with_context, session
 from flask_login import login_required, current_user
 from app.main import bp
 from app.decorators import role_required
-from app.models import Exam, ExamAttempt, User, School, Question, QuestionType, UserRole, Resource, ResourceType, AuditLog
-from app.extensions import db
+from app.models import Exam, ExamAttempt, ArchivedAttempt, AttemptAnswer, Grade, User, School, Question, QuestionType, UserRole, Resource, ResourceType, ResourceRecommendation, AuditLog, Job, SubjectAggregate, ScoreHistogram, Blob, UploadSession, exam_questions
+from app.extensions import db, invigilation
+from app.grading import (MANUAL_TYPES, compute_score, save_grades, find_grading_error, is_correct, update_subject_aggregates,
+                         update_score_histograms, update_leaderboards)
+from app.jobs import enqueue, job_status
+from app.answers import save_answers as store_answers, load_answers, decode as decode_answer
+from app.uploads import (UploadError, store_file, start_upload, write_chunk, complete_upload, add_reference,
+                         release, blob_url, serve_blob, static_upload_folder)
+from app.snapshots import pin_exam, load_paper, exam_paper
+from app.catalog import subject_catalog, subjects as catalog_subjects
+from app.fragments import render_fragment, touch, touch_attempts, user_scope, teacher_scope, EXAMS_SCOPE
+from app.adaptive import get_table, estimate_ability, starting_ability, save_ability, TARGET_STANDARD_ERROR
+from app.similarity import flags_for_attempt, flags_for_attempts
+from app.export import export_csv, gzip_stream
+from app.distributions import ScoreSketch, merged_sketches
+from app.exam_blueprints import (BlueprintError, parse_blueprint, recently_seen, draw_forms, build_exams,
+                                 MAX_FORMS, RECENT_DAYS)
+from app.retention import start_exam_deletion, EXAM_ACTIVE
+from app.recommendations import forget_resource
+from app.invigilation import EVENT_START, EVENT_HEARTBEAT, EVENT_SUBMIT, BUSY_RETRY
+from app.leaderboards import exam_board, subject_board, standing, best_entry, top, NATIONAL
 from sqlalchemy import func
-from datetime import datetime
+from sqlalchemy.orm import joinedload
+from datetime import datetime, timedelta
 import os
-from werkzeug.utils import secure_filename
+import sqlite3
 
 @bp.route('/')
 @bp.route('/index')
@@ -17,6 +37,11 @@ def index():
 @bp.route('/dashboard')
 @login_required
 def dashboard():
+    main = render_fragment(f'dashboard:{current_user.id}', [user_scope(current_user.id), EXAMS_SCOPE],
+                           _student_dashboard)
+    return render_template('student_dashboard.html', title='Dashboard', main=main)
+
+def _student_dashboard():
     exam_history_query = db.session.query(
         ExamAttempt, Exam
     ).join(Exam, ExamAttempt.exam_id == Exam.id)\
@@ -28,23 +53,45 @@ def dashboard():
         {
             'subject': attempt.exam.subject,
             'exam': attempt.exam.title,
+            # Practice sessions are set by the student themselves and are not ranked
+            'exam_id': exam.id if attempt.score is not None and exam.created_by != current_user.id else None,
             'score': f"{int(attempt.score)}%" if attempt.score is not None else "N/A",
-            'date': attempt.start_time.strftime('%Y-%m-%d')
+            'date': attempt.start_time.strftime('%Y-%m-%d'),
+            'start_time': attempt.start_time
         }
         for attempt, exam in exam_history_query
     ]
-
-    performance_analysis_query = db.session.query(
-        Exam.subject,
-        func.avg(ExamAttempt.score)
-    ).join(Exam, ExamAttempt.exam_id == Exam.id)\
-     .filter(ExamAttempt.user_id == current_user.id, ExamAttempt.score.isnot(None))\
-     .group_by(Exam.subject)\
-     .all()
+    # Archived attempts stay in the history, though off the leaderboards
+    archived_query = db.session.query(ArchivedAttempt.start_time, ArchivedAttempt.score, Exam.subject, Exam.title)\
+        .join(Exam, ArchivedAttempt.exam_id == Exam.id)\
+        .filter(ArchivedAttempt.user_id == current_user.id).all()
+    exam_history += [
+        {
+            'subject': subject,
+            'exam': title,
+            'exam_id': None,
+            'score': f"{int(score)}%" if score is not None else "N/A",
+            'date': start_time.strftime('%Y-%m-%d'),
+            'start_time': start_time
+        }
+        for start_time, score, subject, title in archived_query
+    ]
+    exam_history.sort(key=lambda entry: entry['start_time'], reverse=True)
+
+    totals = {}
+    for model in (ExamAttempt, ArchivedAttempt):
+        for subject, count, score_sum in db.session.query(
+            Exam.subject, func.count(model.score), func.sum(model.score)
+        ).join(Exam, model.exam_id == Exam.id)\
+         .filter(model.user_id == current_user.id, model.score.isnot(None))\
+         .group_by(Exam.subject):
+            total = totals.setdefault(subject, [0, 0.0])
+            total[0] += count
+            total[1] += score_sum
 
     performance_analysis = [
-        {'subject': subject, 'score': int(avg_score)}
-        for subject, avg_score in performance_analysis_query
+        {'subject': subject, 'score': int(score_sum / count)}
+        for subject, (count, score_sum) in sorted(totals.items())
     ]
 
     overall_performance = 0
@@ -53,7 +100,7 @@ def dashboard():
 
     attempted_exam_ids = [attempt.exam_id for attempt, exam in exam_history_query]
     current_exams_query = Exam.query.filter(
-        ~Exam.id.in_(attempted_exam_ids)
+        ~Exam.id.in_(attempted_exam_ids), Exam.status == EXAM_ACTIVE
     ).limit(5).all()
 
     current_exams = [
@@ -61,8 +108,7 @@ def dashboard():
         for exam in current_exams_query
     ]
 
-    return render_template('student_dashboard.html',
-                           title='Dashboard',
+    return render_template('fragments/student_dashboard.html',
                            current_exams=current_exams,
                            performance=performance_analysis,
                            overall_performance=overall_performance,
@@ -72,6 +118,13 @@ def dashboard():
 @login_required
 @role_required('teacher')
 def teacher_dashboard():
+    # Short-lived because of the "x minutes ago" ages
+    main = render_fragment(f'teacher_dashboard:{current_user.id}',
+                           [user_scope(current_user.id), teacher_scope(current_user.id)],
+                           _teacher_dashboard, ttl=60)
+    return render_template('teacher/dashboard.html', title='Teacher Dashboard', main=main)
+
+def _teacher_dashboard():
     recent_exams = Exam.query.filter_by(created_by=current_user.id)\
                              .order_by(Exam.creation_date.desc())\
                              .limit(5).all()
@@ -94,57 +147,74 @@ def teacher_dashboard():
             'age': age
         })
 
-    return render_template('teacher/dashboard.html', title='Teacher Dashboard', recent_activities=recent_activities)
+    return render_template('fragments/teacher_dashboard.html', recent_activities=recent_activities)
 
 @bp.route('/teacher/analytics')
 @login_required
 @role_required('teacher')
 def teacher_analytics():
-    teacher_exams = Exam.query.filter_by(created_by=current_user.id).all()
-    teacher_exam_ids = [e.id for e in teacher_exams]
-    all_attempts = ExamAttempt.query.filter(ExamAttempt.exam_id.in_(teacher_exam_ids)).all()
-    total_submissions = len(all_attempts)
-
-    completed_attempts = [a for a in all_attempts if a.end_time is not None]
-    completion_rate = int((len(completed_attempts) / total_submissions) * 100) if total_submissions > 0 else 0
-
-    scored_attempts = [a.score for a in all_attempts if a.score is not None]
-    overall_average = int(sum(scored_attempts) / len(scored_attempts)) if scored_attempts else 0
-
-    average_score_by_subject_query = db.session.query(
-        Exam.subject,
-        func.avg(ExamAttempt.score)
-    ).join(ExamAttempt, Exam.id == ExamAttempt.exam_id)\
-     .filter(Exam.created_by == current_user.id, ExamAttempt.score.isnot(None))\
-     .group_by(Exam.subject).all()
+    main = render_fragment(f'teacher_analytics:{current_user.id}', [teacher_scope(current_user.id)],
+                           _teacher_analytics)
+    return render_template('teacher/analytics.html', title='Performance Analytics', main=main)
+
+def _teacher_analytics():
+    total_submissions, completed = db.session.query(
+        func.count(ExamAttempt.id), func.count(ExamAttempt.end_time)
+    ).join(Exam, Exam.id == ExamAttempt.exam_id).filter(Exam.created_by == current_user.id).one()
+    completion_rate = int((completed / total_submissions) * 100) if total_submissions > 0 else 0
+
+    # Running totals kept in step with every score change
+    aggregates = SubjectAggregate.query.filter(SubjectAggregate.teacher_id == current_user.id,
+                                               SubjectAggregate.scored_attempts > 0)\
+                                       .order_by(SubjectAggregate.subject).all()
+    scored = sum(aggregate.scored_attempts for aggregate in aggregates)
+    overall_average = int(sum(aggregate.score_sum for aggregate in aggregates) / scored) if scored else 0
+
+    # Distributions merge the teacher's per-exam, per-centre histograms
+    by_subject_and_school = merged_sketches([Exam.subject, ScoreHistogram.school_id],
+                                            Exam.created_by == current_user.id)
+    overall, by_subject, by_school = ScoreSketch(), {}, {}
+    for (subject, school_id), sketch in by_subject_and_school.items():
+        overall += sketch
+        by_subject[subject] = by_subject.get(subject, ScoreSketch()) + sketch
+        by_school[school_id] = by_school.get(school_id, ScoreSketch()) + sketch
 
     average_score_by_subject = [
-        {'subject': subject, 'score': int(avg_score)}
-        for subject, avg_score in average_score_by_subject_query
-    ]
-
-    recent_exam_performance_query = db.session.query(
-        Exam.title,
-        func.avg(ExamAttempt.score)
-    ).join(ExamAttempt, Exam.id == ExamAttempt.exam_id)\
-     .filter(Exam.created_by == current_user.id)\
-     .group_by(Exam.id)\
-     .order_by(Exam.creation_date.desc())\
-     .limit(5).all()
-
-    recent_exam_performance = [
-        {'exam': title, 'average': int(avg_score) if avg_score is not None else 0}
-        for title, avg_score in recent_exam_performance_query
+        dict(by_subject.get(aggregate.subject, ScoreSketch()).summary(),
+             subject=aggregate.subject, score=int(aggregate.score_sum / aggregate.scored_attempts))
+        for aggregate in aggregates
     ]
 
+    school_names = dict(db.session.query(School.id, School.name).filter(School.id.in_(list(by_school))))
+    centre_comparison = sorted(
+        (dict(sketch.summary(), centre=school_names.get(school_id, 'No centre'))
+         for school_id, sketch in by_school.items() if sketch.total),
+        key=lambda row: row['median'], reverse=True)
+
+    recent_exams = db.session.query(Exam.id, Exam.title).filter(Exam.created_by == current_user.id)\
+        .order_by(Exam.creation_date.desc()).limit(5).all()
+    recent_sketches = merged_sketches([ScoreHistogram.exam_id],
+                                      ScoreHistogram.exam_id.in_([exam_id for exam_id, _ in recent_exams]))
+    recent_exam_performance = []
+    for exam_id, title in recent_exams:
+        sketch = recent_sketches.get((exam_id,), ScoreSketch())
+        mean = sketch.mean()
+        recent_exam_performance.append(dict(sketch.summary(), exam=title,
+                                            average=int(mean) if mean is not None else None))
+
+    score_bands = overall.bands()
     analytics_data = {
         'total_submissions': total_submissions,
         'overall_average': overall_average,
+        'overall_median': overall.quantile(0.5),
         'completion_rate': completion_rate,
+        'score_bands': score_bands,
+        'largest_band': max(count for _, count in score_bands),
         'average_score_by_subject': average_score_by_subject,
+        'centre_comparison': centre_comparison,
         'recent_exam_performance': recent_exam_performance,
     }
-    return render_template('teacher/analytics.html', title='Performance Analytics', analytics=analytics_data)
+    return render_template('fragments/teacher_analytics.html', analytics=analytics_data)
 
 @bp.route('/admin/dashboard')
 @login_required
@@ -269,6 +339,45 @@ def add_question():
 
     return render_template('teacher/add_question.html', title='Add New Question')
 
+@bp.route('/teacher/question/<int:question_id>/edit', methods=['GET', 'POST'])
+@login_required
+@role_required('teacher')
+def edit_question(question_id):
+    question = Question.query.get_or_404(question_id)
+    if question.created_by != current_user.id:
+        abort(403)
+
+    if request.method == 'POST':
+        scoring_before = (question.question_type, question.answer, question.max_score)
+        question.text = request.form.get('text')
+        question.subject = request.form.get('subject')
+        question.topic = request.form.get('topic')
+        question.question_type = QuestionType[request.form.get('question_type').upper()]
+        question.options = request.form.getlist('options[]')
+        question.answer = request.form.getlist('answer[]') or request.form.get('answer')
+        db.session.flush()
+
+        # A corrected key is applied to past attempts by a background job;
+        # regrading inline would time out on popular questions
+        if (question.question_type, question.answer, question.max_score) != scoring_before:
+            job = enqueue('regrade-question', {'question_id': question.id}, created_by=current_user.id)
+            db.session.commit()
+            flash(f'Question updated. Existing attempts are being regraded in the background (job {job.id}).', 'success')
+        else:
+            db.session.commit()
+            flash('Question updated successfully!', 'success')
+        return redirect(url_for('main.question_bank'))
+
+    return render_template('teacher/add_question.html', title='Edit Question', question=question)
+
+@bp.route('/jobs/<int:job_id>')
+@login_required
+def job_progress(job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.created_by != current_user.id and current_user.role != UserRole.ADMIN:
+        abort(403)
+    return jsonify(job_status(job))
+
 @bp.route('/teacher/exam-builder', methods=['GET', 'POST'])
 @login_required
 @role_required('teacher')
@@ -288,15 +397,66 @@ def exam_builder():
 
         questions = Question.query.filter(Question.id.in_(question_ids)).all()
         new_exam.questions.extend(questions)
-
         db.session.add(new_exam)
+        pin_exam(new_exam, questions)
+        touch(EXAMS_SCOPE, teacher_scope(current_user.id))
         db.session.commit()
 
         flash('Exam created successfully!', 'success')
         return redirect(url_for('main.teacher_exams'))
 
+    return _exam_builder_page()
+
+def _exam_builder_page(blueprint=None):
     all_questions = Question.query.all()
-    return render_template('teacher/exam_builder.html', title='Exam Builder', questions=all_questions)
+    return render_template('teacher/exam_builder.html', title='Exam Builder', questions=all_questions,
+                           catalog=subject_catalog(), schools=School.query.order_by(School.name).all(),
+                           blueprint=blueprint or {'forms': 1, 'recent_days': RECENT_DAYS,
+                                                   'cohort': str(current_user.school_id or '')},
+                           max_forms=MAX_FORMS)
+
+@bp.route('/teacher/exam/blueprint', methods=['POST'])
+@login_required
+@role_required('teacher')
+def build_exam_from_blueprint():
+    """Builds one or more parallel exam forms from a topic and difficulty blueprint."""
+    form = request.form
+    title = (form.get('exam-title') or '').strip()
+    subject = (form.get('subject') or '').strip()
+    if not title or not subject:
+        flash('Give the exam a title and a subject.', 'danger')
+        return _exam_builder_page(form)
+    # Cohort: '' avoids nothing, 'all' avoids what any candidate sat recently, else a centre id
+    cohort = form.get('cohort', '')
+    try:
+        duration = int(form.get('duration', ''))
+        forms = int(form.get('forms') or 1)
+        recent_days = int(form.get('recent_days') or RECENT_DAYS)
+        school_id = int(cohort) if cohort not in ('', 'all') else None
+    except ValueError:
+        flash('Duration, forms, days and centre must be whole numbers.', 'danger')
+        return _exam_builder_page(form)
+    if not 1 <= forms <= MAX_FORMS:
+        flash(f'Build between 1 and {MAX_FORMS} forms at a time.', 'danger')
+        return _exam_builder_page(form)
+
+    try:
+        lines = parse_blueprint(form.get('blueprint'), subject)
+        seen = recently_seen(school_id, recent_days) if cohort else set()
+        form_question_ids, reused = draw_forms(subject, lines, forms, seen)
+    except BlueprintError as e:
+        flash(str(e), 'danger')
+        return _exam_builder_page(form)
+
+    exams = build_exams(title, subject, duration, current_user.id, form_question_ids)
+    touch(EXAMS_SCOPE, teacher_scope(current_user.id))
+    db.session.commit()
+
+    flash(f'Created {len(exams)} exam{"s" if len(exams) != 1 else ""} '
+          f'with {len(form_question_ids[0])} questions each.', 'success')
+    if reused:
+        flash(f'{reused} recently seen questions were reused because the pool ran short.', 'warning')
+    return redirect(url_for('main.teacher_exams'))
 
 @bp.route('/teacher/exam/<int:exam_id>/edit', methods=['GET', 'POST'])
 @login_required
@@ -305,6 +465,8 @@ def edit_exam(exam_id):
     exam = Exam.query.get_or_404(exam_id)
     if exam.created_by != current_user.id:
         abort(403)
+    if exam.status != EXAM_ACTIVE:
+        abort(404)
 
     if request.method == 'POST':
         exam.title = request.form.get('exam-title')
@@ -313,6 +475,9 @@ def edit_exam(exam_id):
 
         question_ids = request.form.getlist('question')
         exam.questions = Question.query.filter(Question.id.in_(question_ids)).all()
+        # New attempts sit the edited paper; submitted ones keep the paper they sat
+        pin_exam(exam, exam.questions)
+        touch(EXAMS_SCOPE, teacher_scope(current_user.id))
 
         db.session.commit()
         flash('Exam updated successfully!', 'success')
@@ -325,7 +490,12 @@ def edit_exam(exam_id):
 @login_required
 @role_required('teacher')
 def grading_list():
-    attempts_to_grade = ExamAttempt.query.join(Exam).filter(
+    # Project just the columns the table shows so rows never lazy-load user or exam
+    attempts_to_grade = db.session.query(
+        ExamAttempt.id, ExamAttempt.exam_id, ExamAttempt.end_time, User.full_name, Exam.title
+    ).join(Exam, ExamAttempt.exam_id == Exam.id)\
+     .join(User, ExamAttempt.user_id == User.id)\
+     .filter(
         Exam.created_by == current_user.id,
         ExamAttempt.score.is_(None),
         ExamAttempt.end_time.isnot(None)
@@ -333,61 +503,256 @@ def grading_list():
 
     attempts_data = [
         {
-            'id': attempt.id,
-            'student_name': attempt.user.full_name,
-            'exam_title': attempt.exam.title,
-            'submitted_on': attempt.end_time
+            'id': attempt_id,
+            'student_name': full_name,
+            'exam_title': title,
+            'submitted_on': end_time
         }
-        for attempt in attempts_to_grade
+        for attempt_id, _, end_time, full_name, title in attempts_to_grade
     ]
-    return render_template('teacher/grading_list.html', title='Exams to Grade', attempts=attempts_data)
 
+    # Entry points for question-major grading, one per essay/short answer question
+    pending_by_exam = {}
+    for _, exam_id, _, _, _ in attempts_to_grade:
+        pending_by_exam[exam_id] = pending_by_exam.get(exam_id, 0) + 1
+    pending_questions = db.session.query(
+        Exam.id, Exam.title, Question.id, Question.text
+    ).join(exam_questions, exam_questions.c.exam_id == Exam.id)\
+     .join(Question, Question.id == exam_questions.c.question_id)\
+     .filter(Exam.created_by == current_user.id,
+             Exam.id.in_(list(pending_by_exam)),
+             Question.question_type.in_(MANUAL_TYPES))\
+     .order_by(Exam.id, Question.id).all()
 
-@bp.route('/teacher/grading/<int:attempt_id>')
+    questions_data = [
+        {
+            'exam_id': exam_id,
+            'exam_title': exam_title,
+            'question_id': question_id,
+            'question_text': question_text,
+            'pending': pending_by_exam[exam_id]
+        }
+        for exam_id, exam_title, question_id, question_text in pending_questions
+    ]
+    return render_template('teacher/grading_list.html', title='Exams to Grade',
+                           attempts=attempts_data, questions=questions_data)
+
+
+@bp.route('/teacher/grading/<int:attempt_id>', methods=['GET', 'POST'])
 @login_required
 @role_required('teacher')
 def grading_interface(attempt_id):
-    attempt = ExamAttempt.query.get_or_404(attempt_id)
-    if attempt.exam.created_by != current_user.id:
+    attempt = ExamAttempt.query.options(joinedload(ExamAttempt.user)).get_or_404(attempt_id)
+    # Column projection: loading the Exam entity would also load all its questions
+    exam_title, exam_owner = db.session.query(Exam.title, Exam.created_by)\
+        .filter(Exam.id == attempt.exam_id).one()
+    if exam_owner != current_user.id:
         abort(403)
 
-    questions_to_grade = []
-    student_answers = attempt.answers or {}
-    for question in attempt.exam.questions:
-        if question.question_type in [QuestionType.ESSAY, QuestionType.SHORT_ANSWER]:
-            questions_to_grade.append({
+    # Grade against the paper the candidate sat, not the live questions
+    if attempt.snapshot_digest:
+        paper = load_paper(attempt.snapshot_digest)
+    else:
+        paper = exam_paper(attempt.exam_id)[1] or []
+    manual_questions = [q for q in paper if q.question_type in MANUAL_TYPES]
+
+    if request.method == 'POST':
+        entries = [
+            {
+                'attempt_id': attempt.id,
                 'question_id': question.id,
-                'question_text': question.text,
-                'student_answer': student_answers.get(str(question.id), 'No answer provided.'),
-                'max_score': question.max_score
-            })
+                'score': request.form.get(f'score-{question.id}'),
+                'comments': request.form.get(f'comments-{question.id}')
+            }
+            for question in manual_questions
+            if request.form.get(f'score-{question.id}', '') != ''
+        ]
+        error = find_grading_error(current_user.id, entries)
+        if error:
+            flash(error, 'danger')
+            return redirect(url_for('main.grading_interface', attempt_id=attempt.id))
+
+        save_grades(current_user.id, entries)
+        db.session.commit()
+        flash('Grades saved successfully!', 'success')
+        return redirect(url_for('main.grading_list'))
+
+    existing_grades = {grade.question_id: grade for grade in Grade.query.filter_by(attempt_id=attempt.id)}
+    similar = flags_for_attempt(attempt.id)
+    questions_to_grade = []
+    student_answers = load_answers([attempt.id])[attempt.id]
+    for question in manual_questions:
+        grade = existing_grades.get(question.id)
+        questions_to_grade.append({
+            'question_id': question.id,
+            'question_text': question.text,
+            'student_answer': student_answers.get(str(question.id), 'No answer provided.'),
+            'max_score': question.max_score,
+            'score': grade.score if grade else None,
+            'comments': grade.comments if grade else '',
+            'similar': similar.get(question.id, [])
+        })
 
     attempt_data = {
         'id': attempt.id,
         'student_name': attempt.user.full_name,
-        'exam_title': attempt.exam.title,
+        'exam_title': exam_title,
         'questions_to_grade': questions_to_grade
     }
     return render_template('teacher/grading_interface.html', title='Grade Exam', attempt=attempt_data)
 
+GRADING_PAGE_SIZE = 50
+
+@bp.route('/teacher/grading/exam/<int:exam_id>/question/<int:question_id>', methods=['GET', 'POST'])
+@login_required
+@role_required('teacher')
+def grade_by_question(exam_id, question_id):
+    """
+    Question-major grading: pages through every submitted answer to one
+    question with a keyset cursor (?after=<attempt id>), reading just that
+    question's answers off the (question_id, attempt_id) index.
+    """
+    # Column projection: loading the Exam entity would also load all its questions
+    exam = db.session.query(Exam.id, Exam.title, Exam.created_by).filter(Exam.id == exam_id).first()
+    if exam is None:
+        abort(404)
+    if exam.created_by != current_user.id:
+        abort(403)
+    question = Question.query.join(exam_questions, exam_questions.c.question_id == Question.id)\
+        .filter(exam_questions.c.exam_id == exam_id, Question.id == question_id).first_or_404()
+    if question.question_type not in MANUAL_TYPES:
+        abort(404)
+
+    after = request.args.get('after', 0, type=int)
+    ungraded_only = request.args.get('ungraded') == '1'
+
+    if request.method == 'POST':
+        entries = [
+            {
+                'attempt_id': int(field[len('score-'):]),
+                'question_id': question.id,
+                'score': value,
+                'comments': request.form.get(f'comments-{field[len("score-"):]}')
+            }
+            for field, value in request.form.items()
+            if field.startswith('score-') and field[len('score-'):].isdigit() and value != ''
+        ]
+        error = find_grading_error(current_user.id, entries)
+        if error:
+            flash(error, 'danger')
+            return redirect(url_for('main.grade_by_question', exam_id=exam_id, question_id=question_id,
+                                    after=after, ungraded=request.args.get('ungraded')))
+
+        saved = save_grades(current_user.id, entries)
+        db.session.commit()
+        flash(f'{saved} grades saved.', 'success')
+        next_after = request.form.get('next_after', type=int)
+        if next_after is None:
+            return redirect(url_for('main.grading_list'))
+        return redirect(url_for('main.grade_by_question', exam_id=exam_id, question_id=question_id,
+                                after=next_after, ungraded=request.args.get('ungraded')))
+
+    page_query = db.session.query(
+        ExamAttempt.id,
+        User.full_name,
+        AttemptAnswer.choice, AttemptAnswer.choices, AttemptAnswer.text
+    ).join(User, ExamAttempt.user_id == User.id)\
+     .outerjoin(AttemptAnswer, (AttemptAnswer.question_id == question.id)
+                               & (AttemptAnswer.attempt_id == ExamAttempt.id))\
+     .filter(ExamAttempt.exam_id == exam_id,
+             ExamAttempt.end_time.isnot(None),
+             ExamAttempt.id > after)
+    if ungraded_only:
+        page_query = page_query.outerjoin(
+            Grade, (Grade.attempt_id == ExamAttempt.id) & (Grade.question_id == question.id)
+        ).filter(Grade.id.is_(None))
+    # One extra row tells us whether there is a next page
+    rows = page_query.order_by(ExamAttempt.id).limit(GRADING_PAGE_SIZE + 1).all()
+    has_next = len(rows) > GRADING_PAGE_SIZE
+    rows = rows[:GRADING_PAGE_SIZE]
+
+    existing_grades = {}
+    if rows:
+        existing_grades = {
+            grade.attempt_id: grade for grade in Grade.query.filter(
+                Grade.question_id == question.id,
+                Grade.attempt_id.in_([row[0] for row in rows])
+            )
+        }
+
+    similar = flags_for_attempts(question.id, [row[0] for row in rows])
+    answers = [
+        {
+            'attempt_id': attempt_id,
+            'student_name': full_name,
+            'student_answer': decode_answer(choice, choices, text) or 'No answer provided.',
+            'score': existing_grades[attempt_id].score if attempt_id in existing_grades else None,
+            'comments': existing_grades[attempt_id].comments if attempt_id in existing_grades else '',
+            'similar': similar.get(attempt_id, [])
+        }
+        for attempt_id, full_name, choice, choices, text in rows
+    ]
+    next_after = rows[-1][0] if has_next else None
+    next_url = None
+    if next_after is not None:
+        next_url = url_for('main.grade_by_question', exam_id=exam_id, question_id=question_id,
+                           after=next_after, ungraded=request.args.get('ungraded'))
+
+    return render_template('teacher/grade_by_question.html', title='Grade by Question',
+                           exam=exam, question=question, answers=answers,
+                           next_after=next_after, next_url=next_url, ungraded_only=ungraded_only)
+
+@bp.route('/teacher/grading/grades', methods=['POST'])
+@login_required
+@role_required('teacher')
+def save_grade_batch():
+    """
+    Saves many grades at once, e.g. one question across a page of attempts.
+    Expects {"grades": [{"attempt_id", "question_id", "score", "comments"}, ...]}.
+    """
+    payload = request.get_json(silent=True)
+    entries = payload.get('grades') if isinstance(payload, dict) else None
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+        return jsonify({'status': 'error', 'message': 'Expected {"grades": [...]} with one object per grade.'}), 400
+    error = find_grading_error(current_user.id, entries)
+    if error:
+        return jsonify({'status': 'error', 'message': error}), 400
+
+    saved = save_grades(current_user.id, entries)
+    db.session.commit()
+    return jsonify({'status': 'saved', 'saved': saved})
+
 @bp.route('/exam/<int:exam_id>')
 @login_required
 def exam(exam_id):
-    exam_data = Exam.query.get_or_404(exam_id)
+    exam_data = db.session.query(Exam.id, Exam.title, Exam.duration_minutes)\
+        .filter(Exam.id == exam_id, Exam.status == EXAM_ACTIVE).first_or_404()
+    # A candidate resuming an attempt keeps the paper they started on, and the clock
+    resumed = db.session.query(ExamAttempt.snapshot_digest, ExamAttempt.start_time).filter_by(
+        user_id=current_user.id, exam_id=exam_id, end_time=None
+    ).order_by(ExamAttempt.id.desc()).first()
+    paper = load_paper(resumed.snapshot_digest) if resumed and resumed.snapshot_digest else exam_paper(exam_id)[1]
+    if paper is None:
+        abort(404)
     duration_minutes = exam_data.duration_minutes
-    initial_hours = f"{duration_minutes // 60}".zfill(2)
-    initial_minutes = f"{duration_minutes % 60}".zfill(2)
+    remaining_seconds = duration_minutes * 60
+    if resumed is not None:
+        elapsed = (datetime.utcnow() - resumed.start_time).total_seconds()
+        remaining_seconds = max(0, int(remaining_seconds - elapsed))
+    initial_hours = f"{remaining_seconds // 3600}".zfill(2)
+    initial_minutes = f"{remaining_seconds % 3600 // 60}".zfill(2)
     exam_dict = {
         'id': exam_data.id,
         'title': exam_data.title,
         'duration_minutes': duration_minutes,
+        'remaining_seconds': remaining_seconds,
         'questions': [
             {
                 'id': q.id,
                 'text': q.text,
                 'type': q.question_type.value,
                 'options': q.options
-            } for q in exam_data.questions
+            } for q in paper
         ]
     }
     return render_template('exam_interface.html',
@@ -396,6 +761,102 @@ def exam(exam_id):
                            initial_hours=initial_hours,
                            initial_minutes=initial_minutes)
 
+def _open_attempt(exam_id):
+    """
+    Returns (attempt, deadline) for the current user's sitting of an exam:
+    their unsubmitted attempt, else one they submitted recently enough that
+    this request is a retry or a stray autosave, else a new attempt pinned
+    to the exam's current paper. Answers are accepted until the deadline:
+    the start time plus the exam's duration and SUBMIT_GRACE_SECONDS.
+    """
+    # Exams being deleted or archived are having their attempts moved out
+    exam_data = db.session.query(Exam.status, Exam.duration_minutes).filter(Exam.id == exam_id).first()
+    if exam_data is None or exam_data.status != EXAM_ACTIVE:
+        abort(404)
+    now = datetime.utcnow()
+    grace = timedelta(seconds=current_app.config['SUBMIT_GRACE_SECONDS'])
+    allowed = timedelta(minutes=exam_data.duration_minutes) + grace
+    attempt = ExamAttempt.query.filter_by(user_id=current_user.id, exam_id=exam_id)\
+        .order_by(ExamAttempt.id.desc()).first()
+    if attempt is not None:
+        deadline = attempt.start_time + allowed
+        # A submission stays final for at least the grace period, even if it came in late
+        if attempt.end_time is None or now <= max(deadline, attempt.end_time + grace):
+            return attempt, deadline
+    digest, _ = exam_paper(exam_id)
+    if digest is None:
+        abort(404)
+    attempt = ExamAttempt(user_id=current_user.id, exam_id=exam_id, snapshot_digest=digest)
+    db.session.add(attempt)
+    touch_attempts([(current_user.id, exam_id)])
+    return attempt, now + allowed
+
+def _report_activity(exam_id, event):
+    """Feeds the invigilation counters; they are advisory, so a busy store never fails the request."""
+    try:
+        invigilation.record(exam_id, current_user.school_id, current_user.id, event)
+    except sqlite3.Error:
+        current_app.logger.warning('Could not record invigilation activity for exam %s', exam_id, exc_info=True)
+
+def _merge_answers(attempt, submitted):
+    """Stores the submitted answers over the attempt's earlier ones, ignoring questions not on its paper."""
+    if attempt.id is None:
+        db.session.flush()
+    paper = load_paper(attempt.snapshot_digest) if attempt.snapshot_digest else exam_paper(attempt.exam_id)[1]
+    on_paper = {str(question.id) for question in paper}
+    store_answers(attempt.id, {
+        question_id: answer for question_id, answer in (submitted or {}).items() if str(question_id) in on_paper
+    })
+
+@bp.route('/exam/<int:exam_id>/answers', methods=['POST'])
+@login_required
+def save_answers(exam_id):
+    attempt, deadline = _open_attempt(exam_id)
+    if attempt.end_time is not None:
+        return jsonify({'status': 'error', 'message': 'This exam has already been submitted.',
+                        'attempt_id': attempt.id}), 409
+    if datetime.utcnow() > deadline:
+        return jsonify({'status': 'error', 'message': 'Time is up. Submit the exam to finish.',
+                        'attempt_id': attempt.id}), 409
+    started = attempt.id is None
+    _merge_answers(attempt, (request.get_json(silent=True) or {}).get('answers'))
+    db.session.commit()
+    _report_activity(exam_id, EVENT_START if started else EVENT_HEARTBEAT)
+    return jsonify({'status': 'saved', 'attempt_id': attempt.id})
+
+@bp.route('/exam/<int:exam_id>/submit', methods=['POST'])
+@login_required
+def submit_exam(exam_id):
+    attempt, deadline = _open_attempt(exam_id)
+    if attempt.end_time is not None:
+        # A retried submit (double click, lost response) gets the same answer back
+        return jsonify({'status': 'submitted', 'attempt_id': attempt.id,
+                        'redirect': url_for('main.dashboard')})
+    now = datetime.utcnow()
+    late = now > deadline
+    if not late:
+        _merge_answers(attempt, (request.get_json(silent=True) or {}).get('answers'))
+    # A late submission still closes the attempt, scored on the answers saved in time
+    answers = load_answers([attempt.id])[attempt.id]
+    attempt.end_time = now
+    if attempt.snapshot_digest is None:
+        attempt.snapshot_digest = exam_paper(exam_id)[0]
+    # Objective-only exams are scored straight away; anything with essay or
+    # short answer questions waits in the teacher's grading queue.
+    attempt.score = compute_score(load_paper(attempt.snapshot_digest), answers)
+    update_subject_aggregates([(exam_id, None, attempt.score)])
+    update_score_histograms([(exam_id, current_user.school_id, None, attempt.score)])
+    update_leaderboards([attempt.id])
+    touch_attempts([(current_user.id, exam_id)])
+    db.session.commit()
+    _report_activity(exam_id, EVENT_SUBMIT)
+    if late:
+        return jsonify({'status': 'late', 'attempt_id': attempt.id, 'redirect': url_for('main.dashboard'),
+                        'message': 'Time ran out before this submission arrived; the answers saved in time '
+                                   'were submitted.'}), 409
+    return jsonify({'status': 'submitted', 'attempt_id': attempt.id,
+                    'redirect': url_for('main.dashboard')})
+
 # --- Placeholder Routes ---
 @bp.route('/results')
 @login_required
@@ -410,6 +871,7 @@ def settings():
             user = User.query.get(current_user.id)
             user.full_name = request.form.get('full_name')
             user.email = request.form.get('email')
+            touch(user_scope(user.id))
             db.session.commit()
             flash('Your profile has been updated successfully.', 'success')
         elif request.form.get('form_type') == 'password':
@@ -432,6 +894,21 @@ def student_practice():
         subject = request.form.get('subject')
         num_questions = int(request.form.get('num_questions'))
 
+        if request.form.get('mode') == 'adaptive':
+            if not len(get_table(subject)):
+                flash(f'No multiple choice questions are available for {subject} yet.', 'warning')
+                return redirect(url_for('main.student_practice'))
+            prior = starting_ability(current_user.id, subject)
+            session['adaptive'] = {
+                'subject': subject,
+                'length': num_questions,
+                'prior': prior,
+                'theta': prior,
+                'current': get_table(subject).select(prior),
+                'items': []  # [question_id, a, b, correct, answer]
+            }
+            return redirect(url_for('main.adaptive_practice'))
+
         questions = Question.query.filter_by(subject=subject).order_by(func.random()).limit(num_questions).all()
 
         if len(questions) < num_questions:
@@ -445,15 +922,93 @@ def student_practice():
             created_by=current_user.id
         )
         practice_exam.questions.extend(questions)
-
         db.session.add(practice_exam)
+        pin_exam(practice_exam, questions)
+        touch(EXAMS_SCOPE)
         db.session.commit()
 
         flash('Your practice session is ready. Good luck!', 'success')
         return redirect(url_for('main.exam', exam_id=practice_exam.id))
 
-    subjects = [s[0] for s in db.session.query(Question.subject).distinct().all()]
-    return render_template('student/practice_view.html', title='Practice View', subjects=subjects)
+    return render_template('student/practice_view.html', title='Practice View', subjects=catalog_subjects())
+
+@bp.route('/student/practice/adaptive', methods=['GET', 'POST'])
+@login_required
+def adaptive_practice():
+    state = session.get('adaptive')
+    if not state or state['current'] is None:
+        return redirect(url_for('main.student_practice'))
+
+    table = get_table(state['subject'])
+    question = db.session.get(Question, state['current'])
+    if question is None or state['current'] not in table.index:
+        session.pop('adaptive', None)
+        flash('The question bank changed during your session. Please start again.', 'warning')
+        return redirect(url_for('main.student_practice'))
+
+    if request.method == 'POST':
+        if question.question_type == QuestionType.MCQ_MULTIPLE:
+            answer = request.form.getlist('answer')
+        else:
+            answer = request.form.get('answer')
+        a, b = table.parameters(question.id)
+        state['items'].append([question.id, a, b, is_correct(question, answer), answer])
+        theta, standard_error = estimate_ability([(a, b, c) for _, a, b, c, _ in state['items']],
+                                                 prior_mean=state['prior'])
+        state['theta'] = theta
+
+        seen = {item[0] for item in state['items']}
+        finished = len(state['items']) >= state['length'] or standard_error <= TARGET_STANDARD_ERROR
+        state['current'] = None if finished else table.select(theta, exclude=seen)
+        session['adaptive'] = state
+
+        if state['current'] is None:
+            return _finish_adaptive_practice(state, standard_error)
+        return redirect(url_for('main.adaptive_practice'))
+
+    return render_template('student/adaptive_practice.html', title='Adaptive Practice',
+                           subject=state['subject'], question=question,
+                           number=len(state['items']) + 1, length=state['length'])
+
+def _finish_adaptive_practice(state, standard_error):
+    """Records a finished adaptive session as a practice exam and attempt."""
+    session.pop('adaptive', None)
+    question_ids = [item[0] for item in state['items']]
+    correct = sum(1 for item in state['items'] if item[3])
+
+    practice_exam = Exam(
+        title=f"Adaptive Practice: {state['subject']}",
+        subject=state['subject'],
+        duration_minutes=int(len(question_ids) * 1.5),
+        created_by=current_user.id
+    )
+    practice_exam.questions.extend(Question.query.filter(Question.id.in_(question_ids)).all())
+    db.session.add(practice_exam)
+    pin_exam(practice_exam, practice_exam.questions)
+    db.session.flush()
+
+    now = datetime.utcnow()
+    score = round(correct * 100.0 / len(question_ids), 2)
+    update_subject_aggregates([(practice_exam.id, None, score)])
+    update_score_histograms([(practice_exam.id, current_user.school_id, None, score)])
+    attempt = ExamAttempt(
+        user_id=current_user.id,
+        exam_id=practice_exam.id,
+        start_time=now,
+        end_time=now,
+        score=score,
+        snapshot_digest=practice_exam.snapshot_digest
+    )
+    db.session.add(attempt)
+    db.session.flush()
+    store_answers(attempt.id, {str(item[0]): item[4] for item in state['items']})
+    save_ability(current_user.id, state['subject'], state['theta'], standard_error, len(question_ids))
+    touch(EXAMS_SCOPE, user_scope(current_user.id))
+    db.session.commit()
+
+    flash(f'Practice complete: {correct} of {len(question_ids)} correct. '
+          f'Your {state["subject"]} ability estimate is {state["theta"]:+.2f}.', 'success')
+    return redirect(url_for('main.dashboard'))
 
 @bp.route('/student/mock-exams')
 @login_required
@@ -461,7 +1016,8 @@ def student_mock_exams():
     attempted_exams = ExamAttempt.query.filter_by(user_id=current_user.id).all()
     attempted_exam_ids = [attempt.exam_id for attempt in attempted_exams]
 
-    available_exams = Exam.query.filter(~Exam.id.in_(attempted_exam_ids)).order_by(Exam.creation_date.desc()).all()
+    available_exams = Exam.query.filter(~Exam.id.in_(attempted_exam_ids), Exam.status == EXAM_ACTIVE)\
+                                .order_by(Exam.creation_date.desc()).all()
 
     exams_data = [
         {
@@ -475,30 +1031,96 @@ def student_mock_exams():
 
     return render_template('student/mock_exams.html', title='Mock Exams', exams=exams_data)
 
+PAST_QUESTIONS_PAGE_SIZE = 20
+
+LEADERBOARD_SIZE = 10
+
+@bp.route('/leaderboard/exam/<int:exam_id>')
+@login_required
+def exam_leaderboard(exam_id):
+    exam = db.session.query(Exam.id, Exam.title, Exam.created_by).filter(Exam.id == exam_id).first()
+    if exam is None or db.session.get(User, exam.created_by).role == UserRole.STUDENT:
+        abort(404)
+    return _leaderboard_page(exam_board(exam.id), exam.title)
+
+@bp.route('/leaderboard/subject/<path:subject>')
+@login_required
+def subject_leaderboard(subject):
+    return _leaderboard_page(subject_board(subject), subject)
+
+def _leaderboard_page(board, heading):
+    """The current user's standing on a board, with the top scores in their centre and nationally."""
+    school_id = current_user.school_id
+    best = best_entry(board, current_user.id)
+    return render_template('student/leaderboard.html', title=f'Leaderboard: {heading}', heading=heading,
+                           best=best,
+                           national=standing(board, best, NATIONAL) if best is not None else None,
+                           centre=standing(board, best, school_id) if best is not None and school_id else None,
+                           national_top=top(board, limit=LEADERBOARD_SIZE),
+                           centre_top=top(board, school_id, limit=LEADERBOARD_SIZE) if school_id else None)
+
 @bp.route('/student/past-questions')
 @login_required
 def student_past_questions():
-    subjects = [s[0] for s in db.session.query(Question.subject).distinct().all()]
-
+    catalog = subject_catalog()
     selected_subject = request.args.get('subject', '')
-
-    query = Question.query
+    selected_topic = request.args.get('topic', '')
+    after = request.args.get('after', type=int)
+
+    # Keyset pagination on the primary key; explanations are fetched on demand
+    query = db.session.query(
+        Question.id, Question.text, Question.subject, Question.topic,
+        Question.explanation.isnot(None).label('has_explanation')
+    )
     if selected_subject:
-        query = query.filter_by(subject=selected_subject)
-
-    questions = query.order_by(Question.subject, Question.id).all()
-
+        query = query.filter(Question.subject == selected_subject)
+        if selected_topic:
+            query = query.filter(Question.topic == selected_topic)
+    if after is not None:
+        query = query.filter(Question.id > after)
+    questions = query.order_by(Question.id).limit(PAST_QUESTIONS_PAGE_SIZE + 1).all()
+    next_after = questions[PAST_QUESTIONS_PAGE_SIZE - 1].id if len(questions) > PAST_QUESTIONS_PAGE_SIZE else None
+
+    topics = next((entry['topics'] for entry in catalog if entry['subject'] == selected_subject), [])
     return render_template('student/past_questions.html',
                            title='Past Questions',
-                           questions=questions,
-                           subjects=subjects,
-                           selected_subject=selected_subject)
+                           questions=questions[:PAST_QUESTIONS_PAGE_SIZE],
+                           catalog=catalog,
+                           topics=topics,
+                           selected_subject=selected_subject,
+                           selected_topic=selected_topic,
+                           paged=after is not None,
+                           next_after=next_after)
+
+@bp.route('/student/past-questions/<int:question_id>/explanation')
+@login_required
+def past_question_explanation(question_id):
+    explanation = db.session.query(Question.explanation).filter(Question.id == question_id).first_or_404()[0]
+    return jsonify({'id': question_id, 'explanation': explanation})
+
+RESOURCES_PAGE_SIZE = 20
 
 @bp.route('/student/resources')
 @login_required
 def student_resources():
-    resources = Resource.query.order_by(Resource.creation_date.desc()).all()
-    return render_template('student/resources.html', title='Resources', resources=resources)
+    before = request.args.get('before', type=int)
+    recommended = []
+    if before is None:
+        # Ranked nightly from the student's weak topics (app.recommendations): one range read of their rows
+        recommended = db.session.query(Resource, ResourceRecommendation.answered, ResourceRecommendation.correct)\
+            .join(ResourceRecommendation, ResourceRecommendation.resource_id == Resource.id)\
+            .filter(ResourceRecommendation.user_id == current_user.id)\
+            .order_by(ResourceRecommendation.position).all()
+
+    # The rest of the library, newest first, a page at a time on the primary key
+    query = Resource.query
+    if before is not None:
+        query = query.filter(Resource.id < before)
+    resources = query.order_by(Resource.id.desc()).limit(RESOURCES_PAGE_SIZE + 1).all()
+    next_before = resources[RESOURCES_PAGE_SIZE - 1].id if len(resources) > RESOURCES_PAGE_SIZE else None
+    return render_template('student/resources.html', title='Resources', recommended=recommended,
+                           resources=resources[:RESOURCES_PAGE_SIZE], paged=before is not None,
+                           next_before=next_before)
 
 @bp.route('/teacher/exams')
 @login_required
@@ -513,7 +1135,8 @@ def teacher_exams():
             'title': exam.title,
             'subject': exam.subject,
             'question_count': len(exam.questions),
-            'creation_date': exam.creation_date
+            'creation_date': exam.creation_date,
+            'status': exam.status
         })
 
     return render_template('teacher/manage_exams.html', title='Manage Exams', exams=exams_data)
@@ -526,12 +1149,188 @@ def delete_exam(exam_id):
     if exam.created_by != current_user.id:
         abort(403)
 
-    ExamAttempt.query.filter_by(exam_id=exam.id).delete()
-    db.session.delete(exam)
-    db.session.commit()
-    flash('Exam has been deleted successfully.', 'success')
+    # Attempts, grades and answers go in chunks from a background job; the exam is hidden meanwhile
+    if start_exam_deletion(exam, created_by=current_user.id) is None:
+        flash('This exam is already being deleted.', 'info')
+    else:
+        db.session.commit()
+        flash('The exam has been removed. Its attempts and results are being deleted in the background.', 'success')
     return redirect(url_for('main.teacher_exams'))
 
+SITTING_HOURS = 12
+
+@bp.route('/invigilate')
+@login_required
+@role_required('admin', 'teacher')
+def invigilation_index():
+    """Exams candidates have started in the last SITTING_HOURS hours."""
+    author = db.aliased(User)
+    query = db.session.query(
+        Exam.id, Exam.title, Exam.subject, func.count(ExamAttempt.id), func.count(ExamAttempt.end_time),
+        func.max(ExamAttempt.start_time)
+    ).join(ExamAttempt, ExamAttempt.exam_id == Exam.id)\
+     .join(author, author.id == Exam.created_by)\
+     .filter(ExamAttempt.start_time >= datetime.utcnow() - timedelta(hours=SITTING_HOURS),
+             author.role != UserRole.STUDENT, Exam.status == EXAM_ACTIVE)
+    if current_user.role == UserRole.TEACHER:
+        query = query.filter(Exam.created_by == current_user.id)
+    sittings = [
+        {'id': exam_id, 'title': title, 'subject': subject, 'started': started, 'submitted': submitted,
+         'latest': latest}
+        for exam_id, title, subject, started, submitted, latest in
+        query.group_by(Exam.id, Exam.title, Exam.subject).order_by(func.max(ExamAttempt.start_time).desc())
+    ]
+    return render_template('invigilation.html', title='Invigilation', sittings=sittings, hours=SITTING_HOURS)
+
+def _invigilated_exam(exam_id):
+    exam = db.session.query(Exam.id, Exam.title, Exam.subject, Exam.created_by)\
+        .filter(Exam.id == exam_id).first_or_404()
+    if current_user.role == UserRole.TEACHER and exam.created_by != current_user.id:
+        abort(403)
+    return exam
+
+@bp.route('/invigilate/exam/<int:exam_id>')
+@login_required
+@role_required('admin', 'teacher')
+def invigilate_exam(exam_id):
+    exam = _invigilated_exam(exam_id)
+    schools = db.session.query(School.id, School.name).order_by(School.name).all()
+    return render_template('invigilation_exam.html', title=f'Invigilating {exam.title}', exam=exam,
+                           schools=schools, school_id=request.args.get('school_id', type=int),
+                           busy_retry=BUSY_RETRY)
+
+@bp.route('/invigilate/exam/<int:exam_id>/events')
+@login_required
+@role_required('admin', 'teacher')
+def invigilation_events(exam_id):
+    _invigilated_exam(exam_id)
+    if not invigilation.is_seeded(exam_id):
+        # Once per exam: candidates who started before the counters were being kept (latest attempt first)
+        invigilation.seed(exam_id, db.session.query(
+            ExamAttempt.user_id, User.school_id, ExamAttempt.start_time, ExamAttempt.end_time
+        ).join(User, User.id == ExamAttempt.user_id)
+         .filter(ExamAttempt.exam_id == exam_id).order_by(ExamAttempt.id.desc()).all())
+    school_id = request.args.get('school_id', type=int)
+    if not invigilation.claim_stream():
+        # Every stream slot in this worker is taken; the page tries again later
+        return Response(f'retry: {BUSY_RETRY * 1000}\n\n', status=503, mimetype='text/event-stream',
+                        headers={'Retry-After': str(BUSY_RETRY), 'Cache-Control': 'no-cache'})
+    # The stream is long-lived and needs no database connection
+    db.session.remove()
+    response = Response(stream_with_context(invigilation.stream(exam_id, school_id)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Released when the server closes the response, even if the stream never started
+    response.call_on_close(invigilation.release_stream)
+    return response
+
+def _results_response(filename, exam_id=None, school_id=None):
+    """Streams a results CSV, gzip-compressed when ?gzip=1 is given."""
+    chunks = export_csv(exam_id=exam_id, school_id=school_id)
+    mimetype = 'text/csv'
+    if request.args.get('gzip') == '1':
+        chunks = gzip_stream(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@bp.route('/teacher/exam/<int:exam_id>/results.csv')
+@login_required
+@role_required('teacher')
+def export_exam_results(exam_id):
+    created_by = db.session.query(Exam.created_by).filter(Exam.id == exam_id).scalar()
+    if created_by is None:
+        abort(404)
+    if created_by != current_user.id:
+        abort(403)
+    return _results_response(f'exam-{exam_id}-results.csv', exam_id=exam_id)
+
+@bp.route('/admin/centre/<int:school_id>/results.csv')
+@login_required
+@role_required('admin')
+def export_centre_results(school_id):
+    school = School.query.get_or_404(school_id)
+    return _results_response(f'centre-{school.id}-results.csv', school_id=school.id,
+                             exam_id=request.args.get('exam_id', type=int))
+
+def _uploaded_blob():
+    """
+    The stored file for a resource form: a finished chunked upload (sent as
+    upload_sha256 by uploads.js) or a plain file field. Returns (Blob, name)
+    or (None, None).
+    """
+    sha256 = request.form.get('upload_sha256')
+    if sha256:
+        blob = db.session.get(Blob, sha256)
+        if blob is not None:
+            return blob, request.form.get('file_name')
+    file = request.files.get('file')
+    if file and file.filename != '':
+        return store_file(file.stream, file.filename), file.filename
+    return None, None
+
+def _own_upload(upload_id):
+    upload = UploadSession.query.get_or_404(upload_id)
+    if upload.user_id != current_user.id:
+        abort(403)
+    return upload
+
+@bp.route('/media/<filename>')
+@login_required
+def media(filename):
+    blob = db.session.get(Blob, filename.split('.', 1)[0])
+    if blob is None or blob.filename != filename:
+        abort(404)
+    return serve_blob(blob)
+
+@bp.route('/uploads', methods=['POST'])
+@login_required
+@role_required('teacher', 'admin')
+def start_chunked_upload():
+    payload = request.get_json(silent=True) or {}
+    try:
+        upload, blob = start_upload(current_user.id, payload.get('filename') or 'upload',
+                                    payload.get('size'), payload.get('sha256'))
+    except UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    db.session.commit()
+    if blob is not None:
+        # Already stored: nothing to send
+        return jsonify({'complete': True, 'sha256': blob.sha256, 'size': blob.size})
+    return jsonify({'upload_id': upload.id, 'offset': 0, 'size': upload.size}), 201
+
+@bp.route('/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_offset(upload_id):
+    upload = _own_upload(upload_id)
+    return jsonify({'upload_id': upload.id, 'offset': upload.received, 'size': upload.size})
+
+@bp.route('/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    upload = _own_upload(upload_id)
+    try:
+        offset = int(request.args.get('offset', ''))
+        write_chunk(upload, offset, request.stream, request.content_length)
+    except ValueError:
+        return jsonify({'error': 'An integer offset is required.', 'offset': upload.received}), 400
+    except UploadError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e), 'offset': upload.received}), 409
+    db.session.commit()
+    return jsonify({'upload_id': upload.id, 'offset': upload.received, 'size': upload.size})
+
+@bp.route('/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_chunked_upload(upload_id):
+    upload = _own_upload(upload_id)
+    try:
+        blob = complete_upload(upload)
+    except UploadError as e:
+        return jsonify({'error': str(e), 'offset': upload.received}), 409
+    db.session.commit()
+    return jsonify({'complete': True, 'sha256': blob.sha256, 'size': blob.size})
+
 @bp.route('/teacher/resources', methods=['GET', 'POST'])
 @login_required
 @role_required('teacher', 'admin')
@@ -540,32 +1339,35 @@ def manage_resources():
         title = request.form.get('title')
         description = request.form.get('description')
         subject = request.form.get('subject')
+        topic = (request.form.get('topic') or '').strip() or None
         resource_type_str = request.form.get('resource_type')
         resource_type = ResourceType[resource_type_str]
         link = request.form.get('link')
-        file = request.files.get('file')
 
         final_link = link
+        blob, file_name = None, None
         if resource_type in [ResourceType.PDF, ResourceType.VIDEO]:
-            if file and file.filename != '':
-                filename = secure_filename(file.filename)
-                upload_folder = os.path.join(current_app.root_path, 'static/uploads')
-                file.save(os.path.join(upload_folder, filename))
-                final_link = url_for('static', filename=f'uploads/{filename}')
-            else:
+            blob, file_name = _uploaded_blob()
+            if blob is None:
                 flash('A file is required for this resource type.', 'danger')
                 return redirect(url_for('main.manage_resources'))
+            final_link = blob_url(blob)
 
         new_resource = Resource(
             title=title,
             description=description,
             subject=subject,
+            topic=topic,
             resource_type=resource_type,
             link=final_link,
+            blob_sha256=blob.sha256 if blob else None,
+            file_name=file_name,
             uploaded_by=current_user.id
         )
 
         db.session.add(new_resource)
+        if blob is not None:
+            add_reference(blob)
         db.session.commit()
         flash('Resource added successfully!', 'success')
         return redirect(url_for('main.manage_resources'))
@@ -581,16 +1383,22 @@ def delete_resource(resource_id):
     if resource.uploaded_by != current_user.id and current_user.role != UserRole.ADMIN:
         abort(403)
 
-    if resource.resource_type in [ResourceType.PDF, ResourceType.VIDEO]:
+    blob_sha256 = resource.blob_sha256
+    if blob_sha256 is None and resource.resource_type in [ResourceType.PDF, ResourceType.VIDEO]:
+        # Uploaded before content-addressed storage; the file belongs to this resource alone
         try:
             filename = os.path.basename(resource.link)
-            file_path = os.path.join(current_app.root_path, 'static/uploads', filename)
+            file_path = os.path.join(static_upload_folder(), filename)
             if os.path.exists(file_path):
                 os.remove(file_path)
         except Exception as e:
             flash(f'Error deleting file: {e}', 'danger')
 
+    forget_resource(resource.id)
     db.session.delete(resource)
+    db.session.flush()
+    # The file itself is removed only when no other resource uses it
+    release(blob_sha256)
     db.session.commit()
     flash('Resource deleted successfully.', 'success')
     return redirect(url_for('main.manage_resources'))
@@ -607,34 +1415,42 @@ def edit_resource(resource_id):
         resource.title = request.form.get('title')
         resource.description = request.form.get('description')
         resource.subject = request.form.get('subject')
+        resource.topic = (request.form.get('topic') or '').strip() or None
 
         resource_type_str = request.form.get('resource_type')
         resource_type = ResourceType[resource_type_str]
         resource.resource_type = resource_type
 
         link = request.form.get('link')
-        file = request.files.get('file')
+        old_blob_sha256 = resource.blob_sha256
 
         if resource_type in [ResourceType.PDF, ResourceType.VIDEO]:
-            if file and file.filename != '':
-                # Delete old file if it exists
-                if resource.link and 'uploads' in resource.link:
+            blob, file_name = _uploaded_blob()
+            if blob is not None:
+                # Delete old file if it was uploaded before content-addressed storage
+                if old_blob_sha256 is None and resource.link and 'uploads' in resource.link:
                     try:
                         old_filename = os.path.basename(resource.link)
-                        old_file_path = os.path.join(current_app.root_path, 'static/uploads', old_filename)
+                        old_file_path = os.path.join(static_upload_folder(), old_filename)
                         if os.path.exists(old_file_path):
                             os.remove(old_file_path)
                     except Exception as e:
                         flash(f'Could not delete old file: {e}', 'warning')
 
-                # Save new file
-                filename = secure_filename(file.filename)
-                upload_folder = os.path.join(current_app.root_path, 'static/uploads')
-                file.save(os.path.join(upload_folder, filename))
-                resource.link = url_for('static', filename=f'uploads/{filename}')
+                resource.link = blob_url(blob)
+                resource.blob_sha256 = blob.sha256
+                resource.file_name = file_name
+                # Re-uploading the same file keeps the reference the resource already holds
+                if blob.sha256 != old_blob_sha256:
+                    add_reference(blob)
         else:
             resource.link = link
+            resource.blob_sha256 = None
+            resource.file_name = None
 
+        if resource.blob_sha256 != old_blob_sha256:
+            db.session.flush()
+            release(old_blob_sha256)
         db.session.commit()
         flash('Resource updated successfully!', 'success')
         return redirect(url_for('main.manage_resources'))
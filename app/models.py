@@ -4,6 +4,7 @@ from app.extensions import db, login_manager
 from itsdangerous.url_safe import URLSafeTimedSerializer
 from flask import current_app
 import enum
+import uuid
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -65,6 +66,13 @@ class QuestionType(enum.Enum):
     COMPREHENSION = 'comprehension'
 
 class Question(db.Model):
+    __table_args__ = (
+        # Keyset pagination of the bank within a subject
+        db.Index('ix_question_subject_id', 'subject', 'id'),
+        # Exam blueprint pools
+        db.Index('ix_question_subject_topic_difficulty', 'subject', 'topic', 'difficulty', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.Text, nullable=False) # Can store HTML for rich formatting
     question_type = db.Column(db.Enum(QuestionType), nullable=False)
@@ -81,6 +89,15 @@ class Question(db.Model):
     def __repr__(self):
         return f'<Question {self.id}>'
 
+# Changes to these columns alter what candidates see or how they are scored
+VERSIONED_QUESTION_FIELDS = ('text', 'question_type', 'options', 'answer', 'explanation', 'max_score')
+
+@db.event.listens_for(Question, 'before_update')
+def _bump_question_version(mapper, connection, target):
+    state = db.inspect(target)
+    if any(state.attrs[field].history.has_changes() for field in VERSIONED_QUESTION_FIELDS):
+        target.version = (target.version or 1) + 1
+
 # Association table for the many-to-many relationship between Exam and Question
 exam_questions = db.Table('exam_questions',
     db.Column('exam_id', db.Integer, db.ForeignKey('exam.id'), primary_key=True),
@@ -94,20 +111,46 @@ class Exam(db.Model):
     duration_minutes = db.Column(db.Integer, nullable=False)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) # Teacher ID
     creation_date = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+    snapshot_digest = db.Column(db.String(64), db.ForeignKey('exam_snapshot.digest'), nullable=True) # Pinned paper
+    status = db.Column(db.String(20), nullable=False, default='active', server_default='active',
+                       index=True) # active, deleting, archived; only active exams can be sat
     questions = db.relationship('Question', secondary=exam_questions, lazy='subquery',
                                 backref=db.backref('exams', lazy=True))
 
     def __repr__(self):
         return f'<Exam {self.title}>'
 
+class QuestionSnapshot(db.Model):
+    """An immutable version of a question, keyed by the SHA-256 of its content."""
+    digest = db.Column(db.String(64), primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), nullable=False, index=True)
+    version = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.LargeBinary, nullable=False) # zlib-compressed JSON
+    created_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+
+    def __repr__(self):
+        return f'<QuestionSnapshot {self.question_id} v{self.version}>'
+
+class ExamSnapshot(db.Model):
+    """A frozen question paper: the ordered question snapshots pre-assembled into one blob."""
+    digest = db.Column(db.String(64), primary_key=True)
+    question_digests = db.Column(db.JSON, nullable=False)
+    payload = db.Column(db.LargeBinary, nullable=False) # zlib-compressed JSON list of questions
+    created_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+
+    def __repr__(self):
+        return f'<ExamSnapshot {self.digest[:12]}>'
+
 class ExamAttempt(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id'), nullable=False)
+    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id'), nullable=False, index=True)
     start_time = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
     end_time = db.Column(db.DateTime, nullable=True)
     score = db.Column(db.Float, nullable=True)
-    answers = db.Column(db.JSON, nullable=True) # Stores student's answers: {question_id: answer}
+    sync_key = db.Column(db.String(32), unique=True, nullable=True,
+                         default=lambda: uuid.uuid4().hex) # Identifies the attempt across centre syncs
+    snapshot_digest = db.Column(db.String(64), db.ForeignKey('exam_snapshot.digest'), nullable=True) # Paper sat
 
     user = db.relationship('User', backref='attempts')
     exam = db.relationship('Exam', backref='attempts')
@@ -115,7 +158,41 @@ class ExamAttempt(db.Model):
     def __repr__(self):
         return f'<ExamAttempt {self.id} by User {self.user_id}>'
 
+class AttemptAnswer(db.Model):
+    """One answer in an attempt; app.answers describes the encoding."""
+    # Per-question reads (grading a question, item statistics) are range scans
+    __table_args__ = (db.Index('ix_attempt_answer_question_attempt', 'question_id', 'attempt_id'),)
+
+    attempt_id = db.Column(db.Integer, db.ForeignKey('exam_attempt.id'), primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), primary_key=True)
+    choice = db.Column(db.SmallInteger, nullable=True) # Option index of a single choice
+    choices = db.Column(db.BigInteger, nullable=True) # Bitmask of option indices of a multiple choice
+    text = db.Column(db.Text, nullable=True) # Any other answer
+
+    def __repr__(self):
+        return f'<AttemptAnswer Attempt {self.attempt_id} Question {self.question_id}>'
+
+class ArchivedAttempt(db.Model):
+    """An attempt moved out of exam_attempt by archival, with its answers and grades packed into one blob."""
+    id = db.Column(db.Integer, primary_key=True)
+    attempt_id = db.Column(db.Integer, nullable=False) # The original ExamAttempt id
+    sync_key = db.Column(db.String(32), nullable=True, index=True) # Keeps centre bundle imports from restoring it
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id'), nullable=False, index=True)
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=True)
+    score = db.Column(db.Float, nullable=True)
+    snapshot_digest = db.Column(db.String(64), db.ForeignKey('exam_snapshot.digest'), nullable=True)
+    payload = db.Column(db.LargeBinary, nullable=False) # zlib-compressed JSON: answers and grades
+    archived_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+
+    def __repr__(self):
+        return f'<ArchivedAttempt {self.attempt_id} by User {self.user_id}>'
+
 class Grade(db.Model):
+    # One grade per question per attempt, so batches can be upserted
+    __table_args__ = (db.UniqueConstraint('attempt_id', 'question_id', name='uq_grade_attempt_question'),)
+
     id = db.Column(db.Integer, primary_key=True)
     attempt_id = db.Column(db.Integer, db.ForeignKey('exam_attempt.id'), nullable=False)
     question_id = db.Column(db.Integer, db.ForeignKey('question.id'), nullable=False)
@@ -130,6 +207,122 @@ class Grade(db.Model):
     def __repr__(self):
         return f'<Grade for Attempt {self.attempt_id} on Question {self.question_id}>'
 
+class ItemParameter(db.Model):
+    """Calibrated 2PL IRT parameters for an objective question."""
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), primary_key=True)
+    subject = db.Column(db.String(100), nullable=False, index=True)
+    discrimination = db.Column(db.Float, nullable=False) # a
+    difficulty = db.Column(db.Float, nullable=False) # b, on the ability scale
+    responses = db.Column(db.Integer, nullable=False) # Responses used for the calibration
+    calibrated_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+
+    def __repr__(self):
+        return f'<ItemParameter Question {self.question_id} a={self.discrimination:.2f} b={self.difficulty:.2f}>'
+
+class StudentAbility(db.Model):
+    """A student's current IRT ability estimate in one subject."""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    subject = db.Column(db.String(100), primary_key=True)
+    theta = db.Column(db.Float, nullable=False, default=0.0)
+    standard_error = db.Column(db.Float, nullable=False, default=1.0)
+    responses = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+
+    def __repr__(self):
+        return f'<StudentAbility User {self.user_id} {self.subject} theta={self.theta:.2f}>'
+
+class AnswerSignature(db.Model):
+    """MinHash signature of one attempt's answer to an essay/short answer question."""
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), primary_key=True)
+    attempt_id = db.Column(db.Integer, db.ForeignKey('exam_attempt.id'), primary_key=True)
+    signature = db.Column(db.LargeBinary, nullable=False) # Empty for answers too short to compare
+
+    def __repr__(self):
+        return f'<AnswerSignature Question {self.question_id} Attempt {self.attempt_id}>'
+
+class SimilarityFlag(db.Model):
+    """A pair of attempts whose answers to the same question are near-duplicates."""
+    __table_args__ = (db.UniqueConstraint('question_id', 'attempt_id', 'other_attempt_id',
+                                          name='uq_similarity_flag_pair'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), nullable=False)
+    attempt_id = db.Column(db.Integer, db.ForeignKey('exam_attempt.id'), nullable=False) # Lower id of the pair
+    other_attempt_id = db.Column(db.Integer, db.ForeignKey('exam_attempt.id'), nullable=False, index=True)
+    similarity = db.Column(db.Float, nullable=False) # Estimated Jaccard similarity
+    created_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+
+    def __repr__(self):
+        return f'<SimilarityFlag {self.attempt_id}~{self.other_attempt_id} on Question {self.question_id}>'
+
+class SubjectAggregate(db.Model):
+    """Running score totals per teacher and subject, kept in step with ExamAttempt.score."""
+    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True) # Exam author
+    subject = db.Column(db.String(100), primary_key=True)
+    scored_attempts = db.Column(db.Integer, nullable=False, default=0)
+    score_sum = db.Column(db.Float, nullable=False, default=0.0)
+
+    def __repr__(self):
+        return f'<SubjectAggregate {self.teacher_id} {self.subject}>'
+
+class ScoreHistogram(db.Model):
+    """Scored attempts per 1-point score bin, per exam and candidate centre; see app.distributions."""
+    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id'), primary_key=True)
+    school_id = db.Column(db.Integer, primary_key=True) # 0 for candidates without a centre
+    bin = db.Column(db.SmallInteger, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<ScoreHistogram Exam {self.exam_id} School {self.school_id} Bin {self.bin}>'
+
+class LeaderboardEntry(db.Model):
+    """A scored attempt on an exam or subject leaderboard; app.leaderboards keeps these in step."""
+    # Top N of the country or of one centre is a range read in score order
+    __table_args__ = (
+        db.Index('ix_leaderboard_entry_board_score', 'board', 'score'),
+        db.Index('ix_leaderboard_entry_board_school_score', 'board', 'school_id', 'score'),
+        db.Index('ix_leaderboard_entry_user_board', 'user_id', 'board'),
+    )
+
+    board = db.Column(db.String(120), primary_key=True) # 'exam:<id>' or 'subject:<name>'
+    attempt_id = db.Column(db.Integer, db.ForeignKey('exam_attempt.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    school_id = db.Column(db.Integer, db.ForeignKey('school.id'), nullable=True) # Candidate's centre when scored
+    score = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f'<LeaderboardEntry {self.board} Attempt {self.attempt_id}>'
+
+class RankNode(db.Model):
+    """A node of a board's Fenwick tree of score counts, per centre; school_id 0 is the whole country."""
+    board = db.Column(db.String(120), primary_key=True)
+    school_id = db.Column(db.Integer, primary_key=True)
+    node = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<RankNode {self.board} {self.school_id} {self.node}>'
+
+class Job(db.Model):
+    """A background job, processed in resumable chunks by `flask jobs work`."""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    params = db.Column(db.JSON, nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True) # queued, running, done, failed
+    cursor = db.Column(db.JSON, nullable=True) # Where to resume, committed with each chunk
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    worker = db.Column(db.String(100), nullable=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+    started_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind} {self.status}>'
+
 class AuditLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -147,17 +340,57 @@ class ResourceType(enum.Enum):
     VIDEO = 'video'
     LINK = 'link'
 
+class Blob(db.Model):
+    """An uploaded file, stored once under the SHA-256 of its content."""
+    sha256 = db.Column(db.String(64), primary_key=True)
+    filename = db.Column(db.String(80), nullable=False) # Name in the upload folder: <sha256><extension>
+    size = db.Column(db.BigInteger, nullable=False)
+    content_type = db.Column(db.String(100), nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0) # Resources using this file
+    created_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+
+    def __repr__(self):
+        return f'<Blob {self.sha256[:12]} refs={self.ref_count}>'
+
+class UploadSession(db.Model):
+    """A chunked upload in progress."""
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    received = db.Column(db.BigInteger, nullable=False, default=0) # Offset to resume from
+    created_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+
+    def __repr__(self):
+        return f'<UploadSession {self.id} {self.received}/{self.size}>'
+
 class Resource(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(150), nullable=False)
     description = db.Column(db.Text, nullable=True)
     subject = db.Column(db.String(100), nullable=False)
+    topic = db.Column(db.String(100), nullable=True) # Matched against question topics for recommendations
     resource_type = db.Column(db.Enum(ResourceType), nullable=False)
     link = db.Column(db.String(255), nullable=False)
+    blob_sha256 = db.Column(db.String(64), db.ForeignKey('blob.sha256'), nullable=True, index=True) # Uploaded file
+    file_name = db.Column(db.String(255), nullable=True) # Name the file was uploaded with
     uploaded_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     creation_date = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
 
     uploader = db.relationship('User', backref='resources')
 
     def __repr__(self):
-        return f'<Resource {self.title}>'
\ No newline at end of file
+        return f'<Resource {self.title}>'
+
+class ResourceRecommendation(db.Model):
+    """One of a student's top resources, ranked nightly by app.recommendations from their weak topics."""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    position = db.Column(db.SmallInteger, primary_key=True) # 0 is the best match
+    resource_id = db.Column(db.Integer, db.ForeignKey('resource.id'), nullable=False, index=True)
+    score = db.Column(db.Float, nullable=False)
+    answered = db.Column(db.Integer, nullable=False) # Answers in the topic (or subject) the score rests on
+    correct = db.Column(db.Integer, nullable=False)
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<ResourceRecommendation User {self.user_id} #{self.position} Resource {self.resource_id}>'
\ No newline at end of file
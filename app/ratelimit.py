@@ -0,0 +1,260 @@
+"""
+Rate limits for the sign-in and verification endpoints.
+
+Each limit allows `limit` requests per `window` seconds for one key (the
+route plus the client address or the email address it targets). Limits are
+checked with a sliding window approximated from two fixed windows: the
+count of the current window plus the previous window's count weighted by
+how much of it still overlaps the sliding window. A key therefore costs
+three integers however many requests it sees, and is forgotten two windows
+after its last request.
+
+The default store is a SQLite file in the instance folder shared by every
+worker on the machine (RATELIMIT_BACKEND 'sqlite'); 'memory' counts per
+process and 'null' turns limiting off. Checks run before the view, so a
+rejected request never reaches the database, a password hash or the mailer.
+
+A limit can instead count only failures: the view calls record_failure()
+when, say, a password is wrong, and the check before the view just looks
+at the count. Signing in successfully then never uses up an account's
+allowance.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, abort, current_app, g
+
+DEFAULT_MAX_KEYS = 100000
+
+
+def _slide(state, now, window):
+    """(current window number, previous count, current count) for `now`, rolling `state` forward."""
+    number = int(now // window)
+    if state is None or state[0] < number - 1:
+        return number, 0, 0
+    if state[0] == number - 1:
+        return number, state[2], 0
+    return state
+
+
+def _estimate(state, now, window):
+    number, previous, current = state
+    overlap = 1.0 - (now - number * window) / window
+    return previous * overlap + current
+
+
+def _retry_after(state, now, window, limit):
+    """Seconds until one more request would be allowed."""
+    number, previous, current = state
+    window_end = (number + 1) * window
+    if current >= limit or not previous:
+        return max(1, math.ceil(window_end - now))
+    # The previous window's weight falls linearly to zero over this window
+    until = number * window + window * (1.0 - (limit - 1 - current) / previous)
+    return max(1, math.ceil(until - now))
+
+
+class MemoryBackend:
+    """Per-process windows, oldest dropped first once past max_keys."""
+
+    def __init__(self, max_keys=DEFAULT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, window, now):
+        with self._lock:
+            # Keys are kept in order of last use, so the expired ones are at the front
+            while self._windows:
+                oldest, (_, expires) = next(iter(self._windows.items()))
+                if expires >= now and len(self._windows) < self.max_keys:
+                    break
+                del self._windows[oldest]
+            entry = self._windows.pop(key, None)
+            state = _slide(entry[0] if entry else None, now, window)
+            allowed = _estimate(state, now, window) + 1 <= limit
+            if allowed:
+                state = (state[0], state[1], state[2] + 1)
+            self._windows[key] = (state, (state[0] + 2) * window)
+            return allowed, None if allowed else _retry_after(state, now, window, limit)
+
+    def peek(self, key, limit, window, now):
+        with self._lock:
+            entry = self._windows.get(key)
+            state = _slide(entry[0] if entry else None, now, window)
+            allowed = _estimate(state, now, window) + 1 <= limit
+            return allowed, None if allowed else _retry_after(state, now, window, limit)
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+
+
+class NullBackend:
+    """Allows everything."""
+
+    def hit(self, key, limit, window, now):
+        return True, None
+
+    def peek(self, key, limit, window, now):
+        return True, None
+
+    def clear(self):
+        pass
+
+
+class SQLiteBackend:
+    """Windows in a SQLite file shared by all worker processes on the machine."""
+
+    # Expired keys are swept every this many hits per process
+    SWEEP_EVERY = 200
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._hits = 0
+
+    def _connection(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS rate_window (key TEXT PRIMARY KEY, number INTEGER NOT NULL, '
+                         'previous INTEGER NOT NULL, current INTEGER NOT NULL, expires REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_rate_window_expires ON rate_window (expires)')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def hit(self, key, limit, window, now):
+        conn = self._connection()
+        # The write lock is taken up front, so concurrent hits on a key are counted one at a time
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT number, previous, current FROM rate_window WHERE key = ?', (key,)).fetchone()
+            state = _slide(row, now, window)
+            allowed = _estimate(state, now, window) + 1 <= limit
+            if allowed:
+                state = (state[0], state[1], state[2] + 1)
+            if allowed or state != row:
+                conn.execute('INSERT OR REPLACE INTO rate_window (key, number, previous, current, expires) '
+                             'VALUES (?, ?, ?, ?, ?)', (key, *state, (state[0] + 2) * window))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self._hits += 1
+        if self._hits % self.SWEEP_EVERY == 0:
+            conn.execute('DELETE FROM rate_window WHERE expires < ?', (now,))
+        return allowed, None if allowed else _retry_after(state, now, window, limit)
+
+    def peek(self, key, limit, window, now):
+        row = self._connection().execute(
+            'SELECT number, previous, current FROM rate_window WHERE key = ?', (key,)).fetchone()
+        state = _slide(row, now, window)
+        allowed = _estimate(state, now, window) + 1 <= limit
+        return allowed, None if allowed else _retry_after(state, now, window, limit)
+
+    def clear(self):
+        self._connection().execute('DELETE FROM rate_window')
+
+
+class RateLimiter:
+    def __init__(self):
+        self.backend = NullBackend()
+
+    def init_app(self, app):
+        kind = app.config.get('RATELIMIT_BACKEND', 'sqlite')
+        if kind == 'sqlite':
+            self.backend = SQLiteBackend(
+                app.config.get('RATELIMIT_PATH') or os.path.join(app.instance_path, 'ratelimit.sqlite3'))
+        elif kind == 'memory':
+            self.backend = MemoryBackend(max_keys=int(app.config.get('RATELIMIT_MAX_KEYS', DEFAULT_MAX_KEYS)))
+        elif kind == 'null':
+            self.backend = NullBackend()
+        else:
+            raise ValueError(f'Unknown RATELIMIT_BACKEND {kind!r}')
+        app.extensions['ratelimit'] = self
+
+    def hit(self, key, limit, window):
+        """
+        Counts a request against a key. Returns (allowed, retry_after);
+        rejected requests are not counted.
+        """
+        return self.backend.hit(key, limit, window, time.time())
+
+    def peek(self, key, limit, window):
+        """Like hit(), but only checks the key without counting the request."""
+        return self.backend.peek(key, limit, window, time.time())
+
+    def clear(self):
+        self.backend.clear()
+
+
+def _client_address():
+    return request.remote_addr or 'unknown'
+
+
+def _normalise(email):
+    return (email or '').strip().lower()
+
+
+def form_email():
+    """The email a sign-in form posts."""
+    return _normalise(request.form.get('email'))
+
+
+def query_email():
+    """The email a verification link carries in its query string."""
+    return _normalise(request.args.get('email'))
+
+
+def rate_limited(name, per_address=None, per_email=None, methods=('POST',), email_failures_only=False,
+                 email=form_email):
+    """
+    Rejects requests to a view with 429 Too Many Requests once the client
+    address or the targeted email goes over its limit. `email` returns the
+    address the view acts on, read from the same place the view reads it,
+    so a decoy elsewhere in the request cannot move the count.
+    Limits are (requests, seconds); only the given methods are counted.
+    With email_failures_only, the email limit counts only the requests the
+    view reports through record_failure().
+    """
+    def decorator(view):
+        @wraps(view)
+        def limited(*args, **kwargs):
+            limiter = current_app.extensions.get('ratelimit')
+            if limiter is not None and request.method in methods:
+                checks = []
+                if per_address:
+                    checks.append((f'{name}:addr:{_client_address()}', per_address, limiter.hit))
+                target = email()
+                if per_email and target:
+                    key = f'{name}:email:{target}'
+                    if email_failures_only:
+                        g.rate_limit_failures = [(key, per_email)]
+                        checks.append((key, per_email, limiter.peek))
+                    else:
+                        checks.append((key, per_email, limiter.hit))
+                for key, (limit, window), check in checks:
+                    allowed, retry_after = check(key, limit, window)
+                    if not allowed:
+                        abort(429, description='Too many attempts. Please wait a little and try again.',
+                              retry_after=retry_after)
+            return view(*args, **kwargs)
+        return limited
+    return decorator
+
+
+def record_failure():
+    """Counts a failed attempt (e.g. a wrong password) against the limits that count only failures."""
+    limiter = current_app.extensions.get('ratelimit')
+    for key, (limit, window) in g.pop('rate_limit_failures', ()):
+        limiter.hit(key, limit, window)
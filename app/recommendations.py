@@ -0,0 +1,141 @@
+"""
+Resource recommendations from each student's weak topics.
+
+A recommend-resources job, queued nightly by `flask recommend-resources`,
+scores the objective answers in every student's submitted attempts against
+the answer keys and works out their accuracy per subject and topic. A
+resource filed under a topic then ranks by how weak the student is in it;
+one without a topic ranks by their weakness in the whole subject,
+discounted, and subjects a student has never sat are left out. Subjects
+and topics are matched without regard to case or surrounding spaces, since
+teachers type them freely.
+
+Each student's top TOP_K go into resource_recommendation, keyed by
+(student, position), so the resources page reads them in one indexed range
+scan. The job handles a chunk of students per call (see app.jobs) and
+replaces their rows in the same commit.
+"""
+from collections import defaultdict
+from datetime import datetime
+
+from app.extensions import db
+from app.models import (Question, ExamAttempt, AttemptAnswer, Resource, ResourceRecommendation, User, UserRole,
+                        Job)
+from app.adaptive import OBJECTIVE_TYPES
+from app.answers import decode
+from app.grading import is_correct
+from app.jobs import job_handler, enqueue
+
+TOP_K = 5
+CHUNK_SIZE = 200  # Students per job chunk
+# A topic's accuracy starts from this many answers' worth of the student's
+# accuracy in the subject, so two wrong answers do not outrank twenty
+PRIOR_ANSWERS = 5
+# Resources for a whole subject rank below those for a weak topic in it
+SUBJECT_WEIGHT = 0.5
+
+
+def _key(value):
+    return (value or '').strip().casefold()
+
+
+def topic_accuracy(user_ids):
+    """{user_id: {(subject, topic): [answered, correct]}} over the students' submitted objective answers."""
+    accuracy = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+    stmt = db.select(ExamAttempt.user_id, Question.subject, Question.topic, Question.question_type,
+                     Question.answer, AttemptAnswer.choice, AttemptAnswer.choices, AttemptAnswer.text)\
+        .join(ExamAttempt, ExamAttempt.id == AttemptAnswer.attempt_id)\
+        .join(Question, Question.id == AttemptAnswer.question_id)\
+        .where(ExamAttempt.user_id.in_(user_ids), ExamAttempt.end_time.isnot(None),
+               Question.question_type.in_(OBJECTIVE_TYPES))
+    for row in db.session.execute(stmt):
+        answer = decode(row.choice, row.choices, row.text)
+        # Omitted items say nothing about what the student knows
+        if answer in (None, '', []):
+            continue
+        counts = accuracy[row.user_id][(_key(row.subject), _key(row.topic))]
+        counts[0] += 1
+        counts[1] += is_correct(row, answer)
+    return accuracy
+
+
+def _library():
+    """[(id, subject, topic)] for every resource, newest first."""
+    return [(resource_id, _key(subject), _key(topic)) for resource_id, subject, topic in db.session.query(
+        Resource.id, Resource.subject, Resource.topic).order_by(Resource.creation_date.desc(), Resource.id.desc())]
+
+
+def rank_resources(accuracy, library, limit=TOP_K):
+    """
+    A student's best `limit` resources as [(resource id, score, answered,
+    correct)], from their {(subject, topic): [answered, correct]} and the
+    library from _library(). `answered` and `correct` are the evidence the
+    score rests on: the topic's counts, or the subject's.
+    """
+    subjects = defaultdict(lambda: [0, 0])
+    for (subject, _), (answered, correct) in accuracy.items():
+        subjects[subject][0] += answered
+        subjects[subject][1] += correct
+
+    ranked = []
+    for resource_id, subject, topic in library:
+        if subject not in subjects:
+            continue
+        answered, correct = subjects[subject]
+        # Smoothed, so a single answer does not read as 0% or 100%
+        subject_accuracy = (correct + 1) / (answered + 2)
+        if topic and (subject, topic) in accuracy:
+            answered, correct = accuracy[(subject, topic)]
+            score = 1 - (correct + PRIOR_ANSWERS * subject_accuracy) / (answered + PRIOR_ANSWERS)
+        else:
+            score = SUBJECT_WEIGHT * (1 - subject_accuracy)
+        ranked.append((resource_id, score, answered, correct))
+    # A stable sort, so equal scores keep the library's newest-first order
+    ranked.sort(key=lambda entry: -entry[1])
+    return ranked[:limit]
+
+
+def store_recommendations(user_ids):
+    """Replaces the students' recommendations. Returns the number of rows written; the caller commits."""
+    accuracy = topic_accuracy(user_ids)
+    library = _library()
+    computed_at = datetime.utcnow()
+    rows = [
+        {'user_id': user_id, 'position': position, 'resource_id': resource_id, 'score': score,
+         'answered': answered, 'correct': correct, 'computed_at': computed_at}
+        for user_id in user_ids if user_id in accuracy
+        for position, (resource_id, score, answered, correct) in enumerate(rank_resources(accuracy[user_id], library))
+    ]
+    ResourceRecommendation.query.filter(ResourceRecommendation.user_id.in_(user_ids))\
+        .delete(synchronize_session=False)
+    if rows:
+        db.session.execute(ResourceRecommendation.__table__.insert(), rows)
+    return len(rows)
+
+
+def forget_resource(resource_id):
+    """Takes a resource out of every student's recommendations before it is deleted. The caller commits."""
+    ResourceRecommendation.query.filter(ResourceRecommendation.resource_id == resource_id)\
+        .delete(synchronize_session=False)
+
+
+def start_recommendations():
+    """Queues a recommend-resources job unless one is already waiting or running. The caller commits."""
+    if Job.query.filter(Job.kind == 'recommend-resources', Job.status.in_(['queued', 'running'])).first():
+        return None
+    return enqueue('recommend-resources')
+
+
+@job_handler('recommend-resources')
+def recommend_resources_job(job):
+    """Each call recommends resources to one chunk of students, in id order."""
+    students = db.session.query(User.id).filter(User.role == UserRole.STUDENT)
+    if job.total is None:
+        job.total = students.count()
+    after = (job.cursor or {}).get('after', 0)
+    user_ids = [user_id for user_id, in students.filter(User.id > after).order_by(User.id).limit(CHUNK_SIZE)]
+    if user_ids:
+        store_recommendations(user_ids)
+        job.cursor = {'after': user_ids[-1]}
+        job.progress = (job.progress or 0) + len(user_ids)
+    return len(user_ids) < CHUNK_SIZE
@@ -0,0 +1,167 @@
+"""
+Deleting and archiving exams in the background.
+
+An exam can have thousands of attempts, each with answers, grades,
+similarity signatures and leaderboard entries, so removing it in the
+request would hold one long transaction. Instead the exam is marked
+'deleting' (it can no longer be listed or sat) and a delete-exam job
+clears it out a chunk of attempts at a time, every chunk committed with the
+job's progress (see app.jobs).
+
+Archival keeps the hot tables small: an archive-exams job moves exams
+nobody has sat since a cutoff into archived_attempt, one compact row per
+attempt with its answers and grades packed into a blob. Archived scores
+stay in the subject totals and score histograms; they leave the
+leaderboards.
+"""
+import json
+import zlib
+from datetime import datetime
+
+from app.extensions import db
+from app.models import (Exam, ExamAttempt, ArchivedAttempt, AttemptAnswer, Grade, AnswerSignature, SimilarityFlag,
+                        ScoreHistogram, exam_questions)
+from app.answers import load_answers
+from app.grading import update_subject_aggregates, update_leaderboards
+from app.fragments import touch, touch_attempts, teacher_scope, EXAMS_SCOPE
+from app.jobs import job_handler, enqueue
+
+CHUNK_SIZE = 500
+
+EXAM_ACTIVE = 'active'
+EXAM_DELETING = 'deleting'
+EXAM_ARCHIVED = 'archived'
+
+
+def _purge_attempts(attempt_ids):
+    """Deletes attempts and every row that refers to them; derived totals are the caller's business."""
+    update_leaderboards(attempt_ids, removed=True)
+    for model in (AttemptAnswer, Grade, AnswerSignature):
+        model.query.filter(model.attempt_id.in_(attempt_ids)).delete(synchronize_session=False)
+    SimilarityFlag.query.filter(db.or_(SimilarityFlag.attempt_id.in_(attempt_ids),
+                                       SimilarityFlag.other_attempt_id.in_(attempt_ids)))\
+        .delete(synchronize_session=False)
+    ExamAttempt.query.filter(ExamAttempt.id.in_(attempt_ids)).delete(synchronize_session=False)
+
+
+def _next_attempts(exam_id):
+    return db.session.query(ExamAttempt.id, ExamAttempt.user_id, ExamAttempt.score)\
+        .filter(ExamAttempt.exam_id == exam_id).order_by(ExamAttempt.id).limit(CHUNK_SIZE).all()
+
+
+def start_exam_deletion(exam, created_by=None):
+    """
+    Hides the exam and queues the job that deletes it. Returns the job, or
+    None if the exam is already being deleted. The caller commits.
+    """
+    if exam.status == EXAM_DELETING:
+        return None
+    exam.status = EXAM_DELETING
+    touch(EXAMS_SCOPE, teacher_scope(exam.created_by))
+    return enqueue('delete-exam', {'exam_id': exam.id}, created_by=created_by)
+
+
+@job_handler('delete-exam')
+def delete_exam_job(job):
+    """
+    Deletes one chunk of the exam's attempts per call, then its archived
+    attempts, histograms and question links, and finally the exam itself.
+    """
+    exam_id = job.params['exam_id']
+    if job.total is None:
+        job.total = sum(db.session.query(db.func.count(model.id)).filter(model.exam_id == exam_id).scalar()
+                        for model in (ExamAttempt, ArchivedAttempt))
+
+    rows = _next_attempts(exam_id)
+    if rows:
+        update_subject_aggregates([(exam_id, score, None) for _, _, score in rows if score is not None])
+        touch_attempts((user_id, exam_id) for _, user_id, _ in rows)
+        _purge_attempts([attempt_id for attempt_id, _, _ in rows])
+        job.progress = (job.progress or 0) + len(rows)
+        return False
+
+    archived = db.session.query(ArchivedAttempt.id, ArchivedAttempt.user_id, ArchivedAttempt.score)\
+        .filter(ArchivedAttempt.exam_id == exam_id).order_by(ArchivedAttempt.id).limit(CHUNK_SIZE).all()
+    if archived:
+        update_subject_aggregates([(exam_id, score, None) for _, _, score in archived if score is not None])
+        touch_attempts((user_id, exam_id) for _, user_id, _ in archived)
+        ArchivedAttempt.query.filter(ArchivedAttempt.id.in_([archived_id for archived_id, _, _ in archived]))\
+            .delete(synchronize_session=False)
+        job.progress = (job.progress or 0) + len(archived)
+        return False
+
+    created_by = db.session.query(Exam.created_by).filter(Exam.id == exam_id).scalar()
+    if created_by is not None:
+        ScoreHistogram.query.filter_by(exam_id=exam_id).delete(synchronize_session=False)
+        db.session.execute(exam_questions.delete().where(exam_questions.c.exam_id == exam_id))
+        Exam.query.filter_by(id=exam_id).delete(synchronize_session=False)
+        touch(EXAMS_SCOPE, teacher_scope(created_by))
+    return True
+
+
+def archivable_exams(before):
+    """Ids of active exams created before `before` that nobody has started since."""
+    recent = db.session.query(ExamAttempt.exam_id).filter(ExamAttempt.start_time >= before)
+    return [exam_id for (exam_id,) in db.session.query(Exam.id).filter(
+        Exam.status == EXAM_ACTIVE, Exam.creation_date < before, ~Exam.id.in_(recent.scalar_subquery())
+    ).order_by(Exam.id)]
+
+
+def _packed(answers, grades):
+    return zlib.compress(json.dumps({'answers': answers, 'grades': grades}, separators=(',', ':')).encode('utf-8'))
+
+
+def unpack_archived(attempt):
+    """{'answers': {str(question_id): answer}, 'grades': [...]} for an ArchivedAttempt."""
+    return json.loads(zlib.decompress(attempt.payload))
+
+
+@job_handler('archive-exams')
+def archive_exams_job(job):
+    """
+    The first call marks the exams to archive, so no new attempts start;
+    each later call moves one chunk of attempts into archived_attempt.
+    """
+    cursor = dict(job.cursor or {})
+    if 'exams' not in cursor:
+        exam_ids = archivable_exams(datetime.fromisoformat(job.params['before']))
+        for start in range(0, len(exam_ids), CHUNK_SIZE):
+            Exam.query.filter(Exam.id.in_(exam_ids[start:start + CHUNK_SIZE]))\
+                .update({'status': EXAM_ARCHIVED}, synchronize_session=False)
+        if exam_ids:
+            touch(EXAMS_SCOPE)
+        job.total = db.session.query(db.func.count(ExamAttempt.id))\
+            .filter(ExamAttempt.exam_id.in_(exam_ids)).scalar() if exam_ids else 0
+        job.cursor = {'exams': exam_ids, 'index': 0}
+        return not exam_ids
+
+    exam_id = cursor['exams'][cursor['index']]
+    attempts = db.session.query(
+        ExamAttempt.id, ExamAttempt.sync_key, ExamAttempt.user_id, ExamAttempt.start_time, ExamAttempt.end_time,
+        ExamAttempt.score, ExamAttempt.snapshot_digest
+    ).filter(ExamAttempt.exam_id == exam_id).order_by(ExamAttempt.id).limit(CHUNK_SIZE).all()
+    if not attempts:
+        cursor['index'] += 1
+        job.cursor = cursor
+        return cursor['index'] >= len(cursor['exams'])
+
+    attempt_ids = [attempt.id for attempt in attempts]
+    answers = load_answers(attempt_ids)
+    grades = {}
+    for attempt_id, question_id, teacher_id, score, comments in db.session.query(
+        Grade.attempt_id, Grade.question_id, Grade.teacher_id, Grade.score, Grade.comments
+    ).filter(Grade.attempt_id.in_(attempt_ids)):
+        grades.setdefault(attempt_id, []).append({'question_id': question_id, 'teacher_id': teacher_id,
+                                                  'score': score, 'comments': comments})
+    archived_at = datetime.utcnow()
+    db.session.execute(ArchivedAttempt.__table__.insert(), [
+        {'attempt_id': attempt.id, 'sync_key': attempt.sync_key, 'user_id': attempt.user_id, 'exam_id': exam_id,
+         'start_time': attempt.start_time, 'end_time': attempt.end_time, 'score': attempt.score,
+         'snapshot_digest': attempt.snapshot_digest, 'archived_at': archived_at,
+         'payload': _packed(answers[attempt.id], grades.get(attempt.id, []))}
+        for attempt in attempts
+    ])
+    touch_attempts((attempt.user_id, exam_id) for attempt in attempts)
+    _purge_attempts(attempt_ids)
+    job.progress = (job.progress or 0) + len(attempts)
+    return False
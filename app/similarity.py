@@ -0,0 +1,219 @@
+"""
+Near-duplicate detection for essay and short answer responses.
+
+Each answer is reduced to a set of word shingles and a MinHash signature.
+Signatures are split into LSH bands so only answers that share a band are
+compared, which keeps a scan close to linear in the number of candidates.
+Signatures are stored per (question, attempt), so later scans only hash the
+attempts that arrived since the last run.
+"""
+import hashlib
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+from app.extensions import db
+from app.models import Question, ExamAttempt, AttemptAnswer, AnswerSignature, SimilarityFlag, exam_questions
+from app.grading import MANUAL_TYPES
+from app.answers import decode
+
+SHINGLE_SIZE = 3
+NUM_PERM = 128
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+# Answers shorter than this are too generic to compare meaningfully
+MIN_WORDS = 10
+DEFAULT_THRESHOLD = 0.8
+# Questions loaded per pool worker at a time; bounds the answers held in memory
+QUESTIONS_PER_WORKER = 2
+
+_PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(20240601)
+_A = _rng.randint(1, _PRIME, NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, _PRIME, NUM_PERM).astype(np.uint64)
+
+_TAG_RE = re.compile(r'<[^>]+>')
+_WORD_RE = re.compile(r'\w+')
+
+
+def shingles(text):
+    words = _WORD_RE.findall(_TAG_RE.sub(' ', text or '').lower())
+    if len(words) < MIN_WORDS:
+        return set()
+    return {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def _hash(shingle):
+    digest = hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % _PRIME
+
+
+def signature(text):
+    """Returns the MinHash signature of an answer as a uint32 array, or None if it is too short."""
+    items = shingles(text)
+    if not items:
+        return None
+    hashes = np.fromiter((_hash(s) for s in items), dtype=np.uint64, count=len(items))
+    # Values stay below 2**62, so the uint64 arithmetic cannot overflow
+    return ((np.outer(hashes, _A) + _B) % _PRIME).min(axis=0).astype(np.uint32)
+
+
+def scan_question(new_answers, known_signatures, threshold=DEFAULT_THRESHOLD):
+    """
+    Finds near-duplicate pairs for one question.
+
+    `new_answers` maps attempt ids to answer text that has not been hashed
+    yet; `known_signatures` maps attempt ids to signature bytes from earlier
+    scans. Only pairs involving at least one new attempt are returned, as
+    (attempt_id, other_attempt_id, similarity) with attempt_id < other_attempt_id.
+    Returns (signature bytes to store by attempt id, pairs). Pure, so it can run
+    in a worker process.
+    """
+    new_signatures = {}
+    # Answers too short to hash are stored with an empty signature so they are not rescanned
+    stored = {}
+    for attempt_id, text in new_answers.items():
+        sig = signature(text)
+        stored[attempt_id] = sig.tobytes() if sig is not None else b''
+        if sig is not None:
+            new_signatures[attempt_id] = sig
+
+    signatures = {a: np.frombuffer(s, dtype=np.uint32) for a, s in known_signatures.items() if s}
+    signatures.update(new_signatures)
+
+    buckets = {}
+    for attempt_id, sig in signatures.items():
+        for band, rows in enumerate(sig.reshape(BANDS, ROWS)):
+            buckets.setdefault((band, rows.tobytes()), []).append(attempt_id)
+
+    candidates = set()
+    for members in buckets.values():
+        if len(members) < 2:
+            continue
+        fresh = [m for m in members if m in new_signatures]
+        for a in fresh:
+            for b in members:
+                if a != b:
+                    candidates.add((min(a, b), max(a, b)))
+
+    pairs = []
+    for a, b in candidates:
+        similarity = float(np.mean(signatures[a] == signatures[b]))
+        if similarity >= threshold:
+            pairs.append((a, b, round(similarity, 3)))
+
+    return stored, pairs
+
+
+def _pending_answers(question_id, exam_id=None):
+    """Submitted answers to a question whose signature has not been stored yet."""
+    query = db.session.query(
+        AttemptAnswer.attempt_id, AttemptAnswer.choice, AttemptAnswer.choices, AttemptAnswer.text
+    ).join(ExamAttempt, ExamAttempt.id == AttemptAnswer.attempt_id)\
+     .join(exam_questions, (exam_questions.c.exam_id == ExamAttempt.exam_id)
+                           & (exam_questions.c.question_id == question_id))\
+     .outerjoin(AnswerSignature, (AnswerSignature.attempt_id == AttemptAnswer.attempt_id)
+                                 & (AnswerSignature.question_id == question_id))\
+     .filter(AttemptAnswer.question_id == question_id,
+             ExamAttempt.end_time.isnot(None), AnswerSignature.attempt_id.is_(None))
+    if exam_id is not None:
+        query = query.filter(ExamAttempt.exam_id == exam_id)
+    pending = {}
+    for attempt_id, choice, choices, text in query:
+        answer = decode(choice, choices, text)
+        if answer:
+            pending[attempt_id] = answer if isinstance(answer, str) else ' '.join(answer)
+    return pending
+
+
+def _pending_questions(question_ids, exam_id):
+    """Yields (question id, new answers, known signatures) for each question with new answers."""
+    for question_id in question_ids:
+        new_answers = _pending_answers(question_id, exam_id)
+        if not new_answers:
+            continue
+        known = dict(db.session.query(AnswerSignature.attempt_id, AnswerSignature.signature)
+                     .filter(AnswerSignature.question_id == question_id))
+        yield question_id, new_answers, known
+
+
+def _store_scan(question_id, stored, pairs):
+    db.session.bulk_insert_mappings(AnswerSignature, [
+        {'question_id': question_id, 'attempt_id': attempt_id, 'signature': sig}
+        for attempt_id, sig in stored.items()
+    ])
+    db.session.bulk_insert_mappings(SimilarityFlag, [
+        {'question_id': question_id, 'attempt_id': a, 'other_attempt_id': b, 'similarity': s}
+        for a, b, s in pairs
+    ])
+    db.session.commit()
+
+
+def detect_similar_answers(question_ids=None, exam_id=None, threshold=DEFAULT_THRESHOLD, workers=None):
+    """
+    Hashes new answers for each essay/short answer question and stores
+    flagged pairs. Questions are loaded a few at a time and scanned in
+    parallel in a process pool; all database work stays in this process.
+    Returns (questions scanned, answers hashed, pairs flagged).
+    """
+    query = db.session.query(Question.id).filter(Question.question_type.in_(MANUAL_TYPES))
+    if exam_id is not None:
+        query = query.join(exam_questions, exam_questions.c.question_id == Question.id)\
+                     .filter(exam_questions.c.exam_id == exam_id)
+    if question_ids:
+        query = query.filter(Question.id.in_(question_ids))
+
+    pending = _pending_questions([question_id for (question_id,) in query], exam_id)
+    batch_size = 1 if workers == 1 else (workers or os.cpu_count() or 1) * QUESTIONS_PER_WORKER
+    scanned = hashed = flagged = 0
+    pool = None
+    try:
+        while True:
+            batch = list(islice(pending, batch_size))
+            if not batch:
+                break
+            if len(batch) == 1 and pool is None:
+                results = [scan_question(batch[0][1], batch[0][2], threshold)]
+            else:
+                if pool is None:
+                    pool = ProcessPoolExecutor(max_workers=workers)
+                results = pool.map(scan_question, [b[1] for b in batch], [b[2] for b in batch],
+                                   [threshold] * len(batch))
+            for (question_id, _, _), (stored, pairs) in zip(batch, results):
+                _store_scan(question_id, stored, pairs)
+                scanned += 1
+                hashed += len(stored)
+                flagged += len(pairs)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return scanned, hashed, flagged
+
+
+def flags_for_attempts(question_id, attempt_ids):
+    """Maps each attempt id to [(other attempt id, similarity), ...] for one question."""
+    attempt_ids = list(attempt_ids)
+    if not attempt_ids:
+        return {}
+    flags = {}
+    for flag in SimilarityFlag.query.filter(
+        SimilarityFlag.question_id == question_id,
+        db.or_(SimilarityFlag.attempt_id.in_(attempt_ids), SimilarityFlag.other_attempt_id.in_(attempt_ids))
+    ).order_by(SimilarityFlag.similarity.desc()):
+        flags.setdefault(flag.attempt_id, []).append((flag.other_attempt_id, flag.similarity))
+        flags.setdefault(flag.other_attempt_id, []).append((flag.attempt_id, flag.similarity))
+    return flags
+
+
+def flags_for_attempt(attempt_id):
+    """Maps question ids to [(other attempt id, similarity), ...] for one attempt."""
+    flags = {}
+    for flag in SimilarityFlag.query.filter(
+        db.or_(SimilarityFlag.attempt_id == attempt_id, SimilarityFlag.other_attempt_id == attempt_id)
+    ).order_by(SimilarityFlag.similarity.desc()):
+        other = flag.other_attempt_id if flag.attempt_id == attempt_id else flag.attempt_id
+        flags.setdefault(flag.question_id, []).append((other, flag.similarity))
+    return flags
@@ -0,0 +1,168 @@
+"""
+Immutable, content-addressed question papers.
+
+Every question version is frozen into a QuestionSnapshot keyed by the
+SHA-256 of its content, so exams using the same version share one row. An
+exam pins an ExamSnapshot: the ordered list of question snapshots,
+pre-assembled into a single compressed blob. Delivery, scoring and grading
+read that blob instead of the live Question rows, so editing a question
+never changes an exam that has already been sat.
+"""
+import hashlib
+import json
+import zlib
+from collections import OrderedDict
+from threading import Lock
+
+from app.extensions import db, dialect_insert
+from app.models import Question, QuestionType, Exam, QuestionSnapshot, ExamSnapshot, exam_questions
+
+# Fields frozen into a snapshot; anything else about a question can change freely
+SNAPSHOT_FIELDS = ('id', 'version', 'text', 'question_type', 'options', 'answer', 'explanation',
+                   'subject', 'topic', 'difficulty', 'max_score')
+
+PAPER_CACHE_SIZE = 256
+
+
+class SnapshotQuestion:
+    """Read-only question loaded from a snapshot; quacks like a Question for scoring."""
+    __slots__ = SNAPSHOT_FIELDS
+
+    def __init__(self, data):
+        for field in SNAPSHOT_FIELDS:
+            setattr(self, field, data.get(field))
+        self.question_type = QuestionType(self.question_type)
+
+    def to_dict(self):
+        data = {field: getattr(self, field) for field in SNAPSHOT_FIELDS}
+        data['question_type'] = self.question_type.value
+        return data
+
+
+def _canonical(data):
+    return json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def question_payload(question):
+    data = {field: getattr(question, field) for field in SNAPSHOT_FIELDS}
+    data['question_type'] = question.question_type.value
+    return data
+
+
+def pin_exam(exam, questions=None):
+    """
+    Freezes the exam's current questions into snapshots and points
+    exam.snapshot_digest at the assembled paper. Existing snapshots are
+    reused; concurrent pins of shared questions insert each snapshot once.
+    The caller commits. Returns the paper digest.
+    """
+    if questions is None:
+        questions = exam.questions
+    payloads = [question_payload(q) for q in sorted(questions, key=lambda q: q.id)]
+    encoded = [_canonical(p) for p in payloads]
+    digests = [hashlib.sha256(e).hexdigest() for e in encoded]
+    paper_digest = hashlib.sha256('\n'.join(digests).encode('ascii')).hexdigest()
+    question_rows = [{'digest': digest, 'question_id': payload['id'], 'version': payload['version'],
+                      'payload': zlib.compress(data)}
+                     for payload, data, digest in zip(payloads, encoded, digests)]
+    paper_row = {'digest': paper_digest, 'question_digests': digests, 'payload': zlib.compress(_canonical(payloads))}
+
+    insert = dialect_insert()
+    if insert is not None:
+        # Snapshots are content-addressed, so a row someone else wrote first is the same row
+        if question_rows:
+            db.session.execute(insert(QuestionSnapshot.__table__).values(question_rows)
+                               .on_conflict_do_nothing(index_elements=['digest']))
+        db.session.execute(insert(ExamSnapshot.__table__).values([paper_row])
+                           .on_conflict_do_nothing(index_elements=['digest']))
+    else:
+        existing = {d for (d,) in db.session.query(QuestionSnapshot.digest)
+                    .filter(QuestionSnapshot.digest.in_(digests))} if digests else set()
+        for row in question_rows:
+            if row['digest'] not in existing:
+                db.session.add(QuestionSnapshot(**row))
+                existing.add(row['digest'])
+        if db.session.get(ExamSnapshot, paper_digest) is None:
+            db.session.add(ExamSnapshot(**paper_row))
+    exam.snapshot_digest = paper_digest
+    return paper_digest
+
+
+def pin_unpinned_exams(chunk_size=100):
+    """
+    Pins every exam created before snapshots existed, committing a chunk at
+    a time. Run once at deploy (`flask pin-exams`); delivery never pins.
+    Returns the number of exams pinned.
+    """
+    pinned = 0
+    while True:
+        exams = Exam.query.filter(Exam.snapshot_digest.is_(None)).order_by(Exam.id).limit(chunk_size).all()
+        if not exams:
+            return pinned
+        for exam in exams:
+            pin_exam(exam)
+        db.session.commit()
+        pinned += len(exams)
+
+
+_papers = OrderedDict()
+_papers_lock = Lock()
+
+
+def load_paper(digest):
+    """
+    Returns the list of SnapshotQuestion for a paper digest. Papers never
+    change, so decoded papers are kept in a small per-process LRU.
+    """
+    with _papers_lock:
+        paper = _papers.get(digest)
+        if paper is not None:
+            _papers.move_to_end(digest)
+            return paper
+
+    blob = db.session.query(ExamSnapshot.payload).filter(ExamSnapshot.digest == digest).scalar()
+    if blob is None:
+        return None
+    paper = [SnapshotQuestion(data) for data in json.loads(zlib.decompress(blob))]
+
+    with _papers_lock:
+        _papers[digest] = paper
+        if len(_papers) > PAPER_CACHE_SIZE:
+            _papers.popitem(last=False)
+    return paper
+
+
+def exam_paper(exam_id):
+    """
+    Returns (digest, questions) for an exam's pinned paper, or (None, None)
+    if the exam does not exist or has never been pinned (exams created
+    before snapshots existed are pinned by `flask pin-exams`).
+    """
+    digest = db.session.query(Exam.snapshot_digest).filter(Exam.id == exam_id).scalar()
+    if digest is None:
+        return None, None
+    return digest, load_paper(digest)
+
+
+def current_digests(exam_ids):
+    """Maps exam ids to the paper digest their live questions would pin today."""
+    questions_by_exam = {}
+    for exam_id, question in db.session.query(exam_questions.c.exam_id, Question)\
+            .join(Question, Question.id == exam_questions.c.question_id)\
+            .filter(exam_questions.c.exam_id.in_(list(exam_ids))):
+        questions_by_exam.setdefault(exam_id, []).append(question)
+    digests = {}
+    for exam_id, questions in questions_by_exam.items():
+        parts = [hashlib.sha256(_canonical(question_payload(q))).hexdigest()
+                 for q in sorted(questions, key=lambda q: q.id)]
+        digests[exam_id] = hashlib.sha256('\n'.join(parts).encode('ascii')).hexdigest()
+    return digests
+
+
+def scoring_changes(old_paper, new_paper):
+    """Question ids whose key, marks or type differ between two papers (or that were added/removed)."""
+    def key(question):
+        return (question.question_type, json.dumps(question.answer, sort_keys=True), question.max_score)
+    old = {q.id: key(q) for q in old_paper or []}
+    new = {q.id: key(q) for q in new_paper or []}
+    return {qid for qid in old.keys() | new.keys() if old.get(qid) != new.get(qid)}
@@ -13,8 +13,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const userAnswers = {}; // { questionId: answer }
     const questionStatus = Array(examData.questions.length).fill('unanswered'); // unanswered, answered, marked
 
-    function startTimer(durationMinutes) {
-        let totalSeconds = durationMinutes * 60;
+    function startTimer(remainingSeconds) {
+        let totalSeconds = remainingSeconds;
 
         const timerInterval = setInterval(() => {
             if (totalSeconds <= 0) {
@@ -112,6 +112,20 @@ document.addEventListener('DOMContentLoaded', () => {
         userAnswers[questionId] = answer;
     }
 
+    function postAnswers(url) {
+        return fetch(url, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ answers: userAnswers })
+        }).then(response => response.json());
+    }
+
+    // Auto-save answers every 30 seconds so a dropped connection loses little work
+    const autosaveInterval = setInterval(() => {
+        saveAnswer();
+        postAnswers(examEndpoints.save).catch(() => {});
+    }, 30000);
+
     // Event Listeners
     markForReviewBtn.addEventListener('click', () => {
         // Toggle 'marked' status, but only if it's not already answered
@@ -146,7 +160,24 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    submitBtn.addEventListener('click', () => {
+        saveAnswer();
+        submitBtn.disabled = true;
+        clearInterval(autosaveInterval);
+        postAnswers(examEndpoints.submit)
+            .then(data => {
+                if (data.status === 'late') {
+                    alert(data.message);
+                }
+                window.location.href = data.redirect;
+            })
+            .catch(() => {
+                submitBtn.disabled = false;
+                alert('Could not submit your exam. Please check your connection and try again.');
+            });
+    });
+
     // Initial Load
     renderQuestion(currentQuestionIndex);
-    startTimer(examData.duration_minutes);
+    startTimer(examData.remaining_seconds);
 });
\ No newline at end of file
@@ -0,0 +1,97 @@
+// Chunked, resumable uploads for resource forms.
+// A form with data-chunked-upload sends its file through the /uploads API in
+// chunks before submitting; the form then carries only the stored file's hash.
+// If the connection drops, submitting again resumes from the last chunk the
+// server acknowledged.
+(() => {
+    const CHUNK_SIZE = 4 * 1024 * 1024;
+    const MAX_RETRIES = 5;
+
+    async function request(method, url, body, headers = {}) {
+        const response = await fetch(url, {method, body, headers, credentials: 'same-origin'});
+        const data = await response.json().catch(() => ({}));
+        return {ok: response.ok, status: response.status, data};
+    }
+
+    function uploadKey(file) {
+        return `upload:${file.name}:${file.size}:${file.lastModified}`;
+    }
+
+    async function openUpload(file) {
+        const saved = localStorage.getItem(uploadKey(file));
+        if (saved) {
+            const existing = await request('GET', `/uploads/${saved}`);
+            if (existing.ok) return existing.data;
+            localStorage.removeItem(uploadKey(file));
+        }
+        const created = await request('POST', '/uploads', JSON.stringify({filename: file.name, size: file.size}),
+                                      {'Content-Type': 'application/json'});
+        if (!created.ok) throw new Error(created.data.error || 'Could not start the upload.');
+        if (!created.data.complete) localStorage.setItem(uploadKey(file), created.data.upload_id);
+        return created.data;
+    }
+
+    async function uploadFile(file, onProgress) {
+        const upload = await openUpload(file);
+        if (upload.complete) return upload.sha256;
+
+        let offset = upload.offset;
+        let retries = 0;
+        while (offset < file.size) {
+            const chunk = file.slice(offset, offset + CHUNK_SIZE);
+            let result;
+            try {
+                result = await request('PUT', `/uploads/${upload.upload_id}?offset=${offset}`, chunk,
+                                       {'Content-Type': 'application/octet-stream'});
+            } catch (error) {
+                result = {ok: false, status: 0, data: {}};
+            }
+            if (result.ok || result.status === 409) {
+                // 409 means the server is at a different offset; carry on from there
+                offset = result.data.offset ?? offset;
+                retries = result.ok ? 0 : retries + 1;
+            } else {
+                retries++;
+                await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+            }
+            if (retries > MAX_RETRIES) throw new Error('The upload keeps failing. Submit again to resume.');
+            onProgress(offset / file.size);
+        }
+
+        const completed = await request('POST', `/uploads/${upload.upload_id}/complete`);
+        if (!completed.ok) throw new Error(completed.data.error || 'Could not finish the upload.');
+        localStorage.removeItem(uploadKey(file));
+        return completed.data.sha256;
+    }
+
+    document.querySelectorAll('form[data-chunked-upload]').forEach(form => {
+        const fileInput = form.querySelector('input[type="file"]');
+        const submitButton = form.querySelector('button[type="submit"]');
+        form.addEventListener('submit', async event => {
+            const file = fileInput.files[0];
+            if (!file || fileInput.style.display === 'none' || form.elements.upload_sha256) return;
+            event.preventDefault();
+            const label = submitButton.textContent;
+            submitButton.disabled = true;
+            try {
+                const sha256 = await uploadFile(file, fraction => {
+                    submitButton.textContent = `Uploading ${Math.floor(fraction * 100)}%`;
+                });
+                for (const [name, value] of [['upload_sha256', sha256], ['file_name', file.name]]) {
+                    const hidden = document.createElement('input');
+                    hidden.type = 'hidden';
+                    hidden.name = name;
+                    hidden.value = value;
+                    form.appendChild(hidden);
+                }
+                // The file is already stored; don't send it again with the form
+                fileInput.disabled = true;
+                form.submit();
+            } catch (error) {
+                alert(error.message);
+                submitButton.disabled = false;
+                submitButton.textContent = label;
+            }
+        });
+    });
+})();
@@ -0,0 +1,57 @@
+"""
+Compiled templates kept on disk.
+
+Jinja turns each template into Python source and compiles that the first
+time a process loads it, which for the larger templates takes longer than
+rendering them. With TEMPLATE_CACHE 'filesystem' (the default) the compiled
+bytecode is written to instance/jinja-cache and loaded from there by every
+other process on the machine: the gunicorn master, which loads all templates
+before forking its workers (see wsgi.py), workers of a deployment without
+preload_app, and `flask` commands. Entries are checked against the template
+source, so an edited template is simply compiled again; 'none' turns the
+cache off.
+
+`flask templates compile` fills the cache at deploy time, so the first
+worker to start after a release does not pay for the compiles either.
+"""
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+
+class SharedBytecodeCache(FileSystemBytecodeCache):
+    """A bytecode cache whose writes are best effort: a full or read-only disk never fails a render."""
+
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError:
+            pass
+
+
+def init_templates(app):
+    kind = app.config.get('TEMPLATE_CACHE', 'filesystem')
+    if kind == 'filesystem':
+        directory = app.config.get('TEMPLATE_CACHE_PATH') or os.path.join(app.instance_path, 'jinja-cache')
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = SharedBytecodeCache(directory)
+    elif kind != 'none':
+        raise ValueError(f'Unknown TEMPLATE_CACHE {kind!r}')
+
+
+def compile_templates(app, clean=False):
+    """
+    Loads every template, compiling those the cache has no current bytecode
+    for. `clean` drops the cache first. Returns {template name: seconds}.
+    """
+    env = app.jinja_env
+    if clean and env.bytecode_cache is not None:
+        env.bytecode_cache.clear()
+    timings = {}
+    for name in env.list_templates():
+        started = time.perf_counter()
+        # Straight from the loader, skipping templates this process already holds
+        env.loader.load(env, name, env.globals)
+        timings[name] = time.perf_counter() - started
+    return timings
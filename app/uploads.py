@@ -0,0 +1,289 @@
+"""
+Content-addressed storage for uploaded resource files.
+
+Files are stored once under the SHA-256 of their content, so the same PDF
+uploaded by two teachers takes up space once and a file can never be
+overwritten by another with the same name. Each Blob counts the resources
+that use it; the file is removed when the last one goes, and files that
+were stored but never attached to a resource are pruned with unfinished
+uploads.
+
+Large files are sent in chunks: the client opens an UploadSession, PUTs
+chunks at increasing offsets (asking for the current offset to resume
+after a dropped connection) and completes the session, at which point the
+file is hashed in a single streaming pass and moved into the store.
+
+The store lives outside the static folder (UPLOAD_FOLDER, by default
+instance/uploads), so files are only ever sent by serve_blob behind a
+login.
+"""
+import hashlib
+import mimetypes
+import os
+import shutil
+import uuid
+from datetime import datetime, timedelta
+
+from flask import current_app, url_for, request, send_file
+from werkzeug.utils import secure_filename
+
+from app.extensions import db
+from app.models import Blob, UploadSession, Resource
+
+COPY_BUFFER = 64 * 1024
+# Largest single chunk accepted by the upload API
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+# Unfinished uploads are removed after this long
+UPLOAD_EXPIRY = timedelta(hours=24)
+# A stored file's content never changes under its name, so it can be cached for good
+MEDIA_MAX_AGE = 365 * 24 * 3600
+
+
+class UploadError(Exception):
+    pass
+
+
+def upload_folder():
+    return current_app.config.get('UPLOAD_FOLDER') or os.path.join(current_app.instance_path, 'uploads')
+
+
+def static_upload_folder():
+    """Where uploads used to be kept, inside the public static folder."""
+    return os.path.join(current_app.root_path, 'static', 'uploads')
+
+
+def _partial_path(upload_id):
+    return os.path.join(upload_folder(), '.partial', upload_id)
+
+
+def blob_path(blob):
+    return os.path.join(upload_folder(), blob.filename)
+
+
+def blob_url(blob):
+    return url_for('main.media', filename=blob.filename)
+
+
+def serve_blob(blob):
+    """
+    Response for a stored file. The content hash is a strong ETag, so a
+    revalidation is answered without touching the file. Range requests are
+    handled by send_file, which hands the file to the server's sendfile
+    support where available. With RESOURCE_ACCEL_REDIRECT set to an nginx
+    internal location the body is left to nginx entirely; with
+    USE_X_SENDFILE, Flask sends an X-Sendfile header instead.
+    """
+    if blob.sha256 in request.if_none_match:
+        response = current_app.response_class(status=304)
+    elif current_app.config.get('RESOURCE_ACCEL_REDIRECT'):
+        response = current_app.response_class(mimetype=blob.content_type)
+        response.headers['X-Accel-Redirect'] = \
+            current_app.config['RESOURCE_ACCEL_REDIRECT'].rstrip('/') + '/' + blob.filename
+    else:
+        response = send_file(blob_path(blob), mimetype=blob.content_type, conditional=True,
+                             etag=blob.sha256, max_age=MEDIA_MAX_AGE)
+    response.set_etag(blob.sha256)
+    # Resources are behind a login, so shared caches must not keep them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = MEDIA_MAX_AGE
+    response.cache_control.immutable = True
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BUFFER), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _store(temp_path, sha256, filename):
+    """Moves a hashed temporary file into the store, or drops it if the content is already there."""
+    blob = db.session.get(Blob, sha256)
+    if blob is not None:
+        os.remove(temp_path)
+        return blob
+    extension = os.path.splitext(secure_filename(filename or ''))[1].lower()
+    blob = Blob(sha256=sha256, filename=sha256 + extension, size=os.path.getsize(temp_path),
+                content_type=mimetypes.guess_type(filename or '')[0] or 'application/octet-stream',
+                ref_count=0)
+    os.replace(temp_path, blob_path(blob))
+    db.session.add(blob)
+    return blob
+
+
+def store_file(stream, filename):
+    """
+    Stores a file from a readable stream (e.g. a werkzeug FileStorage),
+    hashing it while it is written. The caller commits. Returns the Blob.
+    """
+    os.makedirs(os.path.join(upload_folder(), '.partial'), exist_ok=True)
+    temp_path = _partial_path(uuid.uuid4().hex)
+    digest = hashlib.sha256()
+    with open(temp_path, 'wb') as target:
+        for block in iter(lambda: stream.read(COPY_BUFFER), b''):
+            digest.update(block)
+            target.write(block)
+    return _store(temp_path, digest.hexdigest(), filename)
+
+
+def start_upload(user_id, filename, size, sha256=None):
+    """
+    Opens a chunked upload. If the client already knows the file's hash and
+    the content is stored, no upload is needed and the Blob is returned
+    instead. Returns (UploadSession or None, Blob or None); the caller commits.
+    """
+    if sha256:
+        blob = db.session.get(Blob, sha256.lower())
+        if blob is not None:
+            return None, blob
+    # bool is an int too, but never a file size
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        raise UploadError('The file size is required, as a whole number of bytes.')
+    if size > current_app.config['MAX_UPLOAD_SIZE']:
+        raise UploadError(f"Files may be at most {current_app.config['MAX_UPLOAD_SIZE']} bytes.")
+    os.makedirs(os.path.join(upload_folder(), '.partial'), exist_ok=True)
+    upload = UploadSession(id=uuid.uuid4().hex, user_id=user_id, filename=filename, size=size, received=0)
+    open(_partial_path(upload.id), 'wb').close()
+    db.session.add(upload)
+    return upload, None
+
+
+def write_chunk(upload, offset, stream, length):
+    """
+    Writes one chunk at `offset`, which must be the number of bytes already
+    received. Rewriting the same offset after a failed request is safe.
+    The caller commits. Returns the new offset.
+    """
+    if offset != upload.received:
+        raise UploadError(f'Expected offset {upload.received}.')
+    if length is None or length > MAX_CHUNK_SIZE:
+        raise UploadError(f'Chunks must declare their length and be at most {MAX_CHUNK_SIZE} bytes.')
+    if offset + length > upload.size:
+        raise UploadError('The chunk goes past the end of the file.')
+    # Uploads opened before the limit was lowered
+    if offset + length > current_app.config['MAX_UPLOAD_SIZE']:
+        raise UploadError(f"Files may be at most {current_app.config['MAX_UPLOAD_SIZE']} bytes.")
+
+    written = 0
+    with open(_partial_path(upload.id), 'r+b') as target:
+        target.seek(offset)
+        for block in iter(lambda: stream.read(min(COPY_BUFFER, length - written)), b''):
+            target.write(block)
+            written += len(block)
+            if written >= length:
+                break
+        target.truncate()
+    if written != length:
+        raise UploadError('The chunk was cut short; resend it from the same offset.')
+    upload.received = offset + written
+    return upload.received
+
+
+def complete_upload(upload):
+    """Hashes a fully received upload and moves it into the store. The caller commits."""
+    if upload.received != upload.size:
+        raise UploadError(f'Only {upload.received} of {upload.size} bytes were received.')
+    path = _partial_path(upload.id)
+    blob = _store(path, _hash_file(path), upload.filename)
+    db.session.delete(upload)
+    return blob
+
+
+def add_reference(blob):
+    db.session.flush()
+    Blob.query.filter_by(sha256=blob.sha256).update({'ref_count': Blob.ref_count + 1},
+                                                     synchronize_session=False)
+    db.session.expire(blob, ['ref_count'])
+
+
+def release(sha256):
+    """
+    Drops one reference to a blob and removes the file once nothing uses
+    it. Call after the referencing Resource has been deleted or repointed,
+    in the same transaction. The caller commits.
+    """
+    if not sha256:
+        return
+    Blob.query.filter_by(sha256=sha256).update({'ref_count': Blob.ref_count - 1},
+                                               synchronize_session=False)
+    blob = db.session.get(Blob, sha256, populate_existing=True)
+    if blob is not None and blob.ref_count <= 0:
+        # The file goes only once the transaction that dropped it commits
+        db.session.info.setdefault('released_files', []).append(blob_path(blob))
+        db.session.delete(blob)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def _remove_released_files(session):
+    for path in session.info.pop('released_files', []):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def _keep_released_files(session, previous_transaction):
+    session.info.pop('released_files', None)
+
+
+def prune_uploads(max_age=UPLOAD_EXPIRY):
+    """
+    Removes unfinished uploads older than max_age, and stored files that
+    were uploaded that long ago but never attached to a resource. The
+    caller commits. Returns (uploads removed, files removed).
+    """
+    cutoff = datetime.utcnow() - max_age
+    expired = UploadSession.query.filter(UploadSession.created_at < cutoff).all()
+    for upload in expired:
+        path = _partial_path(upload.id)
+        if os.path.exists(path):
+            os.remove(path)
+        db.session.delete(upload)
+
+    unused = 0
+    for blob in Blob.query.filter(Blob.ref_count <= 0, Blob.created_at < cutoff).all():
+        # Only if no resource has taken it up in the meantime
+        if Blob.query.filter(Blob.sha256 == blob.sha256, Blob.ref_count <= 0)\
+                .delete(synchronize_session=False):
+            db.session.info.setdefault('released_files', []).append(blob_path(blob))
+            db.session.expunge(blob)
+            unused += 1
+    return len(expired), unused
+
+
+def take_in_files(folder):
+    """
+    Moves the files in `folder` into the store: files of known Blobs, and
+    files of resources uploaded before content-addressed storage (whose
+    links point into the static folder), which become Blobs. Needs a
+    request context for the new links. The caller commits. Returns
+    (blob files moved, resources taken in).
+    """
+    os.makedirs(os.path.join(upload_folder(), '.partial'), exist_ok=True)
+    moved = 0
+    for blob in Blob.query:
+        source = os.path.join(folder, blob.filename)
+        if os.path.exists(source):
+            if os.path.exists(blob_path(blob)):
+                os.remove(source)
+            else:
+                shutil.move(source, blob_path(blob))
+                moved += 1
+
+    taken_in = 0
+    for resource in Resource.query.filter(Resource.blob_sha256.is_(None),
+                                          Resource.link.like('%/static/uploads/%')):
+        source = os.path.join(folder, os.path.basename(resource.link))
+        if not os.path.exists(source):
+            continue
+        temp_path = _partial_path(uuid.uuid4().hex)
+        shutil.move(source, temp_path)
+        blob = _store(temp_path, _hash_file(temp_path), resource.file_name or os.path.basename(source))
+        resource.blob_sha256, resource.link = blob.sha256, blob_url(blob)
+        add_reference(blob)
+        taken_in += 1
+    return moved, taken_in
+
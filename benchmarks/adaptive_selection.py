@@ -0,0 +1,49 @@
+"""
+Micro-benchmark for adaptive item selection.
+
+Builds an InformationTable for a synthetic item bank and times select()
+for students who have already seen a session's worth of items.
+
+    python -m benchmarks.adaptive_selection --items 100000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app.adaptive import InformationTable
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--seen', type=int, default=40, help='Items already administered.')
+    parser.add_argument('--selections', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    started = time.perf_counter()
+    table = InformationTable(np.arange(1, args.items + 1),
+                             rng.uniform(0.3, 2.5, args.items), rng.normal(0, 1.2, args.items))
+    build_ms = (time.perf_counter() - started) * 1000
+
+    thetas = rng.normal(0, 1, args.selections)
+    timings = []
+    for theta in thetas:
+        seen = set()
+        # Worst case: the student has already seen the best items at this ability
+        for _ in range(args.seen):
+            seen.add(table.select(theta, exclude=seen))
+        started = time.perf_counter()
+        table.select(theta, exclude=seen)
+        timings.append(time.perf_counter() - started)
+
+    timings = np.array(timings) * 1e6
+    print(f'items={args.items} seen={args.seen} table build {build_ms:.0f} ms')
+    print(f'select(): p50 {np.percentile(timings, 50):.1f} us, p99 {np.percentile(timings, 99):.1f} us, '
+          f'max {timings.max():.1f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""
+Load test for the exam day workflow.
+
+Seeds a synthetic dataset, starts the app on a local threaded server (or
+targets an existing deployment with --url) and drives it with concurrent
+virtual candidates (login -> /exam/<id> -> autosave -> submit) alongside
+teachers loading the grading queue and analytics pages. Per-endpoint latency
+percentiles and throughput are written to benchmarks/results/ as JSON.
+
+    python -m benchmarks.exam_day --candidates 200 --concurrency 20
+    python -m benchmarks.exam_day --compare benchmarks/results/<old>.json
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from benchmarks.seed import Scale, seed, BENCH_PASSWORD
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Each request is timed on its own, so redirects are not followed
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Recorder:
+    """Thread-safe collection of (endpoint, latency, ok) samples."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, endpoint, seconds, ok):
+        with self._lock:
+            self.samples[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+
+class VirtualUser:
+    def __init__(self, base_url, recorder):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def request(self, endpoint, path, form=None, json_body=None):
+        data = None
+        headers = {}
+        if form is not None:
+            data = urllib.parse.urlencode(form).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif json_body is not None:
+            data = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers)
+        started = time.perf_counter()
+        try:
+            with self.opener.open(req, timeout=60) as response:
+                response.read()
+                ok = response.status < 400
+        except urllib.error.HTTPError as e:
+            e.read()
+            ok = 300 <= e.code < 400
+        except (urllib.error.URLError, OSError):
+            ok = False
+        self.recorder.add(endpoint, time.perf_counter() - started, ok)
+        return ok
+
+    def login(self, email):
+        return self.request('POST /auth/login', '/auth/login',
+                            form={'email': email, 'password': BENCH_PASSWORD})
+
+
+def run_candidate(base_url, recorder, student, exam_id, questions, autosaves, rng):
+    user = VirtualUser(base_url, recorder)
+    if not user.login(student['email']):
+        return
+    user.request('GET /exam/<id>', f'/exam/{exam_id}')
+    answers = {}
+    for batch in range(autosaves):
+        for question in questions[batch::autosaves]:
+            if question['type'] == 'essay':
+                answers[str(question['id'])] = 'Benchmark essay answer. ' * rng.randint(5, 40)
+            else:
+                answers[str(question['id'])] = str(rng.randrange(4))
+        user.request('POST /exam/<id>/answers', f'/exam/{exam_id}/answers',
+                     json_body={'answers': answers})
+    user.request('POST /exam/<id>/submit', f'/exam/{exam_id}/submit',
+                 json_body={'answers': answers})
+
+
+def run_teacher(base_url, recorder, teacher, stop):
+    user = VirtualUser(base_url, recorder)
+    if not user.login(teacher['email']):
+        return
+    while not stop.is_set():
+        user.request('GET /teacher/grading', '/teacher/grading')
+        user.request('GET /teacher/analytics', '/teacher/analytics')
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    for endpoint, samples in sorted(recorder.samples.items()):
+        values = sorted(samples)
+        endpoints[endpoint] = {
+            'count': len(values),
+            'errors': recorder.errors[endpoint],
+            'rps': round(len(values) / elapsed, 2) if elapsed else 0.0,
+            'mean_ms': round(sum(values) * 1000 / len(values), 2),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+        }
+    return endpoints
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def start_local_server(database_url, scale, rng_seed):
+    """Creates a fresh app on its own database, seeds it and serves it on a free port."""
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    from app import create_app
+    from app.extensions import db
+
+    class BenchConfig:
+        SQLALCHEMY_DATABASE_URI = database_url
+        # SQLite serialises writers; give concurrent submits time to queue
+        SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'timeout': 30}} if database_url.startswith('sqlite') else {}
+        MAIL_SUPPRESS_SEND = True
+        # Every virtual candidate signs in from 127.0.0.1
+        RATELIMIT_BACKEND = 'null'
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        dataset = seed(scale, seed=rng_seed)
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}', dataset
+
+
+def seed_external(database_url, scale, rng_seed):
+    from app import create_app
+    from app.extensions import db
+
+    class BenchConfig:
+        SQLALCHEMY_DATABASE_URI = database_url
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        return seed(scale, seed=rng_seed)
+
+
+def run(args):
+    scale = Scale(schools=args.schools, students=args.students, teachers=args.teachers,
+                  questions=args.questions, exams=args.exams,
+                  questions_per_exam=args.questions_per_exam, attempts=args.attempts)
+
+    server = None
+    if args.url:
+        if not args.database_url:
+            raise SystemExit('--url needs --database-url so the target database can be seeded.')
+        base_url = args.url
+        dataset = seed_external(args.database_url, scale, args.seed)
+    else:
+        database_url = args.database_url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+        server, base_url, dataset = start_local_server(database_url, scale, args.seed)
+
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+    stop = threading.Event()
+    teacher_threads = [
+        threading.Thread(target=run_teacher, args=(base_url, recorder, teacher, stop), daemon=True)
+        for teacher in dataset['teachers'][:args.teacher_sessions]
+    ]
+
+    started = time.perf_counter()
+    for thread in teacher_threads:
+        thread.start()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        # One sitting per student and exam: autosaves to an exam the student
+        # has just submitted are refused
+        sittings = [(student, exam_id) for student in dataset['students'] for exam_id in dataset['exams']]
+        for student, exam_id in rng.sample(sittings, min(args.candidates, len(sittings))):
+            pool.submit(run_candidate, base_url, recorder, student,
+                        exam_id, dataset['exams'][exam_id], args.autosaves,
+                        random.Random(rng.random()))
+    stop.set()
+    for thread in teacher_threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    if server is not None:
+        server.shutdown()
+
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            'python': platform.python_version(),
+            'target': args.url or 'local',
+            'seed': args.seed,
+            'scale': scale.as_dict(),
+            'candidates': args.candidates,
+            'concurrency': args.concurrency,
+            'teacher_sessions': args.teacher_sessions,
+            'autosaves': args.autosaves,
+            'elapsed_s': round(elapsed, 3),
+        },
+        'endpoints': summarize(recorder, elapsed),
+    }
+
+
+def print_report(result, baseline=None):
+    header = f"{'endpoint':<28}{'count':>7}{'err':>5}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}"
+    print(header)
+    print('-' * len(header))
+    for endpoint, stats in result['endpoints'].items():
+        line = (f"{endpoint:<28}{stats['count']:>7}{stats['errors']:>5}{stats['rps']:>9.1f}"
+                f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}")
+        old = (baseline or {}).get('endpoints', {}).get(endpoint)
+        if old and old['p95_ms']:
+            change = (stats['p95_ms'] - old['p95_ms']) * 100 / old['p95_ms']
+            line += f"   p95 {change:+.1f}% vs {baseline['meta']['revision']}"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', help='Benchmark an already running server instead of a local one.')
+    parser.add_argument('--database-url', help='Database to seed. It is dropped and recreated, so never point this at real data '
+                             '(defaults to a temporary SQLite file).')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--schools', type=int, default=5)
+    parser.add_argument('--students', type=int, default=200)
+    parser.add_argument('--teachers', type=int, default=10)
+    parser.add_argument('--questions', type=int, default=500)
+    parser.add_argument('--exams', type=int, default=20)
+    parser.add_argument('--questions-per-exam', type=int, default=40)
+    parser.add_argument('--attempts', type=int, default=2000, help='Historical attempts to seed.')
+    parser.add_argument('--candidates', type=int, default=100, help='Virtual candidates to run.')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--teacher-sessions', type=int, default=2)
+    parser.add_argument('--autosaves', type=int, default=3, help='Autosave requests per candidate.')
+    parser.add_argument('--output', help='Result file (defaults to benchmarks/results/<revision>.json).')
+    parser.add_argument('--compare', help='Previous result file to compare against.')
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{result['meta']['revision']}-{datetime.utcnow():%Y%m%d%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'\nResults written to {output}')
+
+
+if __name__ == '__main__':
+    main()
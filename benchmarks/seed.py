@@ -0,0 +1,180 @@
+"""
+Synthetic dataset for the benchmark harness.
+
+Everything is generated from a seeded random.Random so two runs at the same
+scale produce the same rows, which is what makes results comparable across
+commits.
+"""
+import random
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+from app.extensions import db
+from app.models import (User, UserRole, School, Question, QuestionType, Exam, ExamAttempt, AttemptAnswer,
+                        exam_questions)
+from app.grading import rebuild_subject_aggregates, rebuild_score_histograms
+from app.leaderboards import rebuild_leaderboards
+from app.answers import answer_rows as attempt_answer_rows
+from app.snapshots import pin_exam
+
+BENCH_PASSWORD = 'bench-password'
+
+SUBJECTS = {
+    'Mathematics': ['Algebra', 'Geometry', 'Statistics', 'Trigonometry'],
+    'English Language': ['Comprehension', 'Lexis', 'Summary', 'Essay Writing'],
+    'Biology': ['Cells', 'Ecology', 'Genetics', 'Nutrition'],
+    'Chemistry': ['Stoichiometry', 'Organic', 'Acids and Bases', 'Periodicity'],
+    'Physics': ['Mechanics', 'Waves', 'Electricity', 'Heat'],
+}
+DIFFICULTIES = ['Easy', 'Medium', 'Hard']
+
+
+class Scale:
+    """Row counts for one benchmark dataset."""
+
+    def __init__(self, schools=5, students=200, teachers=10, questions=500, exams=20,
+                 questions_per_exam=40, attempts=2000, essay_ratio=0.1):
+        self.schools = schools
+        self.students = students
+        self.teachers = teachers
+        self.questions = questions
+        self.exams = exams
+        self.questions_per_exam = questions_per_exam
+        self.attempts = attempts
+        self.essay_ratio = essay_ratio
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def _chunks(rows, size=1000):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def _insert(model_or_table, rows):
+    table = getattr(model_or_table, '__table__', model_or_table)
+    for chunk in _chunks(rows):
+        db.session.execute(table.insert(), chunk)
+
+
+def seed(scale, seed=42):
+    """
+    Populates an empty database and returns the accounts and exams the
+    virtual users need: {'students': [...], 'teachers': [...], 'exams': {...}}.
+    """
+    rng = random.Random(seed)
+    # Hashing is deliberately slow, so every synthetic account shares one hash
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    now = datetime.utcnow()
+
+    _insert(School, [
+        {'id': i, 'name': f'Bench Centre {i}', 'location': f'District {i}'}
+        for i in range(1, scale.schools + 1)
+    ])
+
+    teachers = []
+    students = []
+    user_rows = []
+    for i in range(1, scale.teachers + scale.students + 1):
+        is_teacher = i <= scale.teachers
+        email = f'teacher{i}@bench.local' if is_teacher else f'student{i}@bench.local'
+        user_rows.append({
+            'id': i,
+            'full_name': f'Bench {"Teacher" if is_teacher else "Student"} {i}',
+            'email': email,
+            'password_hash': password_hash,
+            'role': UserRole.TEACHER if is_teacher else UserRole.STUDENT,
+            'school_id': rng.randint(1, scale.schools),
+            'is_verified': True,
+        })
+        (teachers if is_teacher else students).append({'id': i, 'email': email})
+    _insert(User, user_rows)
+
+    question_rows = []
+    question_types = {}
+    for i in range(1, scale.questions + 1):
+        subject = rng.choice(list(SUBJECTS))
+        if rng.random() < scale.essay_ratio:
+            qtype, options, answer = QuestionType.ESSAY, None, 'Model answer'
+        else:
+            qtype = QuestionType.MCQ_SINGLE
+            options = [f'Option {c}' for c in 'ABCD']
+            answer = [str(rng.randrange(4))]
+        question_types[i] = qtype
+        question_rows.append({
+            'id': i,
+            'text': f'Synthetic question {i} on {subject}?',
+            'question_type': qtype,
+            'options': options,
+            'answer': answer,
+            'explanation': f'Explanation for question {i}.',
+            'subject': subject,
+            'topic': rng.choice(SUBJECTS[subject]),
+            'difficulty': rng.choice(DIFFICULTIES),
+            'max_score': 10,
+            'created_by': rng.randint(1, scale.teachers),
+            'version': 1,
+        })
+    _insert(Question, question_rows)
+
+    exams = {}
+    exam_rows = []
+    link_rows = []
+    question_ids = list(range(1, scale.questions + 1))
+    per_exam = min(scale.questions_per_exam, scale.questions)
+    for i in range(1, scale.exams + 1):
+        chosen = sorted(rng.sample(question_ids, per_exam))
+        exams[i] = chosen
+        exam_rows.append({
+            'id': i,
+            'title': f'Bench Mock Exam {i}',
+            'subject': rng.choice(list(SUBJECTS)),
+            'duration_minutes': 60,
+            'created_by': rng.randint(1, scale.teachers),
+            'creation_date': now - timedelta(days=rng.randint(0, 90)),
+        })
+        link_rows.extend({'exam_id': i, 'question_id': q} for q in chosen)
+    _insert(Exam, exam_rows)
+    _insert(exam_questions, link_rows)
+    # Delivery only serves pinned papers, as after `flask pin-exams`
+    digests = {exam.id: pin_exam(exam) for exam in Exam.query.order_by(Exam.id)}
+
+    attempt_rows, answer_rows = [], []
+    for i in range(1, scale.attempts + 1):
+        exam_id = rng.randint(1, scale.exams)
+        # Every seeded sitting is over, so virtual candidates start new ones
+        start = now - timedelta(days=rng.randint(1, 90), minutes=rng.randint(0, 1440))
+        answers = {}
+        for question_id in exams[exam_id]:
+            if question_types[question_id] == QuestionType.ESSAY:
+                answers[str(question_id)] = 'A synthetic essay answer. ' * rng.randint(5, 40)
+            else:
+                answers[str(question_id)] = str(rng.randrange(4))
+        has_essay = any(question_types[q] == QuestionType.ESSAY for q in exams[exam_id])
+        attempt_rows.append({
+            'id': i,
+            'user_id': rng.choice(students)['id'],
+            'exam_id': exam_id,
+            'snapshot_digest': digests[exam_id],
+            'start_time': start,
+            'end_time': start + timedelta(minutes=rng.randint(10, 60)),
+            # Attempts with essay questions are left for the grading queue
+            'score': None if has_essay and rng.random() < 0.5 else round(rng.uniform(20, 100), 2),
+        })
+        answer_rows += attempt_answer_rows(i, answers)
+    _insert(ExamAttempt, attempt_rows)
+    _insert(AttemptAnswer, answer_rows)
+    rebuild_subject_aggregates()
+    rebuild_score_histograms()
+    rebuild_leaderboards()
+
+    db.session.commit()
+    return {
+        'students': students,
+        'teachers': teachers,
+        'exams': {exam_id: [
+            {'id': q, 'type': question_types[q].value} for q in qs
+        ] for exam_id, qs in exams.items()},
+    }
@@ -0,0 +1,116 @@
+"""
+Startup profile for web workers.
+
+Times how long a fresh process takes to build the app and serve its first
+request, for the full app used by the `flask` CLI, for a web worker built
+with create_app(cli=False), and for a worker forked from a master that has
+already imported wsgi.py (gunicorn's preload_app). Each mode runs in new
+processes so nothing is shared between trials. --imports lists the modules
+that cost the most to import.
+
+    python -m benchmarks.startup --trials 5
+    python -m benchmarks.startup --imports 25
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRST_URL = '/auth/login'
+
+_COLD = """
+import json, sys, time
+started = time.perf_counter()
+from app import create_app
+app = create_app(cli={cli})
+built = time.perf_counter()
+status = app.test_client().get({url!r}).status_code
+served = time.perf_counter()
+print(json.dumps({{'create_app': built - started, 'first_request': served - built, 'total': served - started,
+                  'status': status}}))
+"""
+
+_PRELOADED = """
+import json, os, time
+import wsgi
+read, write = os.pipe()
+forked = time.perf_counter()
+if os.fork() == 0:
+    status = wsgi.app.test_client().get({url!r}).status_code
+    served = time.perf_counter()
+    os.write(write, json.dumps({{'create_app': 0.0, 'first_request': served - forked, 'total': served - forked,
+                                'status': status}}).encode())
+    os._exit(0)
+os.wait()
+print(os.read(read, 4096).decode())
+"""
+
+MODES = {
+    'cli': _COLD.format(cli=True, url=FIRST_URL),
+    'web': _COLD.format(cli=False, url=FIRST_URL),
+    'preloaded': _PRELOADED.format(url=FIRST_URL),
+}
+
+
+def _run(code, env, extra_args=()):
+    result = subprocess.run([sys.executable, *extra_args, '-c', code], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    return result
+
+
+def import_profile(env, cli, limit):
+    """[(module, self ms, cumulative ms)] for the slowest imports, from python -X importtime."""
+    result = _run(f'from app import create_app; create_app(cli={cli})', env, ('-X', 'importtime'))
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line[len('import time:'):].split('|')]
+        modules.append((name, int(self_us) / 1000, int(cumulative_us) / 1000))
+    by_package = defaultdict(float)
+    for name, self_ms, _ in modules:
+        by_package[name.split('.')[0]] += self_ms
+    slowest = sorted(modules, key=lambda m: m[1], reverse=True)[:limit]
+    packages = sorted(by_package.items(), key=lambda p: p[1], reverse=True)[:limit]
+    return slowest, packages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--trials', type=int, default=5)
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=['cli', 'web', 'preloaded'])
+    parser.add_argument('--imports', type=int, metavar='N', help='List the N slowest imports instead.')
+    parser.add_argument('--cli', action='store_true', help='With --imports, profile the CLI app.')
+    args = parser.parse_args(argv)
+
+    # A throwaway database and cache so the run does not touch site.db
+    workdir = tempfile.mkdtemp()
+    env = dict(os.environ,
+               DATABASE_URL='sqlite:///' + os.path.join(workdir, 'startup.db'),
+               CACHE_PATH=os.path.join(workdir, 'cache.sqlite3'))
+
+    if args.imports:
+        slowest, packages = import_profile(env, args.cli, args.imports)
+        print(f"{'module':<50} {'self ms':>9} {'cumul. ms':>10}")
+        for name, self_ms, cumulative_ms in slowest:
+            print(f"{name:<50} {self_ms:>9.1f} {cumulative_ms:>10.1f}")
+        print(f"\n{'package':<50} {'self ms':>9}")
+        for name, self_ms in packages:
+            print(f"{name:<50} {self_ms:>9.1f}")
+        return
+
+    print(f"{'mode':<10} {'create_app ms':>14} {'first request ms':>17} {'total ms':>9}")
+    for mode in args.modes:
+        runs = [json.loads(_run(MODES[mode], env).stdout.strip().splitlines()[-1]) for _ in range(args.trials)]
+        median = {key: statistics.median(run[key] for run in runs) * 1000
+                  for key in ('create_app', 'first_request', 'total')}
+        print(f"{mode:<10} {median['create_app']:>14.1f} {median['first_request']:>17.1f} {median['total']:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+First-render latency with and without the template bytecode cache.
+
+Each trial is a new process that builds the web app, serves its first
+request (the sign-in page, which extends base.html) and then loads the
+templates that dominate exam day, and finally every other template, timing
+each step. Three modes:
+
+    uncached  TEMPLATE_CACHE=none: every template is compiled from source
+    cold      an empty cache: compiled, then written for the next process
+    warm      the cache filled by `flask templates compile`
+
+    python -m benchmarks.templates --trials 5
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRST_URL = '/auth/login'
+HOT = ['exam_interface.html', 'student_dashboard.html', 'teacher/dashboard.html', 'teacher/question_bank.html',
+       'admin/user_management.html']
+
+_TRIAL = """
+import json, time
+from app import create_app
+app = create_app(cli=False)
+env = app.jinja_env
+timings = {{}}
+started = time.perf_counter()
+status = app.test_client().get({url!r}).status_code
+timings['first_request'] = time.perf_counter() - started
+for name in {hot!r}:
+    started = time.perf_counter()
+    env.get_template(name)
+    timings[name] = time.perf_counter() - started
+started = time.perf_counter()
+for name in env.list_templates():
+    env.get_template(name)
+timings['all others'] = time.perf_counter() - started
+timings['status'] = status
+print(json.dumps(timings))
+"""
+
+_COMPILE = """
+from app import create_app
+from app.templating import compile_templates
+compile_templates(create_app(cli=False), clean=True)
+"""
+
+MODES = ['uncached', 'cold', 'warm']
+COLUMNS = ['first_request', *HOT, 'all others']
+
+
+def _run(code, env):
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True,
+                            check=True)
+    return result.stdout
+
+
+def trial(mode, env, cache_path):
+    env = dict(env, TEMPLATE_CACHE='none' if mode == 'uncached' else 'filesystem', TEMPLATE_CACHE_PATH=cache_path)
+    if mode == 'cold':
+        shutil.rmtree(cache_path, ignore_errors=True)
+    return json.loads(_run(_TRIAL.format(url=FIRST_URL, hot=HOT), env).strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--trials', type=int, default=5)
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    args = parser.parse_args(argv)
+
+    # A throwaway database, cache and template cache so the run does not touch site.db or instance/
+    workdir = tempfile.mkdtemp()
+    cache_path = os.path.join(workdir, 'jinja-cache')
+    env = dict(os.environ,
+               DATABASE_URL='sqlite:///' + os.path.join(workdir, 'templates.db'),
+               CACHE_PATH=os.path.join(workdir, 'cache.sqlite3'),
+               RATELIMIT_PATH=os.path.join(workdir, 'ratelimit.sqlite3'),
+               INVIGILATION_PATH=os.path.join(workdir, 'invigilation.sqlite3'))
+
+    width = max(len(column) for column in COLUMNS)
+    print(f"{'ms':<{width}} " + ' '.join(f'{mode:>9}' for mode in args.modes))
+    medians = {}
+    for mode in args.modes:
+        if mode == 'warm':
+            _run(_COMPILE, dict(env, TEMPLATE_CACHE='filesystem', TEMPLATE_CACHE_PATH=cache_path))
+        runs = [trial(mode, env, cache_path) for _ in range(args.trials)]
+        medians[mode] = {column: statistics.median(run[column] for run in runs) * 1000 for column in COLUMNS}
+    for column in COLUMNS:
+        print(f"{column:<{width}} " + ' '.join(f'{medians[mode][column]:>9.1f}' for mode in args.modes))
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+"""
+Gunicorn settings for the web workers:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+WEB_CONCURRENCY sets the number of workers, GUNICORN_THREADS the threads in
+each and GUNICORN_BIND the address.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# Invigilation dashboards hold a Server-Sent Events stream open; with threads a
+# watching invigilator takes one thread rather than a whole worker. At most
+# INVIGILATION_MAX_STREAMS of them are streams, so keep this above that.
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Import and warm the app once in the master; new workers start from a fork
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Database connections opened in the master must not be shared
+    from wsgi import app
+    from app.extensions import db
+    with app.app_context():
+        db.engine.dispose(close=False)
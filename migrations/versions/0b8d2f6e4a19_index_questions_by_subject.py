@@ -0,0 +1,26 @@
+"""Index questions by subject for keyset pagination
+
+Revision ID: 0b8d2f6e4a19
+Revises: f2b7c9a4d316
+Create Date: 2026-10-19 18:02:44.371950
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b8d2f6e4a19'
+down_revision = 'f2b7c9a4d316'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('question', schema=None) as batch_op:
+        batch_op.create_index('ix_question_subject_id', ['subject', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('question', schema=None) as batch_op:
+        batch_op.drop_index('ix_question_subject_id')
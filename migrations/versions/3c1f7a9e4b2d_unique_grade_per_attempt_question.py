@@ -0,0 +1,32 @@
+"""Unique grade per attempt and question, index attempts by exam
+
+Revision ID: 3c1f7a9e4b2d
+Revises: 96d15537eba0
+Create Date: 2026-10-19 09:12:41.204117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1f7a9e4b2d'
+down_revision = '96d15537eba0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('grade', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_grade_attempt_question', ['attempt_id', 'question_id'])
+
+    with op.batch_alter_table('exam_attempt', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_exam_attempt_exam_id'), ['exam_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('exam_attempt', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_exam_attempt_exam_id'))
+
+    with op.batch_alter_table('grade', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_grade_attempt_question', type_='unique')
@@ -0,0 +1,56 @@
+"""Add exam status and the archived_attempt table
+
+Revision ID: 3d7a9f1e5c82
+Revises: b5c8e2a7f940
+Create Date: 2026-10-19 21:48:05.271936
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d7a9f1e5c82'
+down_revision = 'b5c8e2a7f940'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('exam', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('status', sa.String(length=20), nullable=False, server_default='active'))
+        batch_op.create_index(batch_op.f('ix_exam_status'), ['status'], unique=False)
+
+    op.create_table('archived_attempt',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('attempt_id', sa.Integer(), nullable=False),
+    sa.Column('sync_key', sa.String(length=32), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('exam_id', sa.Integer(), nullable=False),
+    sa.Column('start_time', sa.DateTime(), nullable=False),
+    sa.Column('end_time', sa.DateTime(), nullable=True),
+    sa.Column('score', sa.Float(), nullable=True),
+    sa.Column('snapshot_digest', sa.String(length=64), nullable=True),
+    sa.Column('payload', sa.LargeBinary(), nullable=False),
+    sa.Column('archived_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['exam_id'], ['exam.id'], ),
+    sa.ForeignKeyConstraint(['snapshot_digest'], ['exam_snapshot.digest'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('archived_attempt', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_archived_attempt_exam_id'), ['exam_id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_archived_attempt_sync_key'), ['sync_key'], unique=False)
+        batch_op.create_index(batch_op.f('ix_archived_attempt_user_id'), ['user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('archived_attempt', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_archived_attempt_user_id'))
+        batch_op.drop_index(batch_op.f('ix_archived_attempt_sync_key'))
+        batch_op.drop_index(batch_op.f('ix_archived_attempt_exam_id'))
+
+    op.drop_table('archived_attempt')
+    with op.batch_alter_table('exam', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_exam_status'))
+        batch_op.drop_column('status')
@@ -0,0 +1,53 @@
+"""Add leaderboard entries and rank trees
+
+Revision ID: 4e9b2c7d1a58
+Revises: 7c4e1a9d2b63
+Create Date: 2026-10-19 20:04:51.226184
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e9b2c7d1a58'
+down_revision = '7c4e1a9d2b63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Filled in by `flask leaderboards rebuild`; the rank trees are built in Python
+    op.create_table('leaderboard_entry',
+    sa.Column('board', sa.String(length=120), nullable=False),
+    sa.Column('attempt_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('school_id', sa.Integer(), nullable=True),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['attempt_id'], ['exam_attempt.id'], ),
+    sa.ForeignKeyConstraint(['school_id'], ['school.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('board', 'attempt_id')
+    )
+    with op.batch_alter_table('leaderboard_entry', schema=None) as batch_op:
+        batch_op.create_index('ix_leaderboard_entry_board_score', ['board', 'score'], unique=False)
+        batch_op.create_index('ix_leaderboard_entry_board_school_score', ['board', 'school_id', 'score'], unique=False)
+        batch_op.create_index('ix_leaderboard_entry_user_board', ['user_id', 'board'], unique=False)
+
+    op.create_table('rank_node',
+    sa.Column('board', sa.String(length=120), nullable=False),
+    sa.Column('school_id', sa.Integer(), nullable=False),
+    sa.Column('node', sa.Integer(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('board', 'school_id', 'node')
+    )
+
+
+def downgrade():
+    op.drop_table('rank_node')
+    with op.batch_alter_table('leaderboard_entry', schema=None) as batch_op:
+        batch_op.drop_index('ix_leaderboard_entry_user_board')
+        batch_op.drop_index('ix_leaderboard_entry_board_school_score')
+        batch_op.drop_index('ix_leaderboard_entry_board_score')
+
+    op.drop_table('leaderboard_entry')
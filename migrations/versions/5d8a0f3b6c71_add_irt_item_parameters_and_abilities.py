@@ -0,0 +1,50 @@
+"""Add IRT item parameter and student ability tables
+
+Revision ID: 5d8a0f3b6c71
+Revises: b7e2d4c1a9f0
+Create Date: 2026-10-19 11:20:05.813340
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d8a0f3b6c71'
+down_revision = 'b7e2d4c1a9f0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('item_parameter',
+    sa.Column('question_id', sa.Integer(), nullable=False),
+    sa.Column('subject', sa.String(length=100), nullable=False),
+    sa.Column('discrimination', sa.Float(), nullable=False),
+    sa.Column('difficulty', sa.Float(), nullable=False),
+    sa.Column('responses', sa.Integer(), nullable=False),
+    sa.Column('calibrated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['question_id'], ['question.id'], ),
+    sa.PrimaryKeyConstraint('question_id')
+    )
+    with op.batch_alter_table('item_parameter', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_item_parameter_subject'), ['subject'], unique=False)
+
+    op.create_table('student_ability',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('subject', sa.String(length=100), nullable=False),
+    sa.Column('theta', sa.Float(), nullable=False),
+    sa.Column('standard_error', sa.Float(), nullable=False),
+    sa.Column('responses', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'subject')
+    )
+
+
+def downgrade():
+    op.drop_table('student_ability')
+    with op.batch_alter_table('item_parameter', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_item_parameter_subject'))
+
+    op.drop_table('item_parameter')
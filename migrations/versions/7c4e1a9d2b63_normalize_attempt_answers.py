@@ -0,0 +1,137 @@
+"""Move attempt answers from a JSON column to the attempt_answer table
+
+Revision ID: 7c4e1a9d2b63
+Revises: 0b8d2f6e4a19
+Create Date: 2026-10-19 19:12:08.513604
+
+"""
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c4e1a9d2b63'
+down_revision = '0b8d2f6e4a19'
+branch_labels = None
+depends_on = None
+
+CHUNK_SIZE = 1000
+
+exam_attempt = sa.table('exam_attempt', sa.column('id', sa.Integer), sa.column('answers', sa.JSON))
+attempt_answer = sa.table('attempt_answer', sa.column('attempt_id', sa.Integer), sa.column('question_id', sa.Integer),
+                          sa.column('choice', sa.SmallInteger), sa.column('choices', sa.BigInteger),
+                          sa.column('text', sa.Text))
+
+
+# Frozen copy of app.answers.encode/decode as of this revision
+def _index(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value if 0 <= value <= 32767 else None
+    if isinstance(value, str) and value.isdigit() and str(int(value)) == value and int(value) <= 32767:
+        return int(value)
+    return None
+
+
+def _encode(answer):
+    if isinstance(answer, (list, tuple)):
+        indices = [_index(value) for value in answer]
+        if all(index is not None and index <= 62 for index in indices):
+            mask = 0
+            for index in indices:
+                mask |= 1 << index
+            return None, mask, None
+        return None, None, '\n'.join(str(value) for value in answer)
+    index = _index(answer)
+    if index is not None:
+        return index, None, None
+    return None, None, str(answer)
+
+
+def _decode(choice, choices, text):
+    if choice is not None:
+        return str(choice)
+    if choices is not None:
+        return [str(bit) for bit in range(63) if choices >> bit & 1]
+    return text
+
+
+def _load(value):
+    # Some drivers hand back JSON columns as text
+    return json.loads(value) if isinstance(value, str) else value
+
+
+def upgrade():
+    op.create_table('attempt_answer',
+        sa.Column('attempt_id', sa.Integer(), nullable=False),
+        sa.Column('question_id', sa.Integer(), nullable=False),
+        sa.Column('choice', sa.SmallInteger(), nullable=True),
+        sa.Column('choices', sa.BigInteger(), nullable=True),
+        sa.Column('text', sa.Text(), nullable=True),
+        sa.ForeignKeyConstraint(['attempt_id'], ['exam_attempt.id'], ),
+        sa.ForeignKeyConstraint(['question_id'], ['question.id'], ),
+        sa.PrimaryKeyConstraint('attempt_id', 'question_id')
+    )
+
+    # Backfill in keyset-paged chunks so memory stays flat on large tables
+    conn = op.get_bind()
+    question_ids = {question_id for (question_id,) in conn.execute(sa.text('SELECT id FROM question'))}
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select(exam_attempt.c.id, exam_attempt.c.answers)
+            .where(exam_attempt.c.id > last_id).order_by(exam_attempt.c.id).limit(CHUNK_SIZE)
+        ).all()
+        if not rows:
+            break
+        inserts = []
+        for attempt_id, answers in rows:
+            for question_id, answer in (_load(answers) or {}).items():
+                # Answers to questions that no longer exist cannot be kept under the foreign key
+                if answer is None or not str(question_id).isdigit() or int(question_id) not in question_ids:
+                    continue
+                choice, choices, text = _encode(answer)
+                inserts.append({'attempt_id': attempt_id, 'question_id': int(question_id),
+                                'choice': choice, 'choices': choices, 'text': text})
+        if inserts:
+            conn.execute(attempt_answer.insert(), inserts)
+        last_id = rows[-1][0]
+
+    # Built after the backfill, which is faster than maintaining it row by row
+    with op.batch_alter_table('attempt_answer', schema=None) as batch_op:
+        batch_op.create_index('ix_attempt_answer_question_attempt', ['question_id', 'attempt_id'], unique=False)
+
+    with op.batch_alter_table('exam_attempt', schema=None) as batch_op:
+        batch_op.drop_column('answers')
+
+
+def downgrade():
+    with op.batch_alter_table('exam_attempt', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('answers', sa.JSON(), nullable=True))
+
+    conn = op.get_bind()
+    last_id = 0
+    while True:
+        attempt_ids = [attempt_id for (attempt_id,) in conn.execute(
+            sa.select(exam_attempt.c.id).where(exam_attempt.c.id > last_id)
+            .order_by(exam_attempt.c.id).limit(CHUNK_SIZE))]
+        if not attempt_ids:
+            break
+        answers = {attempt_id: {} for attempt_id in attempt_ids}
+        for attempt_id, question_id, choice, choices, text in conn.execute(
+            sa.select(attempt_answer.c.attempt_id, attempt_answer.c.question_id, attempt_answer.c.choice,
+                      attempt_answer.c.choices, attempt_answer.c.text)
+            .where(attempt_answer.c.attempt_id.in_(attempt_ids))
+        ):
+            answers[attempt_id][str(question_id)] = _decode(choice, choices, text)
+        for attempt_id, values in answers.items():
+            conn.execute(exam_attempt.update().where(exam_attempt.c.id == attempt_id).values(answers=values))
+        last_id = attempt_ids[-1]
+
+    with op.batch_alter_table('attempt_answer', schema=None) as batch_op:
+        batch_op.drop_index('ix_attempt_answer_question_attempt')
+
+    op.drop_table('attempt_answer')
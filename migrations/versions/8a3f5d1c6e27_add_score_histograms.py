@@ -0,0 +1,53 @@
+"""Add per-exam, per-centre score histograms
+
+Revision ID: 8a3f5d1c6e27
+Revises: 4e9b2c7d1a58
+Create Date: 2026-10-19 20:41:17.904312
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a3f5d1c6e27'
+down_revision = '4e9b2c7d1a58'
+branch_labels = None
+depends_on = None
+
+BINS = 101
+
+
+def upgrade():
+    op.create_table('score_histogram',
+    sa.Column('exam_id', sa.Integer(), nullable=False),
+    sa.Column('school_id', sa.Integer(), nullable=False),
+    sa.Column('bin', sa.SmallInteger(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['exam_id'], ['exam.id'], ),
+    sa.PrimaryKeyConstraint('exam_id', 'school_id', 'bin')
+    )
+
+    # Backfill from the scores already recorded; binning is done here because
+    # SQL float-to-integer casts round on some databases and truncate on others
+    conn = op.get_bind()
+    counts = {}
+    for exam_id, school_id, score, count in conn.execute(sa.text(
+        'SELECT exam_attempt.exam_id, "user".school_id, exam_attempt.score, COUNT(exam_attempt.id) '
+        'FROM exam_attempt JOIN "user" ON "user".id = exam_attempt.user_id '
+        'WHERE exam_attempt.score IS NOT NULL '
+        'GROUP BY exam_attempt.exam_id, "user".school_id, exam_attempt.score'
+    )):
+        key = (exam_id, school_id or 0, min(max(int(score), 0), BINS - 1))
+        counts[key] = counts.get(key, 0) + count
+    if counts:
+        histogram = sa.table('score_histogram', sa.column('exam_id', sa.Integer), sa.column('school_id', sa.Integer),
+                             sa.column('bin', sa.SmallInteger), sa.column('count', sa.Integer))
+        op.bulk_insert(histogram, [
+            {'exam_id': exam_id, 'school_id': school_id, 'bin': index, 'count': count}
+            for (exam_id, school_id, index), count in counts.items()
+        ])
+
+
+def downgrade():
+    op.drop_table('score_histogram')
@@ -0,0 +1,45 @@
+"""Add resource topics and the resource_recommendation table
+
+Revision ID: 8c4f2d6b1a93
+Revises: 3d7a9f1e5c82
+Create Date: 2026-10-19 23:12:41.508317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4f2d6b1a93'
+down_revision = '3d7a9f1e5c82'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('resource', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('topic', sa.String(length=100), nullable=True))
+
+    op.create_table('resource_recommendation',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('position', sa.SmallInteger(), nullable=False),
+    sa.Column('resource_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.Column('answered', sa.Integer(), nullable=False),
+    sa.Column('correct', sa.Integer(), nullable=False),
+    sa.Column('computed_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['resource_id'], ['resource.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'position')
+    )
+    with op.batch_alter_table('resource_recommendation', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_resource_recommendation_resource_id'), ['resource_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('resource_recommendation', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_resource_recommendation_resource_id'))
+
+    op.drop_table('resource_recommendation')
+    with op.batch_alter_table('resource', schema=None) as batch_op:
+        batch_op.drop_column('topic')
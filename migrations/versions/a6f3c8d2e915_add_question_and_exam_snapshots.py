@@ -0,0 +1,62 @@
+"""Add immutable question and exam snapshots
+
+Revision ID: a6f3c8d2e915
+Revises: e41c9b2f7a55
+Create Date: 2026-10-19 14:05:33.518402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6f3c8d2e915'
+down_revision = 'e41c9b2f7a55'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('question_snapshot',
+    sa.Column('digest', sa.String(length=64), nullable=False),
+    sa.Column('question_id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('payload', sa.LargeBinary(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['question_id'], ['question.id'], ),
+    sa.PrimaryKeyConstraint('digest')
+    )
+    with op.batch_alter_table('question_snapshot', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_question_snapshot_question_id'), ['question_id'], unique=False)
+
+    op.create_table('exam_snapshot',
+    sa.Column('digest', sa.String(length=64), nullable=False),
+    sa.Column('question_digests', sa.JSON(), nullable=False),
+    sa.Column('payload', sa.LargeBinary(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('digest')
+    )
+
+    with op.batch_alter_table('exam', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('snapshot_digest', sa.String(length=64), nullable=True))
+        batch_op.create_foreign_key('fk_exam_snapshot_digest', 'exam_snapshot', ['snapshot_digest'], ['digest'])
+
+    with op.batch_alter_table('exam_attempt', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('snapshot_digest', sa.String(length=64), nullable=True))
+        batch_op.create_foreign_key('fk_exam_attempt_snapshot_digest', 'exam_snapshot', ['snapshot_digest'], ['digest'])
+
+
+def downgrade():
+    with op.batch_alter_table('exam_attempt', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_exam_attempt_snapshot_digest', type_='foreignkey')
+        batch_op.drop_column('snapshot_digest')
+
+    with op.batch_alter_table('exam', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_exam_snapshot_digest', type_='foreignkey')
+        batch_op.drop_column('snapshot_digest')
+
+    op.drop_table('exam_snapshot')
+    with op.batch_alter_table('question_snapshot', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_question_snapshot_question_id'))
+
+    op.drop_table('question_snapshot')
@@ -0,0 +1,27 @@
+"""Index questions by subject, topic and difficulty for exam blueprints
+
+Revision ID: b5c8e2a7f940
+Revises: 8a3f5d1c6e27
+Create Date: 2026-10-19 21:15:32.618045
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5c8e2a7f940'
+down_revision = '8a3f5d1c6e27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('question', schema=None) as batch_op:
+        batch_op.create_index('ix_question_subject_topic_difficulty', ['subject', 'topic', 'difficulty', 'id'],
+                              unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('question', schema=None) as batch_op:
+        batch_op.drop_index('ix_question_subject_topic_difficulty')
@@ -0,0 +1,50 @@
+"""Add answer signature and similarity flag tables
+
+Revision ID: b7e2d4c1a9f0
+Revises: 3c1f7a9e4b2d
+Create Date: 2026-10-19 10:03:27.551902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2d4c1a9f0'
+down_revision = '3c1f7a9e4b2d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('answer_signature',
+    sa.Column('question_id', sa.Integer(), nullable=False),
+    sa.Column('attempt_id', sa.Integer(), nullable=False),
+    sa.Column('signature', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['attempt_id'], ['exam_attempt.id'], ),
+    sa.ForeignKeyConstraint(['question_id'], ['question.id'], ),
+    sa.PrimaryKeyConstraint('question_id', 'attempt_id')
+    )
+    op.create_table('similarity_flag',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('question_id', sa.Integer(), nullable=False),
+    sa.Column('attempt_id', sa.Integer(), nullable=False),
+    sa.Column('other_attempt_id', sa.Integer(), nullable=False),
+    sa.Column('similarity', sa.Float(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['attempt_id'], ['exam_attempt.id'], ),
+    sa.ForeignKeyConstraint(['other_attempt_id'], ['exam_attempt.id'], ),
+    sa.ForeignKeyConstraint(['question_id'], ['question.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('question_id', 'attempt_id', 'other_attempt_id', name='uq_similarity_flag_pair')
+    )
+    with op.batch_alter_table('similarity_flag', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_similarity_flag_other_attempt_id'), ['other_attempt_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('similarity_flag', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_similarity_flag_other_attempt_id'))
+
+    op.drop_table('similarity_flag')
+    op.drop_table('answer_signature')
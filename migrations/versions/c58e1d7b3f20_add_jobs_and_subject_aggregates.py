@@ -0,0 +1,65 @@
+"""Add background jobs and per-subject score aggregates
+
+Revision ID: c58e1d7b3f20
+Revises: a6f3c8d2e915
+Create Date: 2026-10-19 15:22:47.903115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c58e1d7b3f20'
+down_revision = 'a6f3c8d2e915'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('job',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=50), nullable=False),
+    sa.Column('params', sa.JSON(), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('cursor', sa.JSON(), nullable=True),
+    sa.Column('progress', sa.Integer(), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=True),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('worker', sa.String(length=100), nullable=True),
+    sa.Column('created_by', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('heartbeat_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['created_by'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_job_status'), ['status'], unique=False)
+
+    op.create_table('subject_aggregate',
+    sa.Column('teacher_id', sa.Integer(), nullable=False),
+    sa.Column('subject', sa.String(length=100), nullable=False),
+    sa.Column('scored_attempts', sa.Integer(), nullable=False),
+    sa.Column('score_sum', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['teacher_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('teacher_id', 'subject')
+    )
+
+    # Backfill from the scores already recorded
+    op.execute(
+        'INSERT INTO subject_aggregate (teacher_id, subject, scored_attempts, score_sum) '
+        'SELECT exam.created_by, exam.subject, COUNT(exam_attempt.score), SUM(exam_attempt.score) '
+        'FROM exam JOIN exam_attempt ON exam_attempt.exam_id = exam.id '
+        'WHERE exam_attempt.score IS NOT NULL '
+        'GROUP BY exam.created_by, exam.subject'
+    )
+
+
+def downgrade():
+    op.drop_table('subject_aggregate')
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_job_status'))
+
+    op.drop_table('job')
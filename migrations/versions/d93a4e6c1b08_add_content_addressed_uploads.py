@@ -0,0 +1,54 @@
+"""Add content-addressed upload storage and chunked upload sessions
+
+Revision ID: d93a4e6c1b08
+Revises: c58e1d7b3f20
+Create Date: 2026-10-19 16:48:10.226731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd93a4e6c1b08'
+down_revision = 'c58e1d7b3f20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('blob',
+    sa.Column('sha256', sa.String(length=64), nullable=False),
+    sa.Column('filename', sa.String(length=80), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=False),
+    sa.Column('content_type', sa.String(length=100), nullable=False),
+    sa.Column('ref_count', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('sha256')
+    )
+    op.create_table('upload_session',
+    sa.Column('id', sa.String(length=32), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('filename', sa.String(length=255), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=False),
+    sa.Column('received', sa.BigInteger(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('resource', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('blob_sha256', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('file_name', sa.String(length=255), nullable=True))
+        batch_op.create_index(batch_op.f('ix_resource_blob_sha256'), ['blob_sha256'], unique=False)
+        batch_op.create_foreign_key('fk_resource_blob_sha256', 'blob', ['blob_sha256'], ['sha256'])
+
+
+def downgrade():
+    with op.batch_alter_table('resource', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_resource_blob_sha256', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_resource_blob_sha256'))
+        batch_op.drop_column('file_name')
+        batch_op.drop_column('blob_sha256')
+
+    op.drop_table('upload_session')
+    op.drop_table('blob')
@@ -0,0 +1,28 @@
+"""Add sync key to exam attempts for centre result imports
+
+Revision ID: e41c9b2f7a55
+Revises: 5d8a0f3b6c71
+Create Date: 2026-10-19 12:41:52.097214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e41c9b2f7a55'
+down_revision = '5d8a0f3b6c71'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('exam_attempt', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('sync_key', sa.String(length=32), nullable=True))
+        batch_op.create_unique_constraint('uq_exam_attempt_sync_key', ['sync_key'])
+
+
+def downgrade():
+    with op.batch_alter_table('exam_attempt', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_exam_attempt_sync_key', type_='unique')
+        batch_op.drop_column('sync_key')
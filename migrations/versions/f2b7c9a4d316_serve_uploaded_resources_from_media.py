@@ -0,0 +1,25 @@
+"""Point content-addressed resource links at the media endpoint
+
+Revision ID: f2b7c9a4d316
+Revises: d93a4e6c1b08
+Create Date: 2026-10-19 17:31:05.640218
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b7c9a4d316'
+down_revision = 'd93a4e6c1b08'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("UPDATE resource SET link = REPLACE(link, '/static/uploads/', '/media/') "
+               "WHERE blob_sha256 IS NOT NULL")
+
+
+def downgrade():
+    op.execute("UPDATE resource SET link = REPLACE(link, '/media/', '/static/uploads/') "
+               "WHERE blob_sha256 IS NOT NULL")
@@ -0,0 +1,27 @@
+"""
+Entry point for production web workers:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is built without the CLI commands and Flask-Migrate. With
+preload_app (see gunicorn.conf.py) this module runs once in the master:
+mappers are configured and templates loaded (from the bytecode cache when
+`flask templates compile` has run, see app.templating) before the workers are
+forked, and gc.freeze() keeps the collector from writing to those objects,
+so the workers go on sharing their memory pages instead of copying them.
+"""
+import gc
+
+from sqlalchemy.orm import configure_mappers
+
+from app import create_app
+
+app = create_app(cli=False)
+
+with app.app_context():
+    configure_mappers()
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+gc.collect()
+gc.freeze()